@@ -1,4 +1,6 @@
 from .logistics_detail_constants import *
 from .order_data_constants import *
 from .item_info_constants import *
+from .seller_data_constants import *
+from .inventory_data_constants import *
 from .data_processing_constants import *
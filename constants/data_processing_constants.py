@@ -1,6 +1,13 @@
 import pandas as pd
 
 DAY_ONE = pd.Timestamp("2017-01-01")
+# Format of the timestamps in the raw csv files
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Cleaning rule thresholds
+MAX_SHIPMENT_DAYS = 8
+MAX_SHIPMENT_ACTIONS = 10
+MIN_SHIPMENT_ACTIONS = 4
 
 # pd actions
 LEFT = 'left'
@@ -23,3 +30,8 @@ SHIPMENT_ACTION_COUNT = 'shipment_action_count'
 ACTION_COUNT = 'action_count'
 WEEK_COUNT = 'week_count'
 DAY_OF_WEEK = 'day_of_week'
+CONSIGN_TIME = 'consign_time'
+SIGN_COUNT = 'sign_count'
+CONSIGN_COUNT = 'consign_count'
+PAY_DATE = 'pay_date'
+ORDER_KEY = 'order_key'
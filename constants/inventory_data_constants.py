@@ -0,0 +1,8 @@
+WAREHOUSE_ID = 'warehouse_id'
+WAREHOUSE_CITY_ID = 'warehouse_city_id'
+TOTAL_BEGIN_QTY = 'total_begin_qty'
+TOTAL_END_QTY = 'total_end_qty'
+REPLEN_IN_QTY = 'Replen_in_qty'
+TRANSFER_IN_QTY = 'transfer_in_qty'
+SALE_OUT_QTY = 'sale_out_qty'
+TRANSFER_OUT_QTY = 'transfer_out_qty'
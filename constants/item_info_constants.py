@@ -1,4 +1,11 @@
+DATE = 'date'
 ITEM_ID = 'item_id'
+FRONT_PAGE_ITEM_ID = 'front_page_item_id'
 MERCHANT_ID = 'merchant_id'
 BRAND_ID = 'brand_id'
 CATEGORY_ID = 'category_id'
+SUB_CATEGORY_ID = 'sub_category_id'
+PC_PV = 'pc_pv'
+APP_PV = 'app_pv'
+PC_UV = 'pc_uv'
+APP_UV = 'app_uv'
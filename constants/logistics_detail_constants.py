@@ -11,6 +11,8 @@ TIMESTAMP = 'timestamp'
 
 # Transformed column names
 TIMESTAMP_DATE_TIME = 'timestamp_datetime'
+# Whether the timestamp was present but could not be parsed
+TIMESTAMP_INVALID = 'timestamp_invalid'
 
 # Actions
 FAILURE = 'FAILURE'
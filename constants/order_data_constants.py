@@ -9,3 +9,8 @@ MERCHANT_ID = 'merchant_id'
 LOGISTICS_REVIEW_SCORE = 'logistics_review_score'
 
 PAY_TIMESTAMP_DATETIME = 'pay_timestamp_datetime'
+PAY_TIMESTAMP_INVALID = 'pay_timestamp_invalid'
+
+# Parsed from the item detail info, a comma separated list of item_id:quantity
+ITEM_COUNT = 'item_count'
+ITEM_QUANTITY = 'item_quantity'
@@ -0,0 +1,4 @@
+SUBCATEGORY_ID = 'subcategory_id'
+AVG_LOGISTIC_REVIEW_SCORE = 'avg_logistic_review_score'
+AVG_ORDER_QUALITY_SCORE = 'avg_order_quality_score'
+AVG_SERVICE_QUALITY_SCORE = 'avg_service_quality_score'
@@ -1,2 +1,13 @@
+from .arrow_conversion import *
+from .cleaning_audit import *
 from .data_cleaner import *
 from .data_loader import *
+from .dimension_tables import *
+from .event_store import *
+from .manifest import *
+from .order_keys import *
+from .order_summary import *
+from .parquet_export import *
+from .partitioning import *
+from .schema import *
+from .synthetic_data import *
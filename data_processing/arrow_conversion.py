@@ -0,0 +1,171 @@
+import logging
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+
+from constants import *
+from .schema import ACTION_DTYPE, INVENTORY_COLUMN_NAMES, ITEM_COLUMN_NAMES, LOGISTICS_COLUMN_NAMES, \
+    ORDER_COLUMN_NAMES, SELLER_COLUMN_NAMES
+
+# Bytes of csv parsed at a time, each block becomes one record batch of the feather file
+CSV_BLOCK_SIZE = 16 * 1024 ** 2
+FEATHER_COMPRESSION = 'lz4'
+
+# Every batch is encoded against the same dictionary, feather files only allow one dictionary per column
+ACTION_DICTIONARY = pa.array(list(ACTION_DTYPE.categories), type=pa.string())
+# The timestamps and the columns categorized by the typed schema are read as strings, other types are inferred
+LOGISTICS_COLUMN_TYPES = {ORDER_ID: pa.int64(), ORDER_DATE: pa.string(), ACTION: pa.string(),
+                          FACILITY_TYPE: pa.string(), TIMESTAMP: pa.string()}
+ORDER_COLUMN_TYPES = {DAY: pa.string(), ORDER_ID: pa.int64(), ITEM_DETAIL_INFO: pa.string(),
+                      PAY_TIMESTAMP: pa.string()}
+ITEM_COLUMN_TYPES = {DATE: pa.string()}
+SELLER_COLUMN_TYPES = {DAY: pa.string()}
+INVENTORY_COLUMN_TYPES = {DAY: pa.string()}
+
+
+def parse_timestamp_array(timestamps: pa.Array) -> tuple:
+    """
+    Parse timestamp strings in TIMESTAMP_FORMAT into timestamps, invalid timestamps become null
+    :param timestamps: array of timestamp strings
+    :return: array of timestamps and array flagging the timestamps that were present but could not be parsed
+    """
+    parsed_timestamps = pc.strptime(timestamps, format=TIMESTAMP_FORMAT, unit='ns', error_is_null=True)
+    return parsed_timestamps, pc.and_(pc.is_valid(timestamps), pc.is_null(parsed_timestamps))
+
+
+def encode_actions(actions: pa.Array) -> pa.DictionaryArray:
+    """
+    Dictionary encode actions in the category order of ACTION_DTYPE, unknown actions become null
+    :param actions: array of action strings
+    :return: dictionary array of actions
+    """
+    indices = pc.index_in(actions, value_set=ACTION_DICTIONARY)
+    unknown_actions = actions.filter(pc.and_(pc.is_valid(actions), pc.is_null(indices)))
+    if len(unknown_actions):
+        logging.warning(f'unknown values in {ACTION} are stored as missing: {set(unknown_actions.to_pylist())}')
+    return pa.DictionaryArray.from_arrays(indices.cast(pa.int8()), ACTION_DICTIONARY)
+
+
+def _replace_timestamp(columns: dict, timestamp_column: str, datetime_column: str, invalid_column: str) -> dict:
+    columns[datetime_column], columns[invalid_column] = parse_timestamp_array(columns.pop(timestamp_column))
+    return columns
+
+
+def convert_logistics_batch(batch: pa.RecordBatch) -> pa.RecordBatch:
+    """
+    Convert a batch of logistics data read from csv to the typed schema, see apply_logistics_schema. Ids are
+    downcast when the data is loaded
+    :param batch: record batch read from csv
+    :return: converted record batch
+    """
+    columns = dict(zip(batch.schema.names, batch.columns))
+    columns[ACTION] = encode_actions(columns[ACTION])
+    columns = _replace_timestamp(columns, TIMESTAMP, TIMESTAMP_DATE_TIME, TIMESTAMP_INVALID)
+    return pa.RecordBatch.from_arrays(list(columns.values()), names=list(columns))
+
+
+def convert_order_batch(batch: pa.RecordBatch) -> pa.RecordBatch:
+    """
+    Convert a batch of order data read from csv to the typed schema, see apply_order_schema. Ids and small integer
+    columns are downcast when the data is loaded
+    :param batch: record batch read from csv
+    :return: converted record batch
+    """
+    columns = dict(zip(batch.schema.names, batch.columns))
+    columns = _replace_timestamp(columns, PAY_TIMESTAMP, PAY_TIMESTAMP_DATETIME, PAY_TIMESTAMP_INVALID)
+    return pa.RecordBatch.from_arrays(list(columns.values()), names=list(columns))
+
+
+def keep_batch(batch: pa.RecordBatch) -> pa.RecordBatch:
+    """
+    Keep a batch read from csv as it is, for the item, seller and inventory data whose ids and days are converted to
+    the typed schema when the data is loaded
+    :param batch: record batch read from csv
+    :return: the same record batch
+    """
+    return batch
+
+
+def convert_csv_to_feather(csv_path: str, feather_path: str, column_names: list, column_types: dict, convert_batch,
+                           block_size: int = CSV_BLOCK_SIZE):
+    """
+    Stream a csv file through the multithreaded pyarrow csv reader and write the converted batches straight to a
+    feather file, no more than one block of the csv file is held in memory and no pandas dataframe is built
+    :param csv_path: path to the csv file
+    :param feather_path: path to the feather file to write
+    :param column_names: column names of the csv file
+    :param column_types: types of the columns that are not inferred
+    :param convert_batch: function converting each record batch, e.g. convert_logistics_batch
+    :param block_size: bytes of csv read at a time
+    """
+    logging.info(f'started converting {csv_path} to {feather_path}')
+    reader = pa_csv.open_csv(
+        csv_path,
+        read_options=pa_csv.ReadOptions(column_names=column_names, block_size=block_size, use_threads=True),
+        convert_options=pa_csv.ConvertOptions(column_types=column_types, strings_can_be_null=True))
+    # The types are inferred from the first block and fixed for the rest of the file
+    empty_batch = pa.RecordBatch.from_arrays(
+        [pa.array([], type=field.type) for field in reader.schema], schema=reader.schema)
+    schema = convert_batch(empty_batch).schema
+
+    row_count = 0
+    with pa.ipc.new_file(feather_path, schema,
+                         options=pa.ipc.IpcWriteOptions(compression=FEATHER_COMPRESSION)) as writer:
+        for batch in reader:
+            writer.write_batch(convert_batch(batch))
+            row_count += batch.num_rows
+    logging.info(f'finished converting {row_count} rows of {csv_path}')
+
+
+def convert_logistics_csv_to_feather(csv_path: str, feather_path: str, block_size: int = CSV_BLOCK_SIZE):
+    """
+    Convert a logistics detail csv file to a feather file in the typed schema
+    :param csv_path: path to the csv file
+    :param feather_path: path to the feather file to write
+    :param block_size: bytes of csv read at a time
+    """
+    convert_csv_to_feather(csv_path, feather_path, LOGISTICS_COLUMN_NAMES, LOGISTICS_COLUMN_TYPES,
+                           convert_logistics_batch, block_size)
+
+
+def convert_order_csv_to_feather(csv_path: str, feather_path: str, block_size: int = CSV_BLOCK_SIZE):
+    """
+    Convert an order data csv file to a feather file in the typed schema
+    :param csv_path: path to the csv file
+    :param feather_path: path to the feather file to write
+    :param block_size: bytes of csv read at a time
+    """
+    convert_csv_to_feather(csv_path, feather_path, ORDER_COLUMN_NAMES, ORDER_COLUMN_TYPES, convert_order_batch,
+                           block_size)
+
+
+def convert_item_csv_to_feather(csv_path: str, feather_path: str, block_size: int = CSV_BLOCK_SIZE):
+    """
+    Convert an item data csv file to a feather file, see apply_item_schema
+    :param csv_path: path to the csv file
+    :param feather_path: path to the feather file to write
+    :param block_size: bytes of csv read at a time
+    """
+    convert_csv_to_feather(csv_path, feather_path, ITEM_COLUMN_NAMES, ITEM_COLUMN_TYPES, keep_batch, block_size)
+
+
+def convert_seller_csv_to_feather(csv_path: str, feather_path: str, block_size: int = CSV_BLOCK_SIZE):
+    """
+    Convert a seller data csv file to a feather file, see apply_seller_schema
+    :param csv_path: path to the csv file
+    :param feather_path: path to the feather file to write
+    :param block_size: bytes of csv read at a time
+    """
+    convert_csv_to_feather(csv_path, feather_path, SELLER_COLUMN_NAMES, SELLER_COLUMN_TYPES, keep_batch, block_size)
+
+
+def convert_inventory_csv_to_feather(csv_path: str, feather_path: str, block_size: int = CSV_BLOCK_SIZE):
+    """
+    Convert an inventory data csv file to a feather file, see apply_inventory_schema
+    :param csv_path: path to the csv file
+    :param feather_path: path to the feather file to write
+    :param block_size: bytes of csv read at a time
+    """
+    convert_csv_to_feather(csv_path, feather_path, INVENTORY_COLUMN_NAMES, INVENTORY_COLUMN_TYPES, keep_batch,
+                           block_size)
@@ -0,0 +1,236 @@
+import json
+import logging
+import os.path
+import sys
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # resource is only available on unix, peak memory is not audited elsewhere
+    resource = None
+
+AUDIT_SUMMARY_FILE_NAME = 'cleaning_audit_summary.json'
+# Fields of an audit entry that add up when audits of buckets or shards are merged
+AUDIT_COUNTERS = ['wall_seconds', 'cpu_seconds', 'orders_removed', 'order_rows_removed', 'events_removed']
+# Fields of an audit entry that are the maximum of the merged audits
+AUDIT_MAXIMA = ['peak_memory_delta']
+# Fields of an audit entry holding the rows left after the rule, they add up across buckets and shards
+AUDIT_ROW_COUNTS = ['order_rows', 'events']
+
+
+def get_peak_memory() -> int:
+    """
+    Get the peak resident set size of the process, a single system call
+    :return: peak resident set size in bytes, 0 if it is not available on this platform
+    """
+    if resource is None:
+        return 0
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak_memory if sys.platform == 'darwin' else peak_memory * 1024
+
+
+def _create_entry() -> dict:
+    entry = {field: 0 for field in AUDIT_COUNTERS + AUDIT_MAXIMA + AUDIT_ROW_COUNTS}
+    entry['wall_seconds'] = entry['cpu_seconds'] = 0.0
+    return entry
+
+
+class CleaningAudit:
+    """
+    Audit of the cleaning rules applied to a dataset. For every rule the wall time, CPU time, increase of the peak
+    resident set size, the orders, order rows and events (logistics rows) removed and the rows left afterwards are
+    recorded. Measuring a rule only reads clocks and row counts, the distinct orders removed are counted by
+    DataCleaner.remove_orders on the removed rows only
+    """
+
+    def __init__(self):
+        # Audit entry of every rule, in the order the rules were first measured
+        self.rules = {}
+        # Rules being measured, innermost last, each with the snapshot its measurement continues from
+        self._active = []
+
+    @staticmethod
+    def _snapshot(row_counts) -> dict:
+        order_rows, events = row_counts()
+        return {'wall': time.perf_counter(), 'cpu': time.process_time(), 'peak_memory': get_peak_memory(),
+                'order_rows': order_rows, 'events': events}
+
+    def _get_entry(self, rule_name: str) -> dict:
+        if rule_name not in self.rules:
+            self.rules[rule_name] = _create_entry()
+        return self.rules[rule_name]
+
+    def _accumulate(self, frame: dict, end: dict):
+        start = frame['start']
+        frame['wall_seconds'] += end['wall'] - start['wall']
+        frame['cpu_seconds'] += end['cpu'] - start['cpu']
+        frame['peak_memory_delta'] += end['peak_memory'] - start['peak_memory']
+        frame['order_rows_removed'] += start['order_rows'] - end['order_rows']
+        frame['events_removed'] += start['events'] - end['events']
+
+    @property
+    def current_rule(self) -> str:
+        """
+        :return: name of the innermost rule being measured, None if no rule is being measured
+        """
+        return self._active[-1]['rule_name'] if self._active else None
+
+    @contextmanager
+    def measure(self, rule_name: str, row_counts):
+        """
+        Measure a cleaning rule. Rules measured while another rule is measured, e.g. the timestamp validation run by
+        several rules, are recorded on their own and excluded from the enclosing rule
+        :param rule_name: name of the rule
+        :param row_counts: function returning the current number of order rows and events, only called when the
+            measurement starts and stops
+        """
+        if self._active:
+            self._accumulate(self._active[-1], self._snapshot(row_counts))
+        frame = {'rule_name': rule_name, 'start': self._snapshot(row_counts),
+                 **{field: 0 for field in AUDIT_COUNTERS + AUDIT_MAXIMA}}
+        self._active.append(frame)
+        try:
+            yield
+        finally:
+            self._active.pop()
+            end = self._snapshot(row_counts)
+            self._accumulate(frame, end)
+            self._add(rule_name, frame, end['order_rows'], end['events'], frame['start'])
+            if self._active:
+                self._active[-1]['start'] = self._snapshot(row_counts)
+
+    def count_removed_orders(self, order_count: int):
+        """
+        Count distinct orders removed by the rule being measured
+        :param order_count: number of distinct orders removed
+        """
+        if self._active:
+            self._active[-1]['orders_removed'] += order_count
+
+    def record(self, rule_name: str, orders_removed: int, order_rows_removed: int, events_removed: int,
+               order_rows: int, events: int):
+        """
+        Record the rows removed by a rule that is not measured on its own, e.g. the rules evaluated together by
+        DataCleaner.fused_clean_up. The rows are excluded from the rule being measured
+        :param rule_name: name of the rule
+        :param orders_removed: number of distinct orders removed
+        :param order_rows_removed: number of order rows removed
+        :param events_removed: number of events removed
+        :param order_rows: number of order rows left
+        :param events: number of events left
+        """
+        removed = {'orders_removed': int(orders_removed), 'order_rows_removed': int(order_rows_removed),
+                   'events_removed': int(events_removed)}
+        if self._active:
+            self._active[-1]['order_rows_removed'] -= removed['order_rows_removed']
+            self._active[-1]['events_removed'] -= removed['events_removed']
+        start = {'order_rows': order_rows + removed['order_rows_removed'], 'events': events + removed['events_removed']}
+        self._add(rule_name, removed, int(order_rows), int(events), start)
+
+    def _add(self, rule_name: str, measured: dict, order_rows: int, events: int, start: dict):
+        entry = self._get_entry(rule_name)
+        for field in AUDIT_COUNTERS + AUDIT_MAXIMA:
+            entry[field] += measured.get(field, 0)
+        entry['order_rows'] = order_rows
+        entry['events'] = events
+        logging.info(
+            f'finished {rule_name}: removed {measured["orders_removed"]} orders, '
+            f'{measured["order_rows_removed"]} order rows '
+            f'({measured["order_rows_removed"] / max(start["order_rows"], 1) * 100:.2f}%) and '
+            f'{measured["events_removed"]} events ({measured["events_removed"] / max(start["events"], 1) * 100:.2f}%)'
+            + (f' in {measured["wall_seconds"]:.2f}s' if 'wall_seconds' in measured else ''))
+
+    def merge(self, other: 'CleaningAudit'):
+        """
+        Add the audit of another part of the same dataset, e.g. another bucket of a shard
+        :param other: audit to add
+        """
+        merge_audit_entries(self.rules, other.rules)
+
+    def to_dict(self) -> dict:
+        """
+        :return: audit entry of every rule in the order the rules were first measured
+        """
+        return {rule_name: dict(entry) for rule_name, entry in self.rules.items()}
+
+    def save(self, file_path: str):
+        """
+        Save the audit as json
+        :param file_path: path to the json file
+        """
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'w') as file:
+            json.dump({'rules': self.to_dict()}, file, indent=2)
+
+
+def merge_audit_entries(entries: dict, other_entries: dict):
+    """
+    Add the audit entries of every rule of other_entries to entries in place
+    :param entries: audit entries by rule name to add to
+    :param other_entries: audit entries by rule name to add
+    """
+    for rule_name, other_entry in other_entries.items():
+        entry = entries.setdefault(rule_name, _create_entry())
+        for field in AUDIT_COUNTERS + AUDIT_ROW_COUNTS:
+            entry[field] += other_entry[field]
+        for field in AUDIT_MAXIMA:
+            entry[field] = max(entry[field], other_entry[field])
+
+
+def get_audit_path(cleaned_dir: str, index: int) -> str:
+    """
+    Get the path of the cleaning audit of a shard
+    :param cleaned_dir: directory containing the cleaned data
+    :param index: index of the shard
+    :return: path to the audit
+    """
+    return os.path.join(cleaned_dir, f'data_{index}', f'cleaning_audit_{index}.json')
+
+
+def load_audit(file_path: str) -> dict:
+    """
+    Load the audit entries of a shard
+    :param file_path: path to the json file written by CleaningAudit.save
+    :return: audit entries by rule name
+    """
+    with open(file_path) as file:
+        return json.load(file)['rules']
+
+
+def summarize_audits(shard_audits: dict) -> dict:
+    """
+    Summarize the audits of several shards. The counters of every rule are added up, the peak memory delta is the
+    largest of any shard, and the share of the total time and of the removed orders and events is added per rule
+    :param shard_audits: audit entries by rule name of every shard by shard index
+    :return: summary with the audited shards and the summed entry of every rule, slowest rule first
+    """
+    entries = {}
+    for audit in shard_audits.values():
+        merge_audit_entries(entries, audit)
+    totals = {field: sum(entry[field] for entry in entries.values())
+              for field in ['wall_seconds', 'orders_removed', 'events_removed']}
+    for entry in entries.values():
+        for field, total in totals.items():
+            entry[f'{field}_share'] = entry[field] / total if total else 0.0
+    return {
+        'shards': sorted(shard_audits),
+        'rules': dict(sorted(entries.items(), key=lambda item: item[1]['wall_seconds'], reverse=True)),
+    }
+
+
+def save_audit_summary(cleaned_dir: str, indices: list) -> dict:
+    """
+    Summarize the audits of the given shards that have been cleaned and save the summary next to the cleaned data
+    :param cleaned_dir: directory containing the cleaned data
+    :param indices: indices of the shards to summarize
+    :return: summary, see summarize_audits
+    """
+    shard_audits = {index: load_audit(get_audit_path(cleaned_dir, index)) for index in indices
+                    if os.path.exists(get_audit_path(cleaned_dir, index))}
+    summary = summarize_audits(shard_audits)
+    with open(os.path.join(cleaned_dir, AUDIT_SUMMARY_FILE_NAME), 'w') as file:
+        json.dump(summary, file, indent=2)
+    return summary
@@ -1,10 +1,23 @@
+import hashlib
+import importlib
 import inspect
 import logging
 import os.path
 
+import numpy as np
 import pandas as pd
 
 from constants import *
+from .cleaning_audit import CleaningAudit, get_audit_path
+from .event_store import OrderEventStore
+from .order_keys import *
+from .order_summary import *
+from .parquet_export import *
+from .schema import apply_logistics_schema, apply_order_schema
+
+# Modules the cleaned data depends on besides the rules, e.g. the order summary, the event store kernels, the schema
+# and the export. Their source is fingerprinted with the rules together with this module
+CLEANING_CODE_MODULES = ['cleaning_audit', 'event_store', 'order_keys', 'order_summary', 'parquet_export', 'schema']
 
 
 class DataCleaner:
@@ -12,80 +25,181 @@ class DataCleaner:
     Class to clean data and remove erroneous or unwanted entries.
     Data cleaning is performed according to "Operational Transparency: Showing When Work Gets Done"
     """
+    # Cleaning rules in the order they are applied by clean_up
+    RULES = [
+        'remove_not_cainiao',
+        'remove_without_shipment_score',
+        'remove_trade_success_actions',
+        'drop_duplicates',
+        'remove_failed_delivery',
+        'remove_without_shipment_times',
+        'remove_with_action_before_order',
+        'remove_without_exactly_one_sign_action',
+        'remove_without_exactly_one_consign_action',
+        'remove_with_action_after_sign',
+        'remove_without_slowest_shipping_speed',
+        'remove_with_multiple_shippers',
+        'remove_with_multiple_product_types',
+        'remove_shipment_time_more_than_eight_days',
+        'remove_more_than_ten_actions',
+        'remove_less_than_four_actions',
+    ]
+    # Rules that only look at the order data, see get_leading_order_rules
+    ORDER_RULES = [
+        'remove_not_cainiao',
+        'remove_without_shipment_score',
+        'remove_without_slowest_shipping_speed',
+        'remove_with_multiple_product_types',
+    ]
+    RULE_PARAMETERS = {
+        'day_one': str(DAY_ONE),
+        'timestamp_format': TIMESTAMP_FORMAT,
+        'max_shipment_days': MAX_SHIPMENT_DAYS,
+        'max_shipment_actions': MAX_SHIPMENT_ACTIONS,
+        'min_shipment_actions': MIN_SHIPMENT_ACTIONS,
+    }
 
     def __init__(self, order_data_df: pd.DataFrame, logistics_detail_data_df: pd.DataFrame):
         """
-        Initialize the cleaner
+        Initialize the cleaner, the dataframes are converted to the typed schema in place and every order is given a
+        dense int32 ORDER_KEY, so that the rules test and join orders by indexing arrays with the keys
         :param order_data_df: Dataframe representing order data
         :param logistics_detail_data_df: Data frame representing logistics detail data
         """
-        self.order_data_df = order_data_df
-        self.logistics_data_df = logistics_detail_data_df
+        self.order_data_df = apply_order_schema(order_data_df)
+        self.logistics_data_df = apply_logistics_schema(logistics_detail_data_df)
+        self.order_key_dictionary = build_order_key_dictionary(
+            [self.order_data_df[ORDER_ID], self.logistics_data_df[ORDER_ID]])
+        self.order_data_df[ORDER_KEY] = get_order_keys(self.order_key_dictionary, self.order_data_df[ORDER_ID])
+        self.logistics_data_df[ORDER_KEY] = get_order_keys(self.order_key_dictionary, self.logistics_data_df[ORDER_ID])
+        self.order_summary_df = None
+        self.timestamps_validated = False
+        self.audit = CleaningAudit()
 
-    def convert_timestamp_to_datetime(self):
+    def _get_row_counts(self) -> (int, int):
         """
-        Convert the timestamps in dataframes into datetime format
+        :return: number of order rows and number of events (logistics rows) left
+        """
+        return self.order_data_df.shape[0], self.logistics_data_df.shape[0]
+
+    def convert_timestamp_to_datetime(self):
         """
-        logging.info("started converting timestamp to datetime")
-        if TIMESTAMP_DATE_TIME not in self.logistics_data_df.columns:
-            logging.info("started converting logistics data timestamp to datetime")
-            self.logistics_data_df[TIMESTAMP_DATE_TIME] = pd.to_datetime(
-                self.logistics_data_df[TIMESTAMP], errors='coerce')
+        Remove orders with timestamps that could not be converted into datetime format or are before day one.
+        Timestamps are converted once when the data is converted to the typed schema, so this only validates them
+        """
+        if self.timestamps_validated:
+            return
+        with self.audit.measure('convert_timestamp_to_datetime', self._get_row_counts):
+            logging.info("started converting timestamp to datetime")
+            if TIMESTAMP_INVALID in self.logistics_data_df.columns:
+                logging.info(
+                    f'found {self.logistics_data_df[TIMESTAMP_INVALID].sum()} unparseable logistics timestamps')
+            if PAY_TIMESTAMP_INVALID in self.order_data_df.columns:
+                logging.info(f'found {self.order_data_df[PAY_TIMESTAMP_INVALID].sum()} unparseable payment timestamps')
             invalid_timestamps = self.logistics_data_df[
-                self.logistics_data_df[TIMESTAMP_DATE_TIME].isnull() | self.logistics_data_df[
-                    TIMESTAMP_DATE_TIME] < DAY_ONE]
-            self.remove_order_ids(invalid_timestamps[ORDER_ID])
-        if PAY_TIMESTAMP_DATETIME not in self.order_data_df.columns:
-            logging.info("started converting order data payment timestamp to datetime")
-            self.order_data_df[PAY_TIMESTAMP_DATETIME] = pd.to_datetime(
-                self.order_data_df[PAY_TIMESTAMP], errors='coerce')
+                self.logistics_data_df[TIMESTAMP_DATE_TIME].isnull() | (self.logistics_data_df[
+                    TIMESTAMP_DATE_TIME] < DAY_ONE)]
+            self.remove_order_keys(invalid_timestamps[ORDER_KEY])
             invalid_pay_timestamps = self.order_data_df[
-                self.order_data_df[PAY_TIMESTAMP_DATETIME].isnull() | self.order_data_df[
-                    PAY_TIMESTAMP_DATETIME] < DAY_ONE]
-            self.remove_order_ids(invalid_pay_timestamps[ORDER_ID])
-        logging.info("finished converting timestamp to datetime")
+                self.order_data_df[PAY_TIMESTAMP_DATETIME].isnull() | (self.order_data_df[
+                    PAY_TIMESTAMP_DATETIME] < DAY_ONE)]
+            self.remove_order_keys(invalid_pay_timestamps[ORDER_KEY])
+            self.timestamps_validated = True
+            logging.info("finished converting timestamp to datetime")
+
+    def get_order_summary(self) -> pd.DataFrame:
+        """
+        Get the per-order event summary of the logistics data. The summary is built on first use and kept in sync with
+        the removed orders afterwards
+        :return: dataframe with one row per order, see compute_order_summary
+        """
+        if self.order_summary_df is None:
+            self.convert_timestamp_to_datetime()
+            logging.info("started computing order summary")
+            self.order_summary_df = compute_order_summary(self.logistics_data_df)
+            self.order_summary_df[ORDER_KEY] = get_order_keys(self.order_key_dictionary,
+                                                              self.order_summary_df[ORDER_ID])
+            logging.info("finished computing order summary")
+        return self.order_summary_df
+
+    def get_event_store(self) -> OrderEventStore:
+        """
+        Get the logistics data grouped by order key, see OrderEventStore. The grouped events replace the logistics
+        data, and removing orders keeps the events of every order together, so data that isn't grouped to begin with
+        is sorted once by the first rule using the store. The events of an order keep their order and the exported
+        tables are sorted by order id, so the cleaned data is the same
+        :return: store of the logistics data
+        """
+        event_store = OrderEventStore(self.logistics_data_df, ORDER_KEY)
+        self.logistics_data_df = event_store.events
+        return event_store
 
     def remove_order_ids(self, order_ids: pd.Series):
         """
-        Convert the timestamps in dataframes into datetime format
+        Remove all rows belonging to the given order ids from both the order data and the logistics data. The removed
+        orders are counted towards the audit of the rule being measured
+        :param order_ids: order ids to remove, a missing order id removes the rows without an order id
+        """
+        order_keys = get_order_keys(self.order_key_dictionary, order_ids)
+        self.remove_order_keys(order_keys[(order_keys != MISSING_ORDER_KEY) | pd.isna(np.asarray(order_ids))])
+
+    def remove_order_keys(self, order_keys):
+        """
+        Remove all rows belonging to the given order keys, see remove_orders
+        :param order_keys: keys of the orders to remove, MISSING_ORDER_KEY removes the rows without an order id
+        """
+        is_removed_key = create_key_bitmap(self.order_key_dictionary)
+        is_removed_key[np.asarray(order_keys)] = True
+        self.remove_orders(is_removed_key)
+
+    def remove_orders(self, is_removed_key: np.ndarray):
+        """
+        Remove all rows of the flagged orders from the order data, the logistics data and the order summary. A row is
+        tested by indexing the bitmap with its order key. The removed orders are counted towards the audit of the rule
+        being measured
+        :param is_removed_key: bitmap flagging the orders to remove, see create_key_bitmap
         """
         logging.info("started removing order ids")
-        original_order_count = self.order_data_df.shape[0]
-        self.order_data_df = self.order_data_df[~self.order_data_df[ORDER_ID].isin(order_ids)]
-        self.logistics_data_df = self.logistics_data_df[~self.logistics_data_df[ORDER_ID].isin(order_ids)]
-        cleaned_order_count = self.order_data_df.shape[0]
-        logging.info(
-            f'finished removing order ids, removed {(1 - cleaned_order_count / original_order_count) * 100}% of '
-            f'order for {inspect.stack()[1].function}')
+        is_removed_order = is_removed_key[self.order_data_df[ORDER_KEY].to_numpy()]
+        self.audit.count_removed_orders(self.order_data_df.loc[is_removed_order, ORDER_ID].nunique())
+        self.order_data_df = self.order_data_df[~is_removed_order]
+        self.logistics_data_df = self.logistics_data_df[~is_removed_key[self.logistics_data_df[ORDER_KEY].to_numpy()]]
+        if self.order_summary_df is not None:
+            self.order_summary_df = self.order_summary_df[
+                ~is_removed_key[self.order_summary_df[ORDER_KEY].to_numpy()]]
+        logging.info("finished removing order ids")
+
+    @staticmethod
+    def _is_without_timestamp(logistics_data_df: pd.DataFrame) -> pd.Series:
+        """
+        Flag the logistics rows without a timestamp. Timestamps that were present but could not be parsed are flagged
+        at conversion, those rows are left to convert_timestamp_to_datetime
+        :param logistics_data_df: dataframe containing logistics data
+        :return: series flagging the rows without a timestamp
+        """
+        without_timestamp = logistics_data_df[TIMESTAMP_DATE_TIME].isnull()
+        if TIMESTAMP_INVALID in logistics_data_df.columns:
+            without_timestamp &= ~logistics_data_df[TIMESTAMP_INVALID]
+        return without_timestamp
 
     def drop_duplicates(self):
         """
         Drop duplicate rows from logistics data and order data
         """
-        logging.info("started removing order ids")
-        original_order_count = self.order_data_df.shape[0]
-        original_logistics_count = self.logistics_data_df.shape[0]
+        logging.info("started dropping duplicates")
         self.order_data_df = self.order_data_df.drop_duplicates()
         self.logistics_data_df = self.logistics_data_df.drop_duplicates()
-        cleaned_order_count = self.order_data_df.shape[0]
-        cleaned_logistics_count = self.logistics_data_df.shape[0]
-        logging.info(
-            f'finished dropping duplicates, removed {(1 - cleaned_order_count / original_order_count) * 100}% of orders')
-        logging.info(
-            f'finished dropping duplicates, removed {(1 - cleaned_logistics_count / original_logistics_count) * 100}% of '
-            f'logistics data')
+        self.order_summary_df = None
+        logging.info("finished dropping duplicates")
 
     def remove_trade_success_actions(self):
         """
         Removes all trade success actions from logistics detail.
         """
         logging.info("started removing trade success actions")
-        original_logistics_count = self.logistics_data_df.shape[0]
         self.logistics_data_df = self.logistics_data_df[self.logistics_data_df[ACTION] != TRADE_SUCCESS]
-        cleaned_logistics_count = self.logistics_data_df.shape[0]
-        logging.info(
-            f'finished dropping trade success actions, removed '
-            f'{(1 - cleaned_logistics_count / original_logistics_count) * 100}% of logistics data')
+        self.order_summary_df = None
+        logging.info("finished removing trade success actions")
 
     def remove_failed_delivery(self):
         """
@@ -93,7 +207,7 @@ class DataCleaner:
         """
         logging.info("started removing failed delivery")
         failure_actions = self.logistics_data_df[self.logistics_data_df[ACTION] == FAILURE]
-        self.remove_order_ids(failure_actions[ORDER_ID])
+        self.remove_order_keys(failure_actions[ORDER_KEY])
         logging.info("finished removing failed delivery")
 
     def remove_not_cainiao(self):
@@ -102,7 +216,7 @@ class DataCleaner:
         """
         logging.info("started removing shipments with an original warehouse not managed by Cainiao")
         not_cainiao_orders = self.order_data_df[self.order_data_df[IF_CAINIAO] != 1]
-        self.remove_order_ids(not_cainiao_orders[ORDER_ID])
+        self.remove_order_keys(not_cainiao_orders[ORDER_KEY])
         logging.info("finished removing shipments with an original warehouse not managed by Cainiao")
 
     def remove_without_shipment_score(self):
@@ -111,7 +225,7 @@ class DataCleaner:
         """
         logging.info("started removing shipments without a shipment score")
         without_shipment_score_orders = self.order_data_df[self.order_data_df[LOGISTICS_REVIEW_SCORE].isna()]
-        self.remove_order_ids(without_shipment_score_orders[ORDER_ID])
+        self.remove_order_keys(without_shipment_score_orders[ORDER_KEY])
         logging.info("finished removing shipments without a shipment score")
 
     def remove_without_shipment_times(self):
@@ -120,8 +234,8 @@ class DataCleaner:
         """
         logging.info("started removing shipments without shipment times")
         without_shipment_times_orders = self.logistics_data_df[
-            self.logistics_data_df[TIMESTAMP].isnull() | self.logistics_data_df[ORDER_DATE].isnull()]
-        self.remove_order_ids(without_shipment_times_orders[ORDER_ID])
+            self._is_without_timestamp(self.logistics_data_df) | self.logistics_data_df[ORDER_DATE].isnull()]
+        self.remove_order_keys(without_shipment_times_orders[ORDER_KEY])
         logging.info("finished removing shipments without shipment times")
 
     def remove_with_action_before_order(self):
@@ -130,9 +244,13 @@ class DataCleaner:
         """
         logging.info("started removing shipments with actions reported before the order action")
         self.convert_timestamp_to_datetime()
-        joined_df = self.logistics_data_df.join(self.order_data_df, on=ORDER_ID, lsuffix='logistics_', rsuffix='order_')
-        with_action_before_order = joined_df[joined_df[TIMESTAMP_DATE_TIME] < joined_df[PAY_TIMESTAMP_DATETIME]]
-        self.remove_order_ids(with_action_before_order[f'logistics_{ORDER_ID}'])
+        # An action is before one of the payments of its order if it is before the latest payment
+        latest_pay = reduce_by_order_key(
+            self.order_data_df[ORDER_KEY].to_numpy(), to_nanoseconds(self.order_data_df[PAY_TIMESTAMP_DATETIME]),
+            len(self.order_key_dictionary), np.maximum, NAT_NANOSECONDS)
+        event_store = self.get_event_store()
+        with_action_before_order = event_store.any_earlier(latest_pay[event_store.segment_keys])
+        self.remove_order_keys(event_store.segment_keys[with_action_before_order])
         logging.info("finished removing shipments with actions reported before the order action")
 
     def remove_with_action_after_sign(self):
@@ -141,12 +259,10 @@ class DataCleaner:
         """
         logging.info("started removing shipments with actions reported after the sign action")
         self.convert_timestamp_to_datetime()
-        signed_actions = self.logistics_data_df[self.logistics_data_df[ACTION] == SIGNED]
-        joined_df = self.logistics_data_df.join(signed_actions, on=ORDER_ID, lsuffix='_actions', rsuffix='_signed',
-                                                how='left')
-        with_action_after_sign_order = joined_df[
-            joined_df[f'{TIMESTAMP_DATE_TIME}_actions'] > joined_df[f'{TIMESTAMP_DATE_TIME}_signed']]
-        self.remove_order_ids(with_action_after_sign_order[f'{ORDER_ID}_actions'])
+        # An action is after one of the sign actions of its order if it is after the earliest sign action
+        event_store = self.get_event_store()
+        with_action_after_sign = event_store.any_later(event_store.first_action_times(SIGNED))
+        self.remove_order_keys(event_store.segment_keys[with_action_after_sign])
         logging.info("finished removing shipments with actions reported after the sign action")
 
     def remove_without_exactly_one_sign_action(self):
@@ -154,10 +270,9 @@ class DataCleaner:
         Remove all shipments without exactly one sign action
         """
         logging.info("started removing shipments without exactly one sign action")
-        self.convert_timestamp_to_datetime()
-        action_counts = self.logistics_data_df.groupby([ORDER_ID, ACTION]).size().unstack(fill_value=0)
-        without_exactly_one_sign_action_order = action_counts[action_counts[SIGNED] != 1].index
-        self.remove_order_ids(without_exactly_one_sign_action_order)
+        order_summary = self.get_order_summary()
+        without_exactly_one_sign_action_order = order_summary[order_summary[SIGN_COUNT] != 1]
+        self.remove_order_keys(without_exactly_one_sign_action_order[ORDER_KEY])
         logging.info("finished removing shipments without exactly one sign action")
 
     def remove_without_exactly_one_consign_action(self):
@@ -165,10 +280,9 @@ class DataCleaner:
         Remove all shipments without exactly one consign action
         """
         logging.info("started removing shipments without exactly one consign action")
-        self.convert_timestamp_to_datetime()
-        action_counts = self.logistics_data_df.groupby([ORDER_ID, ACTION]).size().unstack(fill_value=0)
-        without_exactly_one_consign_action_order = action_counts[action_counts[CONSIGN] != 1].index
-        self.remove_order_ids(without_exactly_one_consign_action_order)
+        order_summary = self.get_order_summary()
+        without_exactly_one_consign_action_order = order_summary[order_summary[CONSIGN_COUNT] != 1]
+        self.remove_order_keys(without_exactly_one_consign_action_order[ORDER_KEY])
         logging.info("finished removing shipments without exactly one consign action")
 
     def remove_without_slowest_shipping_speed(self):
@@ -177,8 +291,8 @@ class DataCleaner:
         """
         logging.info("started removing shipments without slowest shipping speed")
         without_slowest_shipping_speed = self.order_data_df[
-            self.order_data_df[PROMISE_SPEED].isnull() | self.order_data_df[PROMISE_SPEED] == 0]
-        self.remove_order_ids(without_slowest_shipping_speed[ORDER_ID])
+            self.order_data_df[PROMISE_SPEED].isnull() | (self.order_data_df[PROMISE_SPEED] == 0)]
+        self.remove_order_keys(without_slowest_shipping_speed[ORDER_KEY])
         logging.info("finished removing shipments without slowest shipping speed")
 
     def remove_with_multiple_shippers(self):
@@ -186,12 +300,11 @@ class DataCleaner:
         Remove all shipments with multiple shippers
         """
         logging.info("started removing shipments with multiple shippers")
-        self.convert_timestamp_to_datetime()
-
-        joined_df = self.logistics_data_df.join(self.order_data_df, on=ORDER_ID, lsuffix='_l', rsuffix='_r')
-        with_multiple_shippers = joined_df[
-            joined_df[LOGISTIC_COMPANY_ID] != joined_df[LOGISTIC_COMPANY_ID]]
-        self.remove_order_ids(with_multiple_shippers[f'{ORDER_ID}_l'])
+        event_store = self.get_event_store()
+        # Like groupby, rows without an order id are not an order
+        with_multiple_shippers = (event_store.count_unique(LOGISTIC_COMPANY_ID) > 1) & (
+                event_store.segment_keys != MISSING_ORDER_KEY)
+        self.remove_order_keys(event_store.segment_keys[with_multiple_shippers])
         logging.info("finished removing shipments with multiple shippers")
 
     def remove_with_multiple_product_types(self):
@@ -199,9 +312,8 @@ class DataCleaner:
         Remove all shipments with multiple product types
         """
         logging.info("started removing shipments with multiple product types")
-        with_multiple_product_types = self.order_data_df[
-            self.order_data_df[ITEM_DETAIL_INFO].str.split(",").apply(lambda x: len(x) > 1)]
-        self.remove_order_ids(with_multiple_product_types[ORDER_ID])
+        with_multiple_product_types = self.order_data_df[self.order_data_df[ITEM_COUNT] > 1]
+        self.remove_order_keys(with_multiple_product_types[ORDER_KEY])
         logging.info("finished removing shipments with multiple product types")
 
     def remove_shipment_time_more_than_eight_days(self):
@@ -210,12 +322,18 @@ class DataCleaner:
         """
         logging.info("started removing shipments with shipment times in excess of eight days")
         self.convert_timestamp_to_datetime()
-        consign_actions = self.logistics_data_df[self.logistics_data_df[ACTION] == CONSIGN]
-        joined_df = self.logistics_data_df.merge(consign_actions, on=ORDER_ID)
-        joined_df["shipment_time"] = joined_df[TIMESTAMP_DATE_TIME] - joined_df[PAY_TIMESTAMP_DATETIME]
-
-        shipment_more_than_eight_days = joined_df[joined_df["shipment_time"].dt.days > 8]
-        self.remove_order_ids(shipment_more_than_eight_days[f'{ORDER_ID}_consign'])
+        # The longest shipment time of an order is from its earliest payment to its latest consign action
+        pay_times = to_nanoseconds(self.order_data_df[PAY_TIMESTAMP_DATETIME])
+        is_paid = pay_times != NAT_NANOSECONDS
+        earliest_pay = reduce_by_order_key(self.order_data_df[ORDER_KEY].to_numpy()[is_paid], pay_times[is_paid],
+                                           len(self.order_key_dictionary), np.minimum, np.iinfo(np.int64).max)
+        event_store = self.get_event_store()
+        earliest_pay = earliest_pay[event_store.segment_keys]
+        latest_consign = event_store.last_action_times(CONSIGN)
+        is_shipped = (earliest_pay != np.iinfo(np.int64).max) & (latest_consign != NAT_NANOSECONDS)
+        shipment_days = np.floor_divide(latest_consign - earliest_pay, pd.Timedelta(days=1).value, where=is_shipped,
+                                        out=np.zeros_like(latest_consign))
+        self.remove_order_keys(event_store.segment_keys[is_shipped & (shipment_days > MAX_SHIPMENT_DAYS)])
         logging.info("finished removing shipments with shipment times in excess of eight days")
 
     def remove_more_than_ten_actions(self):
@@ -223,9 +341,9 @@ class DataCleaner:
         Remove all shipments with more than ten posted actions
         """
         logging.info("started removing shipments with more than ten posted actions")
-        order_counts = self.logistics_data_df.groupby(ORDER_ID).size().reset_index(name='count')
-        with_more_than_ten_actions = order_counts[order_counts['count'] > 10]
-        self.remove_order_ids(with_more_than_ten_actions[ORDER_ID])
+        order_summary = self.get_order_summary()
+        with_more_than_ten_actions = order_summary[order_summary[SHIPMENT_ACTION_COUNT] > MAX_SHIPMENT_ACTIONS]
+        self.remove_order_keys(with_more_than_ten_actions[ORDER_KEY])
         logging.info("finished removing shipments with more than ten posted actions")
 
     def remove_less_than_four_actions(self):
@@ -233,57 +351,302 @@ class DataCleaner:
         Remove all shipments with fewer than four posted actions
         """
         logging.info("started removing shipments with less than four posted actions")
-        order_counts = self.logistics_data_df.groupby(ORDER_ID).size().reset_index(name='count')
-        with_less_than_four_actions = order_counts[order_counts['count'] < 4]
-        self.remove_order_ids(with_less_than_four_actions[ORDER_ID])
+        order_summary = self.get_order_summary()
+        with_less_than_four_actions = order_summary[order_summary[SHIPMENT_ACTION_COUNT] < MIN_SHIPMENT_ACTIONS]
+        self.remove_order_keys(with_less_than_four_actions[ORDER_KEY])
         logging.info("finished removing shipments with less than four posted actions")
 
+    @classmethod
+    def get_rule_fingerprints(cls) -> dict:
+        """
+        Fingerprint every cleaning rule with a hash of its source code, and the rule parameters with their values.
+        Timestamp validation runs inside the rules, so it is fingerprinted as a rule as well. The helpers the rules
+        call, the fused rules and the export are covered by a hash of the source of this module and of
+        CLEANING_CODE_MODULES
+        :return: dict mapping each rule to its hash, each module to its hash, and the parameters to their values
+        """
+        fingerprints = {}
+        for rule in cls.RULES + ['convert_timestamp_to_datetime']:
+            fingerprints[rule] = hashlib.blake2b(
+                inspect.getsource(getattr(cls, rule)).encode(), digest_size=8).hexdigest()
+        code_fingerprints = {}
+        for module in [inspect.getmodule(cls)] + [importlib.import_module(f'.{name}', __package__)
+                                                  for name in CLEANING_CODE_MODULES]:
+            code_fingerprints[module.__name__] = hashlib.blake2b(
+                inspect.getsource(module).encode(), digest_size=8).hexdigest()
+        return {'rules': fingerprints, 'code': code_fingerprints, 'parameters': dict(cls.RULE_PARAMETERS)}
+
+    @classmethod
+    def get_leading_order_rules(cls) -> list:
+        """
+        Get the ORDER_RULES that clean_up applies before any rule looking at the logistics data. An order removed by
+        one of them is removed by the same rule whether its events are read or not, the other order rules remove some
+        orders only if no earlier rule looking at the events removes them first
+        :return: leading order rules in the order they are applied
+        """
+        leading_order_rules = []
+        for rule in cls.RULES:
+            if rule not in cls.ORDER_RULES:
+                break
+            leading_order_rules.append(rule)
+        return leading_order_rules
+
+    @classmethod
+    def find_orders_removed_by_order_rules(cls, order_data_df: pd.DataFrame) -> pd.Series:
+        """
+        Apply the leading order rules (see get_leading_order_rules) to the order data alone. Every rule removes whole
+        orders, so the events of these orders can be skipped while the logistics data is read without changing the
+        cleaned data or the rule each order is attributed to in the audit
+        :param order_data_df: dataframe containing order data, it is converted to the typed schema in place
+        :return: series mapping every removed order id to the first rule removing it, a NaN order id if the rows
+            without an order id are removed
+        """
+        order_cleaner = cls(order_data_df, pd.DataFrame({ORDER_ID: pd.Series(dtype=np.int64)}))
+        removed_order_rules = []
+        for rule in cls.get_leading_order_rules():
+            order_ids = pd.Index(order_cleaner.order_data_df[ORDER_ID].unique())
+            getattr(order_cleaner, rule)()
+            removed_order_ids = order_ids[~order_ids.isin(order_cleaner.order_data_df[ORDER_ID])]
+            removed_order_rules.append(pd.Series(rule, index=removed_order_ids, dtype=object))
+        return pd.concat(removed_order_rules)
+
+    def record_skipped_events(self, removed_order_rules: pd.Series, skipped_events: pd.Series):
+        """
+        Record the events that were skipped while reading the logistics data in the audit of the rule removing their
+        order, so the audit is the same as if the events had been read and removed by the rules. Call after cleaning
+        :param removed_order_rules: first rule removing every skipped order, see find_orders_removed_by_order_rules
+        :param skipped_events: number of events skipped of every order, by order id
+        """
+        rule_events = skipped_events.groupby(removed_order_rules.reindex(skipped_events.index).to_numpy()).sum()
+        # The events of the orders removed by later rules were still there after each rule
+        later_events = 0
+        for rule in reversed(self.get_leading_order_rules()):
+            entry = self.audit.rules[rule]
+            self.audit.record(rule, 0, 0, rule_events.get(rule, 0), entry['order_rows'], entry['events'] + later_events)
+            later_events += rule_events.get(rule, 0)
+
     def clean_up(self):
         """
-        Run data cleaning according to "Operational Transparency: Showing When Work Gets Done"
+        Run data cleaning according to "Operational Transparency: Showing When Work Gets Done", every rule is
+        measured in the audit
         """
         logging.info('started data cleanup')
         logging.info(f'original logistics detail shape: {self.logistics_data_df.shape}')
         logging.info(f'original order data shape: {self.order_data_df.shape}')
-        self.remove_not_cainiao()
-        self.remove_without_shipment_score()
-        self.remove_trade_success_actions()
-        self.drop_duplicates()
-        self.remove_failed_delivery()
-        self.remove_without_shipment_times()
-        self.remove_with_action_before_order()
-        self.remove_without_exactly_one_sign_action()
-        self.remove_without_exactly_one_consign_action()
-        self.remove_with_action_after_sign()
-        self.remove_without_slowest_shipping_speed()
-        self.remove_with_multiple_shippers()
-        self.remove_with_multiple_product_types()
-        self.remove_shipment_time_more_than_eight_days()
-        self.remove_more_than_ten_actions()
-        self.remove_less_than_four_actions()
+        for rule in self.RULES:
+            with self.audit.measure(rule, self._get_row_counts):
+                getattr(self, rule)()
         logging.info("finished data cleanup")
         logging.info(self.logistics_data_df.head())
         logging.info(self.order_data_df.head())
 
-    def export_data(self, root_dir: str, index: int):
+    def fused_clean_up(self):
         """
-        Export dataframe as feather files
+        Run the same data cleaning as clean_up, but evaluate the pass/fail flags of every order for all rules at once.
+        The flags are computed with one grouped pass over the logistics data and one pass over the order data, and the
+        rejected orders are removed with a single combined mask at the end. The output is identical to clean_up and
+        the same rows removed by each rule are recorded in the audit, the rules can't be timed on their own so the time
+        taken by all of them is recorded as fused_clean_up.
+        """
+        logging.info('started fused data cleanup')
+        logging.info(f'original logistics detail shape: {self.logistics_data_df.shape}')
+        logging.info(f'original order data shape: {self.order_data_df.shape}')
+        with self.audit.measure('fused_clean_up', self._get_row_counts):
+            self._apply_fused_rules()
+        logging.info("finished fused data cleanup")
+        logging.info(self.logistics_data_df.head())
+        logging.info(self.order_data_df.head())
+
+    def _apply_fused_rules(self):
+        """
+        Evaluate and apply every cleaning rule at once, see fused_clean_up
+        """
+        # Row level cleaning, the order level rules are evaluated on deduplicated data without trade success actions
+        is_order_duplicate = self.order_data_df.duplicated().to_numpy()
+        order_data_df = self.order_data_df[~is_order_duplicate]
+        is_not_trade_success = (self.logistics_data_df[ACTION] != TRADE_SUCCESS).to_numpy()
+        logistics_data_df = self.logistics_data_df[is_not_trade_success]
+        is_logistics_duplicate = logistics_data_df.duplicated().to_numpy()
+        logistics_data_df = logistics_data_df[~is_logistics_duplicate]
+
+        # One pass over the order data
+        pay_timestamps = order_data_df[PAY_TIMESTAMP_DATETIME]
+        promise_speeds = order_data_df[PROMISE_SPEED]
+        orders = pd.DataFrame({
+            ORDER_ID: order_data_df[ORDER_ID],
+            'not_cainiao': order_data_df[IF_CAINIAO] != 1,
+            'without_shipment_score': order_data_df[LOGISTICS_REVIEW_SCORE].isna(),
+            'invalid_pay_timestamp': pay_timestamps.isnull() | (pay_timestamps < DAY_ONE),
+            'without_slowest_shipping_speed': promise_speeds.isnull() | (promise_speeds == 0),
+            'with_multiple_product_types': order_data_df[ITEM_COUNT] > 1,
+            'pay_timestamp': pay_timestamps,
+        }).groupby(ORDER_ID, dropna=False, sort=False).agg(
+            not_cainiao=('not_cainiao', 'any'),
+            without_shipment_score=('without_shipment_score', 'any'),
+            invalid_pay_timestamp=('invalid_pay_timestamp', 'any'),
+            without_slowest_shipping_speed=('without_slowest_shipping_speed', 'any'),
+            with_multiple_product_types=('with_multiple_product_types', 'any'),
+            earliest_pay=('pay_timestamp', 'min'),
+            latest_pay=('pay_timestamp', 'max'),
+        )
+
+        # One grouped pass over the logistics data, which also produces the order summary
+        timestamps = logistics_data_df[TIMESTAMP_DATE_TIME]
+        events = build_order_summary_events(logistics_data_df).assign(**{
+            'failed': logistics_data_df[ACTION] == FAILURE,
+            'without_shipment_times': (self._is_without_timestamp(logistics_data_df)
+                                       | logistics_data_df[ORDER_DATE].isnull()),
+            'invalid_timestamp': timestamps.isnull() | (timestamps < DAY_ONE),
+            'action_timestamp': timestamps,
+            LOGISTIC_COMPANY_ID: logistics_data_df[LOGISTIC_COMPANY_ID],
+        }).groupby(ORDER_ID, dropna=False, sort=False).agg(
+            **ORDER_SUMMARY_AGGREGATIONS,
+            failed=('failed', 'any'),
+            without_shipment_times=('without_shipment_times', 'any'),
+            invalid_timestamp=('invalid_timestamp', 'any'),
+            earliest_action=('action_timestamp', 'min'),
+            latest_action=('action_timestamp', 'max'),
+            shipper_count=(LOGISTIC_COMPANY_ID, 'nunique'),
+        )
+        # The groupby based rules in clean_up never see rows without an order id
+        is_grouped = events.index.notna()
+        earliest_pay = orders['earliest_pay'].reindex(events.index)
+        latest_pay = orders['latest_pay'].reindex(events.index)
+
+        # Flags in the same order as the rules are applied in clean_up
+        rejections = [
+            ('remove_not_cainiao', orders['not_cainiao']),
+            ('remove_without_shipment_score', orders['without_shipment_score']),
+            ('remove_failed_delivery', events['failed']),
+            ('remove_without_shipment_times', events['without_shipment_times']),
+            ('convert_timestamp_to_datetime', events['invalid_timestamp']),
+            ('convert_timestamp_to_datetime', orders['invalid_pay_timestamp']),
+            ('remove_with_action_before_order', events['earliest_action'] < latest_pay),
+            ('remove_without_exactly_one_sign_action', is_grouped & (events[SIGN_COUNT] != 1)),
+            ('remove_without_exactly_one_consign_action', is_grouped & (events[CONSIGN_COUNT] != 1)),
+            ('remove_with_action_after_sign', events['latest_action'] > events[SIGN_TIME]),
+            ('remove_without_slowest_shipping_speed', orders['without_slowest_shipping_speed']),
+            ('remove_with_multiple_shippers', is_grouped & (events['shipper_count'] > 1)),
+            ('remove_with_multiple_product_types', orders['with_multiple_product_types']),
+            ('remove_shipment_time_more_than_eight_days', (events[CONSIGN_TIME] - earliest_pay).dt.days > MAX_SHIPMENT_DAYS),
+            ('remove_more_than_ten_actions', is_grouped & (events[SHIPMENT_ACTION_COUNT] > MAX_SHIPMENT_ACTIONS)),
+            ('remove_less_than_four_actions', is_grouped & (events[SHIPMENT_ACTION_COUNT] < MIN_SHIPMENT_ACTIONS)),
+        ]
+        flags = pd.concat([flag for _, flag in rejections], axis=1, keys=range(len(rejections)))
+        flagged_order_ids = flags.index
+        flags = flags.fillna(False).astype(bool).to_numpy()
+        kept = len(rejections)
+        # Index of the first rule rejecting each order, orders passing every rule get len(rejections)
+        first_rejection = np.append(np.where(flags.any(axis=1), flags.argmax(axis=1), kept), kept)
+        order_codes = first_rejection[flagged_order_ids.get_indexer(self.order_data_df[ORDER_ID])]
+        logistics_codes = first_rejection[flagged_order_ids.get_indexer(self.logistics_data_df[ORDER_ID])]
+
+        # Record the rows removed by each rule in the audit as clean_up would, the leading order rules run before the
+        # row level cleaning
+        order_rule_count = len(self.get_leading_order_rules())
+        removed_orders = np.bincount(
+            first_rejection[flagged_order_ids.get_indexer(self.order_data_df[ORDER_ID].dropna().unique())],
+            minlength=kept + 1)
+        removed_order_rows = np.bincount(order_codes, minlength=kept + 1)
+        removed_events = np.bincount(logistics_codes, minlength=kept + 1)
+        order_count = order_codes.shape[0]
+        logistics_count = logistics_codes.shape[0]
+        for rule_index in range(order_rule_count):
+            order_count -= removed_order_rows[rule_index]
+            logistics_count -= removed_events[rule_index]
+            self.audit.record(rejections[rule_index][0], removed_orders[rule_index], removed_order_rows[rule_index],
+                              removed_events[rule_index], order_count, logistics_count)
+
+        trade_success_count = np.count_nonzero((logistics_codes >= order_rule_count) & ~is_not_trade_success)
+        logistics_count -= trade_success_count
+        self.audit.record('remove_trade_success_actions', 0, 0, trade_success_count, order_count, logistics_count)
+        logistics_codes = logistics_codes[is_not_trade_success]
+
+        duplicate_order_count = np.count_nonzero((order_codes >= order_rule_count) & is_order_duplicate)
+        duplicate_logistics_count = np.count_nonzero((logistics_codes >= order_rule_count) & is_logistics_duplicate)
+        order_count -= duplicate_order_count
+        logistics_count -= duplicate_logistics_count
+        self.audit.record('drop_duplicates', 0, duplicate_order_count, duplicate_logistics_count, order_count,
+                          logistics_count)
+        order_codes = order_codes[~is_order_duplicate]
+        logistics_codes = logistics_codes[~is_logistics_duplicate]
+
+        removed_order_rows = np.bincount(order_codes, minlength=kept + 1)
+        removed_events = np.bincount(logistics_codes, minlength=kept + 1)
+        for rule_index in range(order_rule_count, kept):
+            order_count -= removed_order_rows[rule_index]
+            logistics_count -= removed_events[rule_index]
+            self.audit.record(rejections[rule_index][0], removed_orders[rule_index], removed_order_rows[rule_index],
+                              removed_events[rule_index], order_count, logistics_count)
+
+        # Apply the combined rejection mask
+        self.order_data_df = order_data_df[order_codes == kept]
+        self.logistics_data_df = logistics_data_df[logistics_codes == kept]
+        is_kept_order = first_rejection[flagged_order_ids.get_indexer(events.index)] == kept
+        self.order_summary_df = events.loc[
+            is_grouped & is_kept_order, list(ORDER_SUMMARY_AGGREGATIONS)].sort_index().reset_index()
+        self.order_summary_df[ORDER_KEY] = get_order_keys(self.order_key_dictionary, self.order_summary_df[ORDER_ID])
+        self.timestamps_validated = True
+
+    def compact_order_keys(self):
+        """
+        Rebuild the order key dictionary from the orders left after cleaning and key every table with it again, so the
+        exported keys are dense
+        """
+        self.order_key_dictionary = build_order_key_dictionary(
+            [self.order_data_df[ORDER_ID], self.logistics_data_df[ORDER_ID]])
+        for df in [self.order_data_df, self.logistics_data_df, self.get_order_summary()]:
+            df[ORDER_KEY] = get_order_keys(self.order_key_dictionary, df[ORDER_ID])
+
+    def export_data(self, root_dir: str, index: int, export_format: str = FEATHER,
+                    partition_by_company: bool = False) -> list:
+        """
+        Export dataframe as feather files, the order summary and the cleaning audit are exported next to the cleaned
+        data. The rows of every table are sorted by order id, the events of an order keep their order
         Data will be exported as feather per the analysis performed at:
             https://towardsdatascience.com/the-best-format-to-save-pandas-data-414dca023e0d
         :param root_dir: The root directory to export the files in
-        :param index: The index of the dataset, index should be from 1 and 7
+        :param index: The index of the dataset, index should be positive
+        :param export_format: FEATHER to export a file per table, PARQUET to export into partitioned parquet datasets
+        :param partition_by_company: whether to also partition the parquet datasets by logistic company
+        :return: paths to the exported files, the order key dictionary is exported with the feather files
         """
-        assert 0 < index < 8
+        assert index > 0
         assert os.path.isdir(root_dir)
 
+        logging.info(f'cleaned logistics detail shape: {self.logistics_data_df.shape}')
+        logging.info(f'cleaned order data shape: {self.order_data_df.shape}')
+
+        apply_logistics_schema(self.logistics_data_df)
+        apply_order_schema(self.order_data_df)
+        # Every remaining timestamp is valid, the flags are only needed while cleaning
+        self.logistics_data_df = self.logistics_data_df.drop(columns=[TIMESTAMP_INVALID], errors='ignore')
+        self.order_data_df = self.order_data_df.drop(columns=[PAY_TIMESTAMP_INVALID], errors='ignore')
+        # Sort by order id so the exported files don't depend on the order the rows were read in, e.g. by bucket
+        self.logistics_data_df = self.logistics_data_df.sort_values(ORDER_ID, kind='stable', ignore_index=True)
+        self.order_data_df = self.order_data_df.sort_values(ORDER_ID, kind='stable', ignore_index=True)
+        self.order_summary_df = self.get_order_summary().sort_values(ORDER_ID, kind='stable', ignore_index=True)
+        self.compact_order_keys()
+
+        audit_file_dir = get_audit_path(os.path.join(root_dir, "cleaned"), index)
+        logging.info(f'exporting cleaning audit to {audit_file_dir}')
+        self.audit.save(audit_file_dir)
+
+        if export_format == PARQUET:
+            # The keys of each shard start at 0, they can't be told apart in datasets shared by all shards
+            self.logistics_data_df = self.logistics_data_df.drop(columns=[ORDER_KEY])
+            self.order_data_df = self.order_data_df.drop(columns=[ORDER_KEY])
+            self.order_summary_df = self.get_order_summary().drop(columns=[ORDER_KEY])
+            return self.export_parquet(root_dir, index, partition_by_company) + [audit_file_dir]
+
         os.makedirs(os.path.join(root_dir, "cleaned", f'data_{index}'), exist_ok=True)
         logistic_data_file_dir = os.path.join(
             root_dir, "cleaned", f'data_{index}', f'cleaned_logistics_detail_{index}.feather')
         order_data_file_dir = os.path.join(
             root_dir, "cleaned", f'data_{index}', f'cleaned_order_data_{index}.feather')
-
-        logging.info(f'cleaned logistics detail shape: {self.logistics_data_df.shape}')
-        logging.info(f'cleaned order data shape: {self.order_data_df.shape}')
+        order_summary_file_dir = os.path.join(
+            root_dir, "cleaned", f'data_{index}', f'cleaned_order_summary_{index}.feather')
+        order_key_file_dir = get_order_key_dictionary_path(os.path.join(root_dir, "cleaned"), index)
 
         logging.info(f'started exporting logistics data to {logistic_data_file_dir}')
         self.logistics_data_df.to_feather(logistic_data_file_dir)
@@ -292,3 +655,36 @@ class DataCleaner:
         logging.info(f'started exporting order data to {order_data_file_dir}')
         self.order_data_df.to_feather(order_data_file_dir)
         logging.info('finished exporting order data')
+
+        logging.info(f'started exporting order summary to {order_summary_file_dir}')
+        self.order_summary_df.to_feather(order_summary_file_dir)
+        logging.info('finished exporting order summary')
+
+        logging.info(f'started exporting order keys to {order_key_file_dir}')
+        save_order_key_dictionary(order_key_file_dir, self.order_key_dictionary)
+        logging.info('finished exporting order keys')
+        return [logistic_data_file_dir, order_data_file_dir, order_summary_file_dir, order_key_file_dir,
+                audit_file_dir]
+
+    def export_parquet(self, root_dir: str, index: int, partition_by_company: bool = False) -> list:
+        """
+        Export the cleaned data into hive partitioned parquet datasets shared by all shards, one dataset per table.
+        The datasets are partitioned by pay date and optionally logistic company, and the rows are sorted by order id
+        so that date windowed, company filtered and order id lookups skip most of the data on disk
+        :param root_dir: The root directory to export the files in
+        :param index: The index of the dataset
+        :param partition_by_company: whether to also partition by logistic company
+        :return: paths to the exported files
+        """
+        cleaned_dir = os.path.join(root_dir, "cleaned")
+        partition_columns = get_partition_columns(partition_by_company)
+        partition_keys = get_order_partition_keys(self.logistics_data_df, self.order_data_df)
+        tables = [('cleaned_logistics_detail', self.logistics_data_df), ('cleaned_order_data', self.order_data_df),
+                  ('cleaned_order_summary', self.get_order_summary())]
+        output_paths = []
+        for table_name, df in tables:
+            dataset_dir = get_parquet_dataset_dir(cleaned_dir, table_name)
+            logging.info(f'started exporting {table_name} to {dataset_dir}')
+            output_paths += write_partitioned_parquet(df, dataset_dir, partition_keys, partition_columns, index)
+            logging.info(f'finished exporting {table_name}')
+        return output_paths
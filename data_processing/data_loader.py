@@ -1,40 +1,350 @@
+import glob
+import logging
+import os.path
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.fs as fs
+import pyarrow.parquet as pq
 
 from config import *
+from .dimension_tables import *
+from .parquet_export import FEATHER, PARQUET, get_parquet_dataset_dir
+from .schema import apply_inventory_schema, apply_item_schema, apply_logistics_schema, apply_order_schema, \
+    apply_seller_schema
+
+
+def read_table(file_path: str, columns: list = None, filters=None) -> pa.Table:
+    """
+    Read a feather file into an arrow table through a memory map, columns and rows that are not requested are skipped
+    by the pyarrow dataset reader
+    :param file_path: path to the feather file
+    :param columns: columns to read, all columns if None
+    :param filters: rows to read as a pyarrow dataset expression or in the filters format of pd.read_parquet, e.g.
+        [(ACTION, 'in', [CONSIGN, GOT]), (LOGISTICS_REVIEW_SCORE, '>=', 2)], all rows if None
+    :return: table containing the requested columns and rows
+    """
+    if filters is not None and not isinstance(filters, ds.Expression):
+        filters = pq.filters_to_expression(filters)
+    dataset = ds.dataset(os.path.abspath(file_path), format='feather', filesystem=fs.LocalFileSystem(use_mmap=True))
+    return dataset.to_table(columns=columns, filter=filters)
+
+
+def table_to_pandas(table: pa.Table) -> pd.DataFrame:
+    """
+    Convert an arrow table to pandas, the buffers of each column are released as soon as the column is converted so
+    that the data is held in memory about once. The table can't be used afterwards
+    :param table: table to convert
+    :return: converted dataframe
+    """
+    return table.to_pandas(split_blocks=True, self_destruct=True)
 
 
-def load_full_logistics_data():
+def read_feather(file_path: str, columns: list = None, filters=None) -> pd.DataFrame:
+    """
+    Read a feather file, columns and rows that are not requested are never converted to pandas
+    :param file_path: path to the feather file
+    :param columns: columns to read, all columns if None
+    :param filters: rows to read, see read_table
+    :return: dataframe containing the requested columns and rows
+    """
+    return table_to_pandas(read_table(file_path, columns, filters))
+
+
+def read_feather_excluding_orders(file_path: str, excluded_order_ids: pd.Index) -> (pd.DataFrame, pd.Series):
+    """
+    Read a feather file one record batch at a time without the rows of the excluded orders, only the other rows of
+    every batch are converted to pandas. The rows keep their row numbers as index, as if the whole file was read and
+    filtered
+    :param file_path: path to the feather file
+    :param excluded_order_ids: order ids whose rows are skipped, NaN skips the rows without an order id
+    :return: dataframe containing the rows of the other orders and the number of rows skipped of every excluded order
+        with rows, by order id
+    """
+    order_ids = excluded_order_ids[excluded_order_ids.notna()].astype('int64').tolist()
+    if excluded_order_ids.hasnans:
+        order_ids.append(None)
+    row_numbers = [np.empty(0, dtype=np.int64)]
+    skipped_rows = []
+    row_count = 0
+    # Integer columns with nulls are converted to float, also when the rows with nulls are skipped
+    columns_with_nulls = set()
+    with pa.memory_map(os.path.abspath(file_path)) as source:
+        reader = pa.ipc.open_file(source)
+        tables = [reader.schema.empty_table()]
+        value_set = pa.array(order_ids).cast(reader.schema.field(ORDER_ID).type)
+        for batch_index in range(reader.num_record_batches):
+            batch = reader.get_batch(batch_index)
+            is_excluded = pc.is_in(batch.column(ORDER_ID), value_set=value_set).to_numpy(zero_copy_only=False)
+            kept_rows = np.flatnonzero(~is_excluded)
+            tables.append(pa.Table.from_batches([batch.take(kept_rows)]))
+            skipped_rows.append(
+                batch.column(ORDER_ID).take(np.flatnonzero(is_excluded)).to_pandas().value_counts(dropna=False))
+            columns_with_nulls.update(name for name, column in zip(batch.schema.names, batch.columns)
+                                      if column.null_count and pa.types.is_integer(column.type))
+            row_numbers.append(kept_rows + row_count)
+            row_count += batch.num_rows
+        df = table_to_pandas(concat_tables(tables))
+    del tables
+    df.index = np.concatenate(row_numbers)
+    for column in columns_with_nulls:
+        df[column] = df[column].astype(np.float64)
+    skipped_rows = pd.concat(skipped_rows).groupby(level=0, dropna=False).sum() if skipped_rows else pd.Series(
+        dtype=np.int64)
+    logging.info(f'skipped {skipped_rows.sum()} rows of {len(excluded_order_ids)} excluded orders in {file_path}')
+    return df, skipped_rows
+
+
+def concat_tables(tables: list) -> pa.Table:
+    """
+    Concatenate arrow tables without copying, dictionary columns written with different index types are cast to the
+    widest index type. The chunks keep their own dictionaries, they are unified when converted to pandas
+    :param tables: tables with the same columns
+    :return: concatenated table
+    """
+    fields = []
+    for column_index, field in enumerate(tables[0].schema):
+        column_types = [table.schema.field(column_index).type for table in tables]
+        if all(pa.types.is_dictionary(column_type) for column_type in column_types):
+            index_type = max((column_type.index_type for column_type in column_types), key=lambda t: t.bit_width)
+            field = field.with_type(pa.dictionary(index_type, field.type.value_type))
+        fields.append(field)
+    schema = pa.schema(fields, metadata=tables[0].schema.metadata)
+    return pa.concat_tables([table if table.schema.equals(schema) else table.cast(schema) for table in tables])
+
+
+def get_cleaned_shard_file_paths(file_name: str) -> dict:
+    """
+    Find the cleaned feather file of every shard
+    :param file_name: name of the files without the shard index, e.g. cleaned_logistics_detail
+    :return: dict mapping the shard index to the path of its file, ordered by shard index
+    """
+    indexed_file_paths = []
+    for file_path in glob.glob(os.path.join(CLEANED_DATA_DIR_ROOT, 'data_*', f'{file_name}_*.feather')):
+        match = re.fullmatch(rf'{file_name}_(\d+)\.feather', os.path.basename(file_path))
+        if match:
+            indexed_file_paths.append((int(match.group(1)), file_path))
+    return dict(sorted(indexed_file_paths))
+
+
+def get_cleaned_file_paths(file_name: str) -> list:
+    """
+    Find the cleaned feather files of every shard
+    :param file_name: name of the files without the shard index, e.g. cleaned_logistics_detail
+    :return: paths to the files ordered by shard index
+    """
+    return list(get_cleaned_shard_file_paths(file_name).values())
+
+
+def get_cleaned_shard_indices() -> list:
+    """
+    Find the shards with cleaned logistics data
+    :return: indices of the shards in ascending order
+    """
+    return list(get_cleaned_shard_file_paths('cleaned_logistics_detail'))
+
+
+def read_parquet_dataset(dataset_dir: str, columns: list = None, filters=None) -> pa.Table:
+    """
+    Read a hive partitioned parquet dataset, partitions and row groups that can't match the filters are skipped
+    :param dataset_dir: directory of the dataset
+    :param columns: columns to read, all columns if None
+    :param filters: rows to read, see read_table
+    :return: table containing the requested columns and rows
+    """
+    if filters is not None and not isinstance(filters, ds.Expression):
+        filters = pq.filters_to_expression(filters)
+    dataset = ds.dataset(dataset_dir, format='parquet', partitioning='hive')
+    return dataset.to_table(columns=columns, filter=filters)
+
+
+def _load_cleaned_files(file_name: str, columns: list = None, filters=None, apply_schema=None,
+                        file_format: str = FEATHER) -> pd.DataFrame:
+    if file_format == PARQUET:
+        data_df = table_to_pandas(
+            read_parquet_dataset(get_parquet_dataset_dir(CLEANED_DATA_DIR_ROOT, file_name), columns, filters))
+        return apply_schema(data_df) if apply_schema is not None else data_df
+
+    file_paths = get_cleaned_file_paths(file_name)
+    if not file_paths:
+        raise FileNotFoundError(f'no cleaned {file_name} files in {CLEANED_DATA_DIR_ROOT}, clean the data or update '
+                                f'CLEANED_DATA_DIR_ROOT in config/config.py')
+    # Arrow releases the GIL while reading, so the shards are read concurrently
+    with ThreadPoolExecutor(max_workers=min(len(file_paths), os.cpu_count() or 1)) as executor:
+        tables = list(executor.map(lambda file_path: read_table(file_path, columns, filters), file_paths))
+    table = concat_tables(tables)
+    del tables
+    data_df = table_to_pandas(table)
+    return apply_schema(data_df) if apply_schema is not None else data_df
+
+
+def load_full_logistics_data(columns: list = None, filters=None, file_format: str = FEATHER):
     """
     Loads and merges logistics data from drive
+    :param columns: columns to load, all columns if None
+    :param filters: rows to load, see read_table
+    :param file_format: FEATHER to load the feather file of every shard, PARQUET to load the partitioned parquet dataset
+        written by DataCleaner.export_parquet, whose filters can also use the pay_date partition column
     :return: dataframe containing logistics data
     """
-    file_paths = [f'{CLEANED_DATA_DIR_ROOT}/data_{i}/cleaned_logistics_detail_{i}.feather' for i in range(1, 8)]
+    return _load_cleaned_files('cleaned_logistics_detail', columns, filters, apply_logistics_schema, file_format)
 
-    full_logistics_data = []
-    for file_path in file_paths:
-        full_logistics_data.append(pd.read_feather(file_path))
-    full_logistics_data_df = pd.concat(full_logistics_data)
-    return full_logistics_data_df
 
-
-def load_full_order_data():
+def load_full_order_data(columns: list = None, filters=None, file_format: str = FEATHER):
     """
     Loads and merges order data from drive
+    :param columns: columns to load, all columns if None
+    :param filters: rows to load, see read_table
+    :param file_format: FEATHER to load the feather file of every shard, PARQUET to load the partitioned parquet dataset
+        written by DataCleaner.export_parquet, whose filters can also use the pay_date partition column
     :return: dataframe containing order data
     """
-    file_paths = [f'{CLEANED_DATA_DIR_ROOT}/data_{i}/cleaned_order_data_{i}.feather' for i in range(1, 8)]
+    return _load_cleaned_files('cleaned_order_data', columns, filters, apply_order_schema, file_format)
+
+
+def load_full_order_summary(columns: list = None, filters=None, file_format: str = FEATHER):
+    """
+    Loads and merges the per-order event summary exported next to the cleaned data from drive
+    :param columns: columns to load, all columns if None
+    :param filters: rows to load, see read_table
+    :param file_format: FEATHER to load the feather file of every shard, PARQUET to load the partitioned parquet dataset
+        written by DataCleaner.export_parquet, whose filters can also use the pay_date partition column
+    :return: dataframe containing order summary
+    """
+    return _load_cleaned_files('cleaned_order_summary', columns, filters, file_format=file_format)
 
-    full_order_data = []
-    for file_path in file_paths:
-        full_order_data.append(pd.read_feather(file_path))
-    full_order_data_df = pd.concat(full_order_data)
-    return full_order_data_df
 
+def _load_cleaned_shard(file_name: str, shard_index: int, columns: list = None, filters=None,
+                        apply_schema=None) -> pd.DataFrame:
+    data_df = read_feather(get_cleaned_shard_file_paths(file_name)[shard_index], columns, filters)
+    return apply_schema(data_df) if apply_schema is not None else data_df
 
-def load_item_data():
+
+def load_shard_logistics_data(shard_index: int, columns: list = None, filters=None):
+    """
+    Loads the logistics data of one shard from drive, the events of an order are all in the shard of the order
+    :param shard_index: index of the shard, see get_cleaned_shard_indices
+    :param columns: columns to load, all columns if None
+    :param filters: rows to load, see read_table
+    :return: dataframe containing logistics data of the shard
+    """
+    return _load_cleaned_shard('cleaned_logistics_detail', shard_index, columns, filters, apply_logistics_schema)
+
+
+def load_shard_order_data(shard_index: int, columns: list = None, filters=None):
+    """
+    Loads the order data of one shard from drive
+    :param shard_index: index of the shard, see get_cleaned_shard_indices
+    :param columns: columns to load, all columns if None
+    :param filters: rows to load, see read_table
+    :return: dataframe containing order data of the shard
     """
-    Loads item data from drive
+    return _load_cleaned_shard('cleaned_order_data', shard_index, columns, filters, apply_order_schema)
+
+
+def load_shard_order_summary(shard_index: int, columns: list = None, filters=None):
+    """
+    Loads the per-order event summary of one shard from drive
+    :param shard_index: index of the shard, see get_cleaned_shard_indices
+    :param columns: columns to load, all columns if None
+    :param filters: rows to load, see read_table
+    :return: dataframe containing order summary of the shard
+    """
+    return _load_cleaned_shard('cleaned_order_summary', shard_index, columns, filters)
+
+
+def get_item_data_path() -> str:
+    """
+    Get the path of the item data
+    :return: path to the item feather file
+    """
+    return get_dimension_table_path(get_cleaned_data_dir(), ITEM_DATA_FILE_NAME)
+
+
+def get_item_dimension_path() -> str:
+    """
+    Get the path of the file the item dimension is loaded from, the item data if the dimension wasn't precomputed
+    :return: path to the item dimension feather file, or to the item data feather file
+    """
+    dimension_path = get_dimension_table_path(get_cleaned_data_dir(), ITEM_DIMENSION_FILE_NAME)
+    return dimension_path if os.path.exists(dimension_path) else get_item_data_path()
+
+
+def get_cleaned_data_dir() -> str:
+    """
+    :return: directory containing the cleaned data
+    """
+    return CLEANED_DATA_DIR_ROOT
+
+
+def load_item_data(columns: list = None, filters=None) -> pd.DataFrame:
+    """
+    Loads item data from drive, one row per item and day
+    :param columns: columns to load, all columns if None
+    :param filters: rows to load, see read_table
     :return: dataframe containing item data
     """
-    item_df = pd.read_feather(f'{CLEANED_DATA_DIR_ROOT}/data_8/msom_item_data.feather')
-    return item_df
+    return apply_item_schema(read_feather(get_item_data_path(), columns, filters))
+
+
+def load_item_dimension(columns: list = None, filters=None) -> pd.DataFrame:
+    """
+    Loads the distinct item attributes precomputed by write_dimension_tables, they are computed from the item data if
+    they weren't precomputed
+    :param columns: columns to load, a subset of ITEM_DIMENSION_COLUMNS, all of them if None
+    :param filters: rows to load, see read_table
+    :return: dataframe with the requested columns of every distinct item
+    """
+    if get_item_dimension_path() == get_item_data_path():
+        item_dimension_df = compute_item_dimension(load_item_data(ITEM_DIMENSION_COLUMNS, filters))
+        return item_dimension_df if columns is None else item_dimension_df[columns]
+    return apply_item_schema(read_feather(get_item_dimension_path(), columns, filters))
+
+
+def load_daily_item_traffic(columns: list = None, filters=None) -> pd.DataFrame:
+    """
+    Loads the page views and visitors of all items per day precomputed by write_dimension_tables
+    :param columns: columns to load, all columns if None
+    :param filters: rows to load, see read_table
+    :return: dataframe containing the daily item traffic, see compute_daily_item_traffic
+    """
+    return apply_item_schema(read_feather(
+        get_dimension_table_path(get_cleaned_data_dir(), DAILY_ITEM_TRAFFIC_FILE_NAME), columns, filters))
+
+
+def load_seller_data(columns: list = None, filters=None) -> pd.DataFrame:
+    """
+    Loads seller data from drive, one row per merchant, sub category and day
+    :param columns: columns to load, all columns if None
+    :param filters: rows to load, see read_table
+    :return: dataframe containing seller data
+    """
+    return apply_seller_schema(read_feather(
+        get_dimension_table_path(get_cleaned_data_dir(), SELLER_DATA_FILE_NAME), columns, filters))
+
+
+def load_inventory_data(columns: list = None, filters=None) -> pd.DataFrame:
+    """
+    Loads inventory data from drive, one row per item, warehouse and day
+    :param columns: columns to load, all columns if None
+    :param filters: rows to load, see read_table
+    :return: dataframe containing inventory data
+    """
+    return apply_inventory_schema(read_feather(
+        get_dimension_table_path(get_cleaned_data_dir(), INVENTORY_DATA_FILE_NAME), columns, filters))
+
+
+def load_daily_inventory(columns: list = None, filters=None) -> pd.DataFrame:
+    """
+    Loads the inventory of every item per day summed over the warehouses, precomputed by write_dimension_tables
+    :param columns: columns to load, all columns if None
+    :param filters: rows to load, see read_table
+    :return: dataframe containing the daily inventory, see compute_daily_inventory
+    """
+    return apply_inventory_schema(read_feather(
+        get_dimension_table_path(get_cleaned_data_dir(), DAILY_INVENTORY_FILE_NAME), columns, filters))
@@ -0,0 +1,102 @@
+import logging
+import os.path
+
+import pandas as pd
+
+from constants import *
+from .arrow_conversion import CSV_BLOCK_SIZE, convert_inventory_csv_to_feather, convert_item_csv_to_feather, \
+    convert_seller_csv_to_feather
+from .schema import INVENTORY_QUANTITY_COLUMNS, TRAFFIC_COLUMNS, apply_inventory_schema, apply_item_schema
+
+# Directory of the item, seller and inventory data, shared by every shard
+DIMENSION_DATA_DIR = 'data_8'
+ITEM_DATA_FILE_NAME = 'msom_item_data'
+SELLER_DATA_FILE_NAME = 'msom_seller_data'
+INVENTORY_DATA_FILE_NAME = 'msom_inventory_data'
+ITEM_DIMENSION_FILE_NAME = 'item_dimension'
+DAILY_ITEM_TRAFFIC_FILE_NAME = 'daily_item_traffic'
+DAILY_INVENTORY_FILE_NAME = 'daily_inventory'
+# Attributes of an item, the item data repeats them for every day
+ITEM_DIMENSION_COLUMNS = [ITEM_ID, MERCHANT_ID, BRAND_ID, CATEGORY_ID, SUB_CATEGORY_ID]
+ITEM_DAY_COUNT = 'item_day_count'
+
+
+def compute_item_dimension(item_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Deduplicate the attributes of the items in the daily item data, the rows keep the order in which they first occur
+    :param item_df: dataframe containing item data with at least ITEM_DIMENSION_COLUMNS
+    :return: dataframe with one row per distinct combination of ITEM_DIMENSION_COLUMNS
+    """
+    return item_df[ITEM_DIMENSION_COLUMNS].drop_duplicates().reset_index(drop=True)
+
+
+def compute_daily_item_traffic(item_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Sum the page views and visitors of all items per day
+    :param item_df: dataframe containing item data with at least DATE and the traffic columns
+    :return: dataframe with one row per date, the number of item rows of that date and the traffic of all of them
+    """
+    grouped = item_df.groupby(DATE, observed=True)
+    daily_traffic = grouped[TRAFFIC_COLUMNS].sum()
+    daily_traffic.insert(0, ITEM_DAY_COUNT, grouped.size())
+    return daily_traffic.reset_index()
+
+
+def compute_daily_inventory(inventory_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Sum the inventory quantities of every item per day over all warehouses
+    :param inventory_df: dataframe containing inventory data with at least DAY, ITEM_ID and the quantity columns
+    :return: dataframe with one row per day and item
+    """
+    return inventory_df.groupby([DAY, ITEM_ID], observed=True)[INVENTORY_QUANTITY_COLUMNS].sum().reset_index()
+
+
+def get_dimension_table_path(root_dir: str, file_name: str) -> str:
+    """
+    Get the path of a feather file of the item, seller or inventory data
+    :param root_dir: directory containing the cleaned data
+    :param file_name: name of the table, e.g. ITEM_DIMENSION_FILE_NAME
+    :return: path to the feather file
+    """
+    return os.path.join(root_dir, DIMENSION_DATA_DIR, f'{file_name}.feather')
+
+
+def write_dimension_tables(root_dir: str, block_size: int = CSV_BLOCK_SIZE) -> list:
+    """
+    Convert the item, seller and inventory csv files in root_dir/data_8 to feather files in the cleaned data and
+    precompute the item dimension, the daily item traffic and the daily inventory from them. Missing csv files are
+    skipped
+    :param root_dir: directory containing the raw data, the tables are written to root_dir/cleaned/data_8
+    :param block_size: bytes of csv read at a time
+    :return: paths to the written files
+    """
+    cleaned_dir = os.path.join(root_dir, 'cleaned')
+    os.makedirs(os.path.join(cleaned_dir, DIMENSION_DATA_DIR), exist_ok=True)
+    output_paths = []
+    for file_name, convert in [(ITEM_DATA_FILE_NAME, convert_item_csv_to_feather),
+                               (SELLER_DATA_FILE_NAME, convert_seller_csv_to_feather),
+                               (INVENTORY_DATA_FILE_NAME, convert_inventory_csv_to_feather)]:
+        csv_path = os.path.join(root_dir, DIMENSION_DATA_DIR, f'{file_name}.csv')
+        if not os.path.exists(csv_path):
+            logging.info(f'skipping {csv_path} which does not exist')
+            continue
+        output_paths.append(get_dimension_table_path(cleaned_dir, file_name))
+        convert(csv_path, output_paths[-1], block_size)
+
+    aggregates = [
+        (ITEM_DATA_FILE_NAME, ITEM_DIMENSION_FILE_NAME, ITEM_DIMENSION_COLUMNS, apply_item_schema,
+         compute_item_dimension),
+        (ITEM_DATA_FILE_NAME, DAILY_ITEM_TRAFFIC_FILE_NAME, [DATE] + TRAFFIC_COLUMNS, apply_item_schema,
+         compute_daily_item_traffic),
+        (INVENTORY_DATA_FILE_NAME, DAILY_INVENTORY_FILE_NAME, [DAY, ITEM_ID] + INVENTORY_QUANTITY_COLUMNS,
+         apply_inventory_schema, compute_daily_inventory),
+    ]
+    for source_name, file_name, columns, apply_schema, compute in aggregates:
+        source_path = get_dimension_table_path(cleaned_dir, source_name)
+        if source_path not in output_paths:
+            continue
+        output_paths.append(get_dimension_table_path(cleaned_dir, file_name))
+        logging.info(f'started computing {file_name} from {source_path}')
+        compute(apply_schema(pd.read_feather(source_path, columns=columns))).to_feather(output_paths[-1])
+        logging.info(f'finished writing {file_name} to {output_paths[-1]}')
+    return output_paths
@@ -0,0 +1,285 @@
+import numpy as np
+import pandas as pd
+
+from constants import *
+from .order_keys import NAT_NANOSECONDS, to_nanoseconds
+
+# Sentinel of the segments without an included timestamp while reducing, replaced by NAT_NANOSECONDS afterwards
+_LATEST_NANOSECONDS = np.iinfo(np.int64).max
+
+
+def get_order_segments(order_ids: np.ndarray) -> tuple:
+    """
+    Find the contiguous segment of events of every order. Events are only sorted by order id if some order's events
+    are not contiguous, cleaned data keeps the events of an order together
+    :param order_ids: integer order id or order key of every event
+    :return: stable permutation grouping the events by order, None if they are already grouped, the order id of every
+        segment and the offsets of the segments in the grouped events, segment i is offsets[i]:offsets[i + 1]
+    """
+    sort_order = None
+    starts = np.flatnonzero(np.diff(order_ids, prepend=order_ids[:1] - 1))
+    # Segments in increasing order are grouped, which is checked in one pass, otherwise an order may occur twice
+    segment_order_ids = order_ids[starts]
+    if (segment_order_ids[1:] <= segment_order_ids[:-1]).any() and np.unique(segment_order_ids).size < starts.size:
+        sort_order = np.argsort(order_ids, kind='stable')
+        order_ids = order_ids[sort_order]
+        starts = np.flatnonzero(np.diff(order_ids, prepend=order_ids[:1] - 1))
+    return sort_order, order_ids[starts], np.append(starts, order_ids.size)
+
+
+def get_event_segments(sort_order: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """
+    Get the order segment of every event
+    :param sort_order: permutation grouping the events by order, None if they are grouped, see get_order_segments
+    :param offsets: offsets of the segments in the grouped events
+    :return: segment of every event in the original order of the events
+    """
+    event_segments = np.repeat(np.arange(offsets.size - 1, dtype=np.int32), np.diff(offsets))
+    if sort_order is not None:
+        event_segments[sort_order] = event_segments.copy()
+    return event_segments
+
+
+def count_segment_events(offsets: np.ndarray) -> np.ndarray:
+    """
+    Count the events of every segment
+    :param offsets: offsets of the segments, see get_order_segments
+    :return: number of events of every segment
+    """
+    return np.diff(offsets)
+
+
+def count_segment_matches(is_match: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """
+    Count the matching events of every segment. Like all segment kernels, the values are in the grouped order of the
+    events and every segment has at least one event
+    :param is_match: whether every event matches
+    :param offsets: offsets of the segments
+    :return: number of matching events of every segment
+    """
+    if not is_match.size:
+        return np.zeros(offsets.size - 1, dtype=np.int64)
+    return np.add.reduceat(is_match.astype(np.int64), offsets[:-1])
+
+
+def count_segment_values(codes: np.ndarray, value_count: int, offsets: np.ndarray) -> np.ndarray:
+    """
+    Count the events of every segment with each value, e.g. the events of every order with each action
+    :param codes: code of the value of every event in range(value_count), negative codes are not counted
+    :param value_count: number of values
+    :param offsets: offsets of the segments
+    :return: array with one row per segment and one column per value
+    """
+    segment_count = offsets.size - 1
+    event_segments = np.repeat(np.arange(segment_count, dtype=np.int64), np.diff(offsets))
+    is_counted = codes >= 0
+    cells = event_segments[is_counted] * value_count + codes[is_counted]
+    return np.bincount(cells, minlength=segment_count * value_count).reshape(segment_count, value_count)
+
+
+def first_segment_times(timestamps: np.ndarray, offsets: np.ndarray, is_included: np.ndarray = None) -> np.ndarray:
+    """
+    Get the earliest timestamp of every segment, e.g. the first time of an action with is_included set to the events
+    of that action
+    :param timestamps: time of every event in nanoseconds, see to_nanoseconds
+    :param offsets: offsets of the segments
+    :param is_included: whether every event is included, all events if None
+    :return: earliest included time of every segment, NAT_NANOSECONDS if it has none
+    """
+    if not timestamps.size:
+        return np.full(offsets.size - 1, NAT_NANOSECONDS)
+    is_timed = timestamps != NAT_NANOSECONDS
+    is_included = is_timed if is_included is None else is_included & is_timed
+    first_times = np.minimum.reduceat(np.where(is_included, timestamps, _LATEST_NANOSECONDS), offsets[:-1])
+    first_times[first_times == _LATEST_NANOSECONDS] = NAT_NANOSECONDS
+    return first_times
+
+
+def last_segment_times(timestamps: np.ndarray, offsets: np.ndarray, is_included: np.ndarray = None) -> np.ndarray:
+    """
+    Get the latest timestamp of every segment, see first_segment_times
+    :param timestamps: time of every event in nanoseconds
+    :param offsets: offsets of the segments
+    :param is_included: whether every event is included, all events if None
+    :return: latest included time of every segment, NAT_NANOSECONDS if it has none
+    """
+    if not timestamps.size:
+        return np.full(offsets.size - 1, NAT_NANOSECONDS)
+    if is_included is not None:
+        timestamps = np.where(is_included, timestamps, NAT_NANOSECONDS)
+    return np.maximum.reduceat(timestamps, offsets[:-1])
+
+
+def count_segment_unique(values: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """
+    Count the distinct values of every segment, missing values are not counted, like nunique. Segments whose smallest
+    and largest value are equal are counted in one pass, only the events of the other segments are sorted
+    :param values: numeric value of every event, e.g. the facility id
+    :param offsets: offsets of the segments
+    :return: number of distinct values of every segment
+    """
+    segment_count = offsets.size - 1
+    if not values.size:
+        return np.zeros(segment_count, dtype=np.int64)
+    is_valid = ~np.isnan(values) if values.dtype.kind == 'f' else np.ones(values.size, dtype=bool)
+    extremes = np.finfo(values.dtype) if values.dtype.kind == 'f' else np.iinfo(values.dtype)
+    smallest = np.minimum.reduceat(np.where(is_valid, values, extremes.max), offsets[:-1])
+    largest = np.maximum.reduceat(np.where(is_valid, values, extremes.min), offsets[:-1])
+    has_valid = count_segment_matches(is_valid, offsets) > 0
+    unique_counts = has_valid.astype(np.int64)
+
+    is_multiple = smallest != largest
+    if is_multiple.any():
+        event_segments = np.repeat(np.arange(segment_count), np.diff(offsets))
+        is_sorted = is_multiple[event_segments] & is_valid
+        sorted_segments = event_segments[is_sorted]
+        sorted_values = values[is_sorted]
+        sort_order = np.lexsort((sorted_values, sorted_segments))
+        sorted_segments = sorted_segments[sort_order]
+        sorted_values = sorted_values[sort_order]
+        is_new = np.ones(sorted_values.size, dtype=bool)
+        is_new[1:] = (sorted_segments[1:] != sorted_segments[:-1]) | (sorted_values[1:] != sorted_values[:-1])
+        unique_counts[is_multiple] = np.bincount(sorted_segments[is_new], minlength=segment_count)[is_multiple]
+    return unique_counts
+
+
+def any_segment_earlier(timestamps: np.ndarray, thresholds: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """
+    Find the segments with an event earlier than the threshold of the segment, e.g. an action before the payment
+    :param timestamps: time of every event in nanoseconds
+    :param thresholds: threshold of every segment in nanoseconds, no event is earlier than NAT_NANOSECONDS
+    :param offsets: offsets of the segments
+    :return: whether every segment has an event with a time earlier than its threshold
+    """
+    if not timestamps.size:
+        return np.zeros(offsets.size - 1, dtype=bool)
+    is_earlier = (timestamps != NAT_NANOSECONDS) & (timestamps < np.repeat(thresholds, np.diff(offsets)))
+    return np.logical_or.reduceat(is_earlier, offsets[:-1])
+
+
+def any_segment_later(timestamps: np.ndarray, thresholds: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """
+    Find the segments with an event later than the threshold of the segment, e.g. an action after the sign action
+    :param timestamps: time of every event in nanoseconds
+    :param thresholds: threshold of every segment in nanoseconds, no event is later than NAT_NANOSECONDS
+    :param offsets: offsets of the segments
+    :return: whether every segment has an event with a time later than its threshold
+    """
+    if not timestamps.size:
+        return np.zeros(offsets.size - 1, dtype=bool)
+    event_thresholds = np.repeat(thresholds, np.diff(offsets))
+    is_later = (timestamps != NAT_NANOSECONDS) & (event_thresholds != NAT_NANOSECONDS) & (
+            timestamps > event_thresholds)
+    return np.logical_or.reduceat(is_later, offsets[:-1])
+
+
+class OrderEventStore:
+    """
+    Events stored grouped by order: the events of every order are one contiguous segment of the rows and an offsets
+    array gives the slice of each segment, so per-order questions are answered by the segment kernels in one linear
+    pass instead of grouping by a hash of the order id. Events that are already grouped, like cleaned data, are stored
+    without a copy
+    """
+
+    def __init__(self, events: pd.DataFrame, key_column: str = ORDER_ID):
+        """
+        :param events: events, e.g. logistics data
+        :param key_column: integer column identifying the order of every event, e.g. ORDER_ID or ORDER_KEY
+        """
+        sort_order, self.segment_keys, self.offsets = get_order_segments(events[key_column].to_numpy())
+        self.events = events if sort_order is None else events.take(sort_order)
+        self.key_column = key_column
+
+    def __len__(self) -> int:
+        """
+        :return: number of segments
+        """
+        return self.offsets.size - 1
+
+    def get_values(self, column: str, dtype=None) -> np.ndarray:
+        """
+        :param column: column of the events
+        :param dtype: dtype of the values, the dtype of the column if None
+        :return: values of the column in the grouped order of the events
+        """
+        return self.events[column].to_numpy(dtype)
+
+    def get_timestamps(self, column: str = TIMESTAMP_DATE_TIME) -> np.ndarray:
+        """
+        :param column: datetime column of the events
+        :return: times of the column in nanoseconds, see to_nanoseconds
+        """
+        return to_nanoseconds(self.events[column])
+
+    def get_event_segments(self) -> np.ndarray:
+        """
+        :return: segment of every event in the grouped order
+        """
+        return get_event_segments(None, self.offsets)
+
+    def filter(self, is_kept: np.ndarray) -> 'OrderEventStore':
+        """
+        Keep some of the events, the kept events stay grouped so the segments are found again in one pass
+        :param is_kept: whether every event in the grouped order is kept
+        :return: store of the kept events
+        """
+        return OrderEventStore(self.events[is_kept], self.key_column)
+
+    def count_events(self) -> np.ndarray:
+        """
+        :return: number of events of every order
+        """
+        return count_segment_events(self.offsets)
+
+    def count_actions(self) -> pd.DataFrame:
+        """
+        :return: number of events of every order with each action, indexed by the order keys
+        """
+        actions = self.events[ACTION].astype('category')
+        counts = count_segment_values(actions.cat.codes.to_numpy(), len(actions.cat.categories), self.offsets)
+        return pd.DataFrame(counts, index=pd.Index(self.segment_keys, name=self.key_column),
+                            columns=actions.cat.categories)
+
+    def first_action_times(self, action: str, column: str = TIMESTAMP_DATE_TIME) -> np.ndarray:
+        """
+        :param action: action to get the times of, e.g. SIGNED
+        :param column: datetime column of the events
+        :return: earliest time of the action of every order in nanoseconds, NAT_NANOSECONDS if it has none
+        """
+        return first_segment_times(self.get_timestamps(column), self.offsets,
+                                   (self.events[ACTION] == action).to_numpy())
+
+    def last_action_times(self, action: str, column: str = TIMESTAMP_DATE_TIME) -> np.ndarray:
+        """
+        :param action: action to get the times of, e.g. CONSIGN
+        :param column: datetime column of the events
+        :return: latest time of the action of every order in nanoseconds, NAT_NANOSECONDS if it has none
+        """
+        return last_segment_times(self.get_timestamps(column), self.offsets,
+                                  (self.events[ACTION] == action).to_numpy())
+
+    def count_unique(self, column: str) -> np.ndarray:
+        """
+        :param column: numeric column of the events, e.g. FACILITY_ID
+        :return: number of distinct values of the column of every order, missing values are not counted
+        """
+        values = self.events[column]
+        if isinstance(values.dtype, np.dtype) and values.dtype.kind in 'iuf':
+            return count_segment_unique(values.to_numpy(), self.offsets)
+        return count_segment_unique(values.to_numpy(np.float64, na_value=np.nan), self.offsets)
+
+    def any_earlier(self, thresholds: np.ndarray, column: str = TIMESTAMP_DATE_TIME) -> np.ndarray:
+        """
+        :param thresholds: threshold of every order in nanoseconds
+        :param column: datetime column of the events
+        :return: whether every order has an event earlier than its threshold
+        """
+        return any_segment_earlier(self.get_timestamps(column), thresholds, self.offsets)
+
+    def any_later(self, thresholds: np.ndarray, column: str = TIMESTAMP_DATE_TIME) -> np.ndarray:
+        """
+        :param thresholds: threshold of every order in nanoseconds
+        :param column: datetime column of the events
+        :return: whether every order has an event later than its threshold
+        """
+        return any_segment_later(self.get_timestamps(column), thresholds, self.offsets)
@@ -0,0 +1,134 @@
+import hashlib
+import json
+import logging
+import os.path
+
+MANIFEST_FILE_NAME = 'manifest.json'
+FINGERPRINT_BLOCK_SIZE = 1024 ** 2
+
+
+def fingerprint_file(file_path: str, previous_fingerprint: dict = None) -> dict:
+    """
+    Fingerprint the content of a file. The content is only hashed again when the size or modification time differ
+    from the previous fingerprint, so fingerprinting unchanged files is nearly free
+    :param file_path: path to the file
+    :param previous_fingerprint: fingerprint of the file recorded by a previous run, None if unknown
+    :return: dict with the size, modification time and content hash of the file
+    """
+    stat = os.stat(file_path)
+    if previous_fingerprint is not None and previous_fingerprint.get('size') == stat.st_size and \
+            previous_fingerprint.get('mtime_ns') == stat.st_mtime_ns:
+        return previous_fingerprint
+    content_hash = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(FINGERPRINT_BLOCK_SIZE), b''):
+            content_hash.update(block)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': content_hash.hexdigest()}
+
+
+def fingerprint_files(file_paths: list, previous_fingerprints: dict = None) -> dict:
+    """
+    Fingerprint the content of files, see fingerprint_file
+    :param file_paths: paths to the files
+    :param previous_fingerprints: fingerprints recorded by a previous run by file path, None if unknown
+    :return: dict mapping each file path to its fingerprint
+    """
+    previous_fingerprints = previous_fingerprints or {}
+    return {file_path: fingerprint_file(file_path, previous_fingerprints.get(file_path)) for file_path in file_paths}
+
+
+def get_manifest_path(cleaned_dir: str) -> str:
+    """
+    Get the path of the run manifest
+    :param cleaned_dir: directory containing the cleaned data
+    :return: path to the manifest
+    """
+    return os.path.join(cleaned_dir, MANIFEST_FILE_NAME)
+
+
+def load_manifest(cleaned_dir: str) -> dict:
+    """
+    Load the run manifest recording the inputs, cleaning rules and outputs of every cleaned shard
+    :param cleaned_dir: directory containing the cleaned data
+    :return: manifest, with an empty shard entry if no manifest has been written yet
+    """
+    manifest_path = get_manifest_path(cleaned_dir)
+    if not os.path.exists(manifest_path):
+        return {'shards': {}}
+    with open(manifest_path) as file:
+        return json.load(file)
+
+
+def save_manifest(cleaned_dir: str, manifest: dict):
+    """
+    Save the run manifest, the previous manifest is replaced atomically so an interrupted run never leaves a partial
+    manifest behind
+    :param cleaned_dir: directory containing the cleaned data
+    :param manifest: manifest to save
+    """
+    os.makedirs(cleaned_dir, exist_ok=True)
+    manifest_path = get_manifest_path(cleaned_dir)
+    with open(f'{manifest_path}.tmp', 'w') as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    os.replace(f'{manifest_path}.tmp', manifest_path)
+
+
+def _get_content_hashes(fingerprints: dict) -> dict:
+    return {file_path: fingerprint['hash'] for file_path, fingerprint in fingerprints.items()}
+
+
+def get_stale_reasons(shard_entry: dict, input_fingerprints: dict, rule_fingerprints: dict, settings: dict) -> list:
+    """
+    Compare the current state of a shard with its manifest entry
+    :param shard_entry: manifest entry of the shard, None if the shard has not been cleaned
+    :param input_fingerprints: fingerprints of the current input files
+    :param rule_fingerprints: fingerprints of the current cleaning rules, see DataCleaner.get_rule_fingerprints
+    :param settings: other settings the outputs depend on, e.g. the export format
+    :return: reasons the shard has to be cleaned again, empty if its outputs are up to date
+    """
+    if shard_entry is None:
+        return ['not cleaned before']
+    reasons = []
+    if _get_content_hashes(shard_entry['inputs']) != _get_content_hashes(input_fingerprints):
+        reasons.append('inputs changed')
+    previous_rules = shard_entry['rules']
+    changed_rules = sorted(rule for rule in set(previous_rules['rules']) | set(rule_fingerprints['rules'])
+                           if previous_rules['rules'].get(rule) != rule_fingerprints['rules'].get(rule))
+    if changed_rules:
+        reasons.append(f'rules changed: {changed_rules}')
+    # Manifests written before the code was fingerprinted have no code fingerprints, their shards are cleaned again
+    previous_code = previous_rules.get('code', {})
+    changed_modules = sorted(module for module in set(previous_code) | set(rule_fingerprints['code'])
+                             if previous_code.get(module) != rule_fingerprints['code'].get(module))
+    if changed_modules:
+        reasons.append(f'cleaning code changed: {changed_modules}')
+    changed_parameters = sorted(
+        parameter for parameter in set(previous_rules['parameters']) | set(rule_fingerprints['parameters'])
+        if previous_rules['parameters'].get(parameter) != rule_fingerprints['parameters'].get(parameter))
+    if changed_parameters:
+        reasons.append(f'rule parameters changed: {changed_parameters}')
+    if shard_entry['settings'] != settings:
+        reasons.append('settings changed')
+    for file_path, output_fingerprint in shard_entry['outputs'].items():
+        if not os.path.exists(file_path) or os.path.getsize(file_path) != output_fingerprint['size']:
+            reasons.append(f'output missing or modified: {file_path}')
+            break
+    return reasons
+
+
+def create_shard_entry(input_fingerprints: dict, rule_fingerprints: dict, settings: dict, output_paths: list) -> dict:
+    """
+    Create the manifest entry of a cleaned shard
+    :param input_fingerprints: fingerprints of the input files the shard was cleaned from
+    :param rule_fingerprints: fingerprints of the cleaning rules, see DataCleaner.get_rule_fingerprints
+    :param settings: other settings the outputs depend on, e.g. the export format
+    :param output_paths: paths to the files exported for the shard
+    :return: manifest entry
+    """
+    logging.info(f'recording {len(output_paths)} output files in the manifest')
+    return {
+        'inputs': input_fingerprints,
+        'rules': rule_fingerprints,
+        'settings': settings,
+        'outputs': {output_path: {'size': os.path.getsize(output_path)} for output_path in output_paths},
+    }
@@ -0,0 +1,99 @@
+import os.path
+
+import numpy as np
+import pandas as pd
+
+from constants import *
+
+# Key of the rows without an order id
+MISSING_ORDER_KEY = -1
+# Value of NaT as int64 nanoseconds, the smallest int64
+NAT_NANOSECONDS = np.iinfo(np.int64).min
+
+
+def build_order_key_dictionary(order_ids: list) -> pd.Index:
+    """
+    Assign every order a dense surrogate key: the keys are the positions of the order ids in the sorted dictionary, so
+    keys sort like the order ids
+    :param order_ids: order id columns of every table, e.g. of the order data and the logistics data
+    :return: sorted unique order ids, the key of an order is its position
+    """
+    unique_order_ids = pd.unique(np.concatenate([pd.unique(np.asarray(ids)) for ids in order_ids]))
+    unique_order_ids = np.sort(unique_order_ids[~pd.isna(unique_order_ids)])
+    if unique_order_ids.size > np.iinfo(np.int32).max:
+        raise ValueError(f'{unique_order_ids.size} orders do not fit into int32 order keys')
+    return pd.Index(unique_order_ids, name=ORDER_ID)
+
+
+def get_order_keys(order_key_dictionary: pd.Index, order_ids) -> np.ndarray:
+    """
+    Look up the keys of order ids
+    :param order_key_dictionary: dictionary of the order keys, see build_order_key_dictionary
+    :param order_ids: order ids to look up
+    :return: int32 key of every order id, MISSING_ORDER_KEY for missing order ids and order ids without a key
+    """
+    return order_key_dictionary.get_indexer(order_ids).astype(np.int32)
+
+
+def create_key_bitmap(order_key_dictionary: pd.Index) -> np.ndarray:
+    """
+    Create a bitmap with one flag per order key. The flag of MISSING_ORDER_KEY is the last one, so indexing the bitmap
+    with the keys of a table gives the flag of every row
+    :param order_key_dictionary: dictionary of the order keys
+    :return: bitmap with every flag unset
+    """
+    return np.zeros(len(order_key_dictionary) + 1, dtype=bool)
+
+
+def reduce_by_order_key(order_keys: np.ndarray, values: np.ndarray, key_count: int, ufunc: np.ufunc,
+                        initial) -> np.ndarray:
+    """
+    Reduce the values of every order by indexing an array with the order keys, without grouping or merging
+    :param order_keys: order key of every value
+    :param values: values to reduce
+    :param key_count: number of order keys
+    :param ufunc: reduction, e.g. np.maximum
+    :param initial: result of the orders without values
+    :return: result of every order key, the result of MISSING_ORDER_KEY is the last one
+    """
+    result = np.full(key_count + 1, initial, dtype=np.result_type(values, initial))
+    ufunc.at(result, order_keys, values)
+    return result
+
+
+def to_nanoseconds(timestamps: pd.Series) -> np.ndarray:
+    """
+    Get datetimes as int64 nanoseconds
+    :param timestamps: datetime series
+    :return: nanoseconds since the epoch, NaT is NAT_NANOSECONDS
+    """
+    return np.asarray(timestamps, dtype='datetime64[ns]').view(np.int64)
+
+
+def get_order_key_dictionary_path(cleaned_dir: str, index: int) -> str:
+    """
+    Get the path of the order key dictionary of a shard
+    :param cleaned_dir: directory containing the cleaned data
+    :param index: index of the shard
+    :return: path to the dictionary
+    """
+    return os.path.join(cleaned_dir, f'data_{index}', f'order_keys_{index}.feather')
+
+
+def save_order_key_dictionary(file_path: str, order_key_dictionary: pd.Index):
+    """
+    Save an order key dictionary as a feather file with the order id of every key in key order
+    :param file_path: path to the feather file
+    :param order_key_dictionary: dictionary to save
+    """
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    pd.DataFrame({ORDER_ID: order_key_dictionary.to_numpy()}).to_feather(file_path)
+
+
+def load_order_key_dictionary(file_path: str) -> pd.Index:
+    """
+    Load an order key dictionary saved by save_order_key_dictionary
+    :param file_path: path to the feather file
+    :return: dictionary of the order keys
+    """
+    return pd.Index(pd.read_feather(file_path)[ORDER_ID], name=ORDER_ID)
@@ -0,0 +1,54 @@
+import pandas as pd
+
+from constants import *
+
+# Named aggregations producing the order summary from the columns of build_order_summary_events. Sign time is the
+# earliest and consign time the latest of their actions, for cleaned orders there is exactly one of each. The facility
+# count counts the distinct facilities of the sign actions, 1 for cleaned orders, as figure 3 has always used it.
+ORDER_SUMMARY_AGGREGATIONS = {
+    SIGN_COUNT: (SIGN_COUNT, SUM),
+    CONSIGN_COUNT: (CONSIGN_COUNT, SUM),
+    SHIPMENT_ACTION_COUNT: (SIGN_COUNT, 'size'),
+    SIGN_TIME: (SIGN_TIME, 'min'),
+    CONSIGN_TIME: (CONSIGN_TIME, 'max'),
+    FACILITY_COUNT: (FACILITY_ID, 'nunique'),
+    ARRIVE_COUNT: (ARRIVE_COUNT, SUM),
+    DEPART_COUNT: (DEPART_COUNT, SUM),
+    RECEIVE_COUNT: (RECEIVE_COUNT, SUM),
+    SCAN_COUNT: (SCAN_COUNT, SUM),
+}
+
+
+def build_order_summary_events(logistics_data_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Build the event level columns aggregated by ORDER_SUMMARY_AGGREGATIONS
+    :param logistics_data_df: dataframe containing logistics data with datetime timestamps
+    :return: dataframe with one row per event
+    """
+    actions = logistics_data_df[ACTION]
+    timestamps = logistics_data_df[TIMESTAMP_DATE_TIME]
+    is_signed = actions == SIGNED
+    is_consign = actions == CONSIGN
+    return pd.DataFrame({
+        ORDER_ID: logistics_data_df[ORDER_ID],
+        SIGN_COUNT: is_signed,
+        CONSIGN_COUNT: is_consign,
+        SIGN_TIME: timestamps.where(is_signed),
+        CONSIGN_TIME: timestamps.where(is_consign),
+        FACILITY_ID: logistics_data_df[FACILITY_ID].where(is_signed),
+        ARRIVE_COUNT: actions == ARRIVAL,
+        DEPART_COUNT: actions == DEPARTURE,
+        RECEIVE_COUNT: actions == GOT,
+        SCAN_COUNT: actions == SENT_SCAN,
+    })
+
+
+def compute_order_summary(logistics_data_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Compute the per-order event summary: sign and consign counts and timestamps, total action count, distinct facility
+    count of the sign actions and the counts of arrival, departure, got and sent scan actions
+    :param logistics_data_df: dataframe containing logistics data with datetime timestamps
+    :return: dataframe with one row per order
+    """
+    return build_order_summary_events(logistics_data_df).groupby(ORDER_ID).agg(
+        **ORDER_SUMMARY_AGGREGATIONS).reset_index()
@@ -0,0 +1,93 @@
+import glob
+import logging
+import os.path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from constants import *
+
+FEATHER = 'feather'
+PARQUET = 'parquet'
+# Directory under the cleaned data holding one partitioned parquet dataset per table
+PARQUET_DIR = 'parquet'
+PARQUET_ROW_GROUP_SIZE = 128 * 1024
+PARQUET_COMPRESSION = 'zstd'
+# Every pay date and logistic company pair may become a partition
+MAX_PARTITIONS = 1 << 16
+
+
+def get_parquet_dataset_dir(cleaned_dir: str, table_name: str) -> str:
+    """
+    Get the directory of the partitioned parquet dataset of a table
+    :param cleaned_dir: directory containing the cleaned data
+    :param table_name: name of the table, e.g. cleaned_logistics_detail
+    :return: path to the dataset
+    """
+    return os.path.join(cleaned_dir, PARQUET_DIR, table_name)
+
+
+def get_partition_columns(partition_by_company: bool) -> list:
+    """
+    Get the columns the parquet datasets are partitioned by
+    :param partition_by_company: whether to partition by logistic company below the pay date
+    :return: partition columns
+    """
+    return [PAY_DATE, LOGISTIC_COMPANY_ID] if partition_by_company else [PAY_DATE]
+
+
+def get_order_partition_keys(logistics_data_df: pd.DataFrame, order_data_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Get the partition keys of every order: the date of the earliest payment, and the logistic company shipping the
+    order, which is unique after cleaning
+    :param logistics_data_df: dataframe containing cleaned logistics data
+    :param order_data_df: dataframe containing cleaned order data
+    :return: dataframe indexed by order id with pay date and logistic company columns
+    """
+    pay_dates = order_data_df.groupby(ORDER_ID, sort=False)[PAY_TIMESTAMP_DATETIME].min().dt.strftime('%Y-%m-%d')
+    companies = logistics_data_df.groupby(ORDER_ID, sort=False)[LOGISTIC_COMPANY_ID].first()
+    return pd.DataFrame({PAY_DATE: pay_dates, LOGISTIC_COMPANY_ID: companies.reindex(pay_dates.index)})
+
+
+def get_shard_parquet_files(dataset_dir: str, index: int) -> list:
+    """
+    Get the files written by a shard into a parquet dataset
+    :param dataset_dir: directory of the dataset
+    :param index: index of the shard
+    :return: sorted paths to the files
+    """
+    return sorted(glob.glob(os.path.join(dataset_dir, '**', f'part-{index}-*.parquet'), recursive=True))
+
+
+def write_partitioned_parquet(df: pd.DataFrame, dataset_dir: str, partition_keys: pd.DataFrame,
+                              partition_columns: list, index: int) -> list:
+    """
+    Write the rows of a shard into a hive partitioned parquet dataset sorted by order id, so that the min/max
+    statistics of each row group can be used to skip row groups when filtering on order id. Files previously written
+    by the same shard are replaced, files of other shards are kept
+    :param df: dataframe to write, must have an order id column
+    :param dataset_dir: directory of the dataset
+    :param partition_keys: partition keys of every order, see get_order_partition_keys
+    :param partition_columns: columns to partition by
+    :param index: index of the shard, used to name the files
+    :return: paths to the files written
+    """
+    for file_path in get_shard_parquet_files(dataset_dir, index):
+        os.remove(file_path)
+
+    keys = partition_keys[[column for column in partition_columns if column not in df.columns]]
+    df = df.join(keys, on=ORDER_ID).sort_values(ORDER_ID, kind='stable')
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    del df
+    file_format = ds.ParquetFileFormat()
+    # Writing with threads may reorder the rows
+    ds.write_dataset(
+        table, dataset_dir, format=file_format,
+        file_options=file_format.make_write_options(compression=PARQUET_COMPRESSION, write_statistics=True),
+        partitioning=ds.partitioning(table.select(partition_columns).schema, flavor='hive'),
+        basename_template=f'part-{index}-{{i}}.parquet', existing_data_behavior='overwrite_or_ignore',
+        max_partitions=MAX_PARTITIONS, min_rows_per_group=PARQUET_ROW_GROUP_SIZE,
+        max_rows_per_group=PARQUET_ROW_GROUP_SIZE, use_threads=False)
+    logging.info(f'finished writing {table.num_rows} rows to {dataset_dir}')
+    return get_shard_parquet_files(dataset_dir, index)
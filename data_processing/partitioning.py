@@ -0,0 +1,109 @@
+import glob
+import logging
+import math
+import os.path
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from constants import *
+from .schema import concat_frames
+
+# Rough peak memory of cleaning a dataframe relative to the size of its csv file
+CSV_MEMORY_FACTOR = 4
+GB = 1024 ** 3
+
+
+def get_order_buckets(order_ids: pd.Series, bucket_count: int) -> np.ndarray:
+    """
+    Assign order ids to buckets by hashing them, the same order id always lands in the same bucket
+    :param order_ids: order ids to assign
+    :param bucket_count: number of buckets
+    :return: bucket of each order id
+    """
+    if pd.api.types.is_numeric_dtype(order_ids):
+        # Chunks with missing order ids are parsed as float, hash all numeric ids as float so that chunks agree
+        order_ids = order_ids.astype('float64')
+    return (pd.util.hash_pandas_object(order_ids, index=False).to_numpy() % bucket_count).astype(np.int64)
+
+
+def get_bucket_count(csv_paths: list, bucket_memory: float) -> int:
+    """
+    Get the number of buckets needed to keep the estimated memory of cleaning a bucket under the memory ceiling
+    :param csv_paths: paths to the csv files that will be partitioned
+    :param bucket_memory: memory ceiling of a bucket in GB
+    :return: number of buckets
+    """
+    estimated_memory = CSV_MEMORY_FACTOR * sum(os.path.getsize(csv_path) for csv_path in csv_paths)
+    return max(1, math.ceil(estimated_memory / (bucket_memory * GB)))
+
+
+def get_bucket_path(bucket_dir: str, bucket: int) -> str:
+    """
+    Get the path of the feather file of a bucket
+    :param bucket_dir: directory containing the buckets
+    :param bucket: index of the bucket
+    :return: path to the bucket
+    """
+    return os.path.join(bucket_dir, f'bucket_{bucket}.feather')
+
+
+def list_buckets(bucket_dir: str) -> list:
+    """
+    List the buckets written to a directory
+    :param bucket_dir: directory containing the buckets
+    :return: sorted indices of the buckets
+    """
+    bucket_paths = glob.glob(os.path.join(bucket_dir, 'bucket_*.feather'))
+    return sorted(int(os.path.basename(path)[len('bucket_'):-len('.feather')]) for path in bucket_paths)
+
+
+def read_bucket(bucket_dir: str, bucket: int) -> pd.DataFrame:
+    """
+    Read a bucket from drive
+    :param bucket_dir: directory containing the buckets
+    :param bucket: index of the bucket
+    :return: dataframe containing the rows of the bucket
+    """
+    return pd.read_feather(get_bucket_path(bucket_dir, bucket))
+
+
+def partition_csv(csv_path: str, column_names: list, bucket_dir: str, bucket_count: int, chunk_size: int,
+                  apply_schema=None):
+    """
+    Stream a csv file in chunks and hash-partition its rows by order id into feather buckets, so that every order
+    ends up in exactly one bucket and no more than one chunk is held in memory while reading
+    :param csv_path: path to the csv file
+    :param column_names: column names of the csv file
+    :param bucket_dir: directory to write the buckets in
+    :param bucket_count: number of buckets
+    :param chunk_size: number of rows read at a time
+    :param apply_schema: function converting each chunk to the typed schema, e.g. apply_logistics_schema
+    """
+    logging.info(f'started partitioning {csv_path} into {bucket_count} buckets')
+    part_dirs = [os.path.join(bucket_dir, f'bucket_{bucket}_parts') for bucket in range(bucket_count)]
+    for part_dir in part_dirs:
+        os.makedirs(part_dir, exist_ok=True)
+
+    chunk_count = 0
+    for chunk in pd.read_csv(csv_path, names=column_names, chunksize=chunk_size):
+        if apply_schema is not None:
+            chunk = apply_schema(chunk)
+        buckets = get_order_buckets(chunk[ORDER_ID], bucket_count)
+        for bucket, bucket_df in chunk.groupby(buckets, sort=False):
+            bucket_df.reset_index(drop=True).to_feather(
+                os.path.join(part_dirs[bucket], f'part_{chunk_count}.feather'))
+        chunk_count += 1
+        logging.info(f'partitioned {chunk_count} chunks of {csv_path}')
+
+    # Compact the parts of each bucket into a single file, keeping the order of the rows in the csv file
+    for bucket, part_dir in enumerate(part_dirs):
+        part_paths = [os.path.join(part_dir, f'part_{chunk_index}.feather') for chunk_index in range(chunk_count)]
+        parts = [pd.read_feather(part_path) for part_path in part_paths if os.path.exists(part_path)]
+        bucket_df = concat_frames(parts, ignore_index=True) if parts else pd.DataFrame(columns=column_names)
+        if apply_schema is not None:
+            bucket_df = apply_schema(bucket_df)
+        bucket_df.to_feather(get_bucket_path(bucket_dir, bucket))
+        shutil.rmtree(part_dir)
+    logging.info(f'finished partitioning {csv_path}')
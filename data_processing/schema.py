@@ -0,0 +1,291 @@
+import logging
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from constants import *
+
+# Columns of the raw csv files
+LOGISTICS_COLUMN_NAMES = [ORDER_ID, ORDER_DATE, LOGISTICS_ORDER_ID, ACTION, FACILITY_ID, FACILITY_TYPE, CITY_ID,
+                          LOGISTIC_COMPANY_ID, TIMESTAMP]
+ORDER_COLUMN_NAMES = [DAY, ORDER_ID, ITEM_DETAIL_INFO, PAY_TIMESTAMP, BUYER_ID, PROMISE_SPEED, IF_CAINIAO, MERCHANT_ID,
+                      LOGISTICS_REVIEW_SCORE]
+ITEM_COLUMN_NAMES = [DATE, ITEM_ID, FRONT_PAGE_ITEM_ID, MERCHANT_ID, BRAND_ID, CATEGORY_ID, SUB_CATEGORY_ID, PC_PV, APP_PV,
+                     PC_UV, APP_UV, IF_CAINIAO]
+SELLER_COLUMN_NAMES = [DAY, MERCHANT_ID, SUBCATEGORY_ID, PC_PV, PC_UV, APP_PV, APP_UV, AVG_LOGISTIC_REVIEW_SCORE,
+                       AVG_ORDER_QUALITY_SCORE, AVG_SERVICE_QUALITY_SCORE, IF_CAINIAO]
+INVENTORY_COLUMN_NAMES = [DAY, ITEM_ID, WAREHOUSE_ID, WAREHOUSE_CITY_ID, TOTAL_BEGIN_QTY, TOTAL_END_QTY, REPLEN_IN_QTY,
+                          TRANSFER_IN_QTY, SALE_OUT_QTY, TRANSFER_OUT_QTY]
+
+ACTION_DTYPE = pd.CategoricalDtype([CONSIGN, GOT, DEPARTURE, ARRIVAL, SENT_SCAN, SIGNED, FAILURE, TRADE_SUCCESS])
+LOGISTICS_CATEGORY_DTYPES = {ORDER_DATE: 'category', ACTION: ACTION_DTYPE, FACILITY_TYPE: 'category'}
+ORDER_CATEGORY_DTYPES = {DAY: 'category'}
+LOGISTICS_ID_COLUMNS = [ORDER_ID, LOGISTICS_ORDER_ID, FACILITY_ID, CITY_ID, LOGISTIC_COMPANY_ID]
+ORDER_ID_COLUMNS = [ORDER_ID, BUYER_ID, MERCHANT_ID]
+# Stored as int8, or float32 while they still contain missing values
+ORDER_SMALL_INTEGER_COLUMNS = [PROMISE_SPEED, IF_CAINIAO, LOGISTICS_REVIEW_SCORE]
+# Page views and visitors, downcast like the ids
+TRAFFIC_COLUMNS = [PC_PV, APP_PV, PC_UV, APP_UV]
+ITEM_ID_COLUMNS = [ITEM_ID, FRONT_PAGE_ITEM_ID, MERCHANT_ID, BRAND_ID, CATEGORY_ID, SUB_CATEGORY_ID] + TRAFFIC_COLUMNS
+SELLER_ID_COLUMNS = [MERCHANT_ID, SUBCATEGORY_ID] + TRAFFIC_COLUMNS
+SELLER_SCORE_COLUMNS = [AVG_LOGISTIC_REVIEW_SCORE, AVG_ORDER_QUALITY_SCORE, AVG_SERVICE_QUALITY_SCORE]
+INVENTORY_QUANTITY_COLUMNS = [TOTAL_BEGIN_QTY, TOTAL_END_QTY, REPLEN_IN_QTY, TRANSFER_IN_QTY, SALE_OUT_QTY,
+                              TRANSFER_OUT_QTY]
+INVENTORY_ID_COLUMNS = [ITEM_ID, WAREHOUSE_ID, WAREHOUSE_CITY_ID] + INVENTORY_QUANTITY_COLUMNS
+# The days of the item, seller and inventory data are categorical like the days of the order data
+ITEM_CATEGORY_DTYPES = {DATE: 'category'}
+# Parsed from the item detail info, downcast like the ids
+ORDER_ITEM_COLUMNS = [ITEM_ID, ITEM_COUNT, ITEM_QUANTITY]
+# First item of the item detail info, the item id and its quantity
+ITEM_DETAIL_PATTERN = r'^(?P<item_id>\d+):(?P<item_quantity>\d+)'
+
+
+def parse_timestamps(timestamps: pd.Series) -> tuple:
+    """
+    Parse timestamp strings in TIMESTAMP_FORMAT into datetime, invalid timestamps become NaT
+    :param timestamps: series of timestamp strings
+    :return: series of datetime and series flagging the timestamps that were present but could not be parsed
+    """
+    parsed_timestamps = pd.to_datetime(timestamps, format=TIMESTAMP_FORMAT, errors='coerce')
+    return parsed_timestamps, timestamps.notna() & parsed_timestamps.isna()
+
+
+def parse_item_details(item_details: pd.Series) -> tuple:
+    """
+    Parse item detail info strings, comma separated lists of item_id:quantity, with vectorized arrow string kernels
+    :param item_details: series of item detail info strings
+    :return: series of the id of the first item, the number of items and the quantity of the first item, missing if
+        the item detail info is missing or does not start with item_id:quantity
+    """
+    details = pa.array(item_details.to_numpy(object, na_value=None), type=pa.string())
+    first_items = pc.extract_regex(details, ITEM_DETAIL_PATTERN)
+    item_counts = pc.add(pc.count_substring(details, ','), 1)
+    return tuple(pd.Series(column.to_numpy(zero_copy_only=False), index=item_details.index) for column in [
+        pc.cast(pc.struct_field(first_items, 'item_id'), pa.int64()), item_counts,
+        pc.cast(pc.struct_field(first_items, 'item_quantity'), pa.int64())])
+
+
+def _set_categories(df: pd.DataFrame, category_dtypes: dict):
+    for column, dtype in category_dtypes.items():
+        if column not in df.columns:
+            continue
+        if isinstance(dtype, pd.CategoricalDtype):
+            # Unordered categoricals compare equal regardless of the order of their categories
+            if isinstance(df[column].dtype, pd.CategoricalDtype) and df[column].cat.categories.equals(
+                    dtype.categories):
+                continue
+            unknown_values = set(df[column].dropna().unique()) - set(dtype.categories)
+            if unknown_values:
+                logging.warning(f'unknown values in {column} are stored as missing: {unknown_values}')
+            if isinstance(df[column].dtype, pd.CategoricalDtype):
+                # astype keeps the order of the current categories when the sets are equal
+                df[column] = df[column].cat.set_categories(dtype.categories)
+                continue
+        elif isinstance(df[column].dtype, pd.CategoricalDtype):
+            # Keep the categories sorted, concatenating or unifying dictionaries appends the new categories at the end
+            if not df[column].cat.categories.is_monotonic_increasing:
+                df[column] = df[column].cat.reorder_categories(df[column].cat.categories.sort_values())
+            continue
+        df[column] = df[column].astype(dtype)
+
+
+def _downcast_ids(df: pd.DataFrame, id_columns: list):
+    for column in id_columns:
+        if column not in df.columns or not pd.api.types.is_integer_dtype(df[column]):
+            continue
+        downcast_ids = pd.to_numeric(df[column], downcast='integer')
+        if downcast_ids.dtype != df[column].dtype:
+            df[column] = downcast_ids
+
+
+def _downcast_floats(df: pd.DataFrame, float_columns: list):
+    for column in float_columns:
+        if column in df.columns and pd.api.types.is_float_dtype(df[column]) and df[column].dtype != np.float32:
+            df[column] = df[column].astype(np.float32)
+
+
+def _downcast_small_integers(df: pd.DataFrame, small_integer_columns: list):
+    for column in small_integer_columns:
+        if column not in df.columns or not pd.api.types.is_numeric_dtype(df[column]):
+            continue
+        dtype = np.float32 if df[column].isnull().any() else np.int8
+        if df[column].dtype != dtype:
+            df[column] = df[column].astype(dtype)
+
+
+def apply_logistics_schema(logistics_data_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Convert logistics data to the compact typed schema in place: categorical action, facility type and order date,
+    downcast integer ids and the timestamp parsed into datetime, with unparseable timestamps flagged. Converting
+    typed data again is a no-op
+    :param logistics_data_df: dataframe containing logistics data
+    :return: the converted dataframe
+    """
+    _set_categories(logistics_data_df, LOGISTICS_CATEGORY_DTYPES)
+    _downcast_ids(logistics_data_df, LOGISTICS_ID_COLUMNS)
+    if TIMESTAMP_DATE_TIME not in logistics_data_df.columns and TIMESTAMP in logistics_data_df.columns:
+        logistics_data_df[TIMESTAMP_DATE_TIME], logistics_data_df[TIMESTAMP_INVALID] = parse_timestamps(
+            logistics_data_df[TIMESTAMP])
+    if TIMESTAMP in logistics_data_df.columns:
+        del logistics_data_df[TIMESTAMP]
+    return logistics_data_df
+
+
+def apply_order_schema(order_data_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Convert order data to the compact typed schema in place: categorical day, downcast integer ids, int8 promise
+    speed, cainiao flag and review score, the item detail info parsed into the item id, item count and quantity, and
+    the payment timestamp parsed into datetime, with unparseable timestamps flagged. Converting typed data again is a
+    no-op
+    :param order_data_df: dataframe containing order data
+    :return: the converted dataframe
+    """
+    _set_categories(order_data_df, ORDER_CATEGORY_DTYPES)
+    _downcast_ids(order_data_df, ORDER_ID_COLUMNS)
+    _downcast_small_integers(order_data_df, ORDER_SMALL_INTEGER_COLUMNS)
+    if ITEM_ID not in order_data_df.columns and ITEM_DETAIL_INFO in order_data_df.columns:
+        order_data_df[ITEM_ID], order_data_df[ITEM_COUNT], order_data_df[ITEM_QUANTITY] = parse_item_details(
+            order_data_df[ITEM_DETAIL_INFO])
+    _downcast_ids(order_data_df, ORDER_ITEM_COLUMNS)
+    if PAY_TIMESTAMP_DATETIME not in order_data_df.columns and PAY_TIMESTAMP in order_data_df.columns:
+        order_data_df[PAY_TIMESTAMP_DATETIME], order_data_df[PAY_TIMESTAMP_INVALID] = parse_timestamps(
+            order_data_df[PAY_TIMESTAMP])
+    if PAY_TIMESTAMP in order_data_df.columns:
+        del order_data_df[PAY_TIMESTAMP]
+    return order_data_df
+
+
+def apply_item_schema(item_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Convert item data to the compact typed schema in place: categorical date, downcast ids and traffic counts and
+    int8 cainiao flag. Converting typed data again is a no-op
+    :param item_df: dataframe containing item data
+    :return: the converted dataframe
+    """
+    _set_categories(item_df, ITEM_CATEGORY_DTYPES)
+    _downcast_ids(item_df, ITEM_ID_COLUMNS)
+    _downcast_small_integers(item_df, [IF_CAINIAO])
+    return item_df
+
+
+def apply_seller_schema(seller_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Convert seller data to the compact typed schema in place: categorical day, downcast ids and traffic counts,
+    float32 average scores and int8 cainiao flag. Converting typed data again is a no-op
+    :param seller_df: dataframe containing seller data
+    :return: the converted dataframe
+    """
+    _set_categories(seller_df, ORDER_CATEGORY_DTYPES)
+    _downcast_ids(seller_df, SELLER_ID_COLUMNS)
+    _downcast_floats(seller_df, SELLER_SCORE_COLUMNS)
+    _downcast_small_integers(seller_df, [IF_CAINIAO])
+    return seller_df
+
+
+def apply_inventory_schema(inventory_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Convert inventory data to the compact typed schema in place: categorical day and downcast ids and quantities.
+    Converting typed data again is a no-op
+    :param inventory_df: dataframe containing inventory data
+    :return: the converted dataframe
+    """
+    _set_categories(inventory_df, ORDER_CATEGORY_DTYPES)
+    _downcast_ids(inventory_df, INVENTORY_ID_COLUMNS)
+    return inventory_df
+
+
+def read_logistics_csv(file_path: str) -> pd.DataFrame:
+    """
+    Read a logistics detail csv file into the typed schema
+    :param file_path: path to the csv file
+    :return: dataframe containing logistics data
+    """
+    return apply_logistics_schema(pd.read_csv(
+        file_path, names=LOGISTICS_COLUMN_NAMES, dtype={column: 'category' for column in LOGISTICS_CATEGORY_DTYPES}))
+
+
+def read_logistics_csv_excluding_orders(file_path: str, excluded_order_ids: pd.Index,
+                                        chunk_size: int) -> (pd.DataFrame, pd.Series):
+    """
+    Read a logistics detail csv file into the typed schema chunk by chunk, the events of the excluded orders are
+    dropped from every chunk before its timestamps are parsed. The rows keep their line numbers as index, as if the
+    whole file was read and filtered
+    :param file_path: path to the csv file
+    :param excluded_order_ids: order ids whose events are skipped, NaN skips the events without an order id
+    :param chunk_size: number of rows read at a time
+    :return: dataframe containing logistics data of the other orders and the number of events skipped of every
+        excluded order with events, by order id
+    """
+    chunks = []
+    skipped_events = []
+    for chunk in pd.read_csv(file_path, names=LOGISTICS_COLUMN_NAMES, chunksize=chunk_size,
+                             dtype={column: 'category' for column in LOGISTICS_CATEGORY_DTYPES}):
+        is_excluded = chunk[ORDER_ID].isin(excluded_order_ids).to_numpy()
+        skipped_events.append(chunk.loc[is_excluded, ORDER_ID].value_counts(dropna=False))
+        # take gives a new frame rather than a slice of the chunk, so the schema can be applied to it in place
+        chunks.append(apply_logistics_schema(chunk.take(np.flatnonzero(~is_excluded))))
+    skipped_events = pd.concat(skipped_events).groupby(level=0, dropna=False).sum()
+    logging.info(f'skipped {skipped_events.sum()} events of {len(excluded_order_ids)} excluded orders in {file_path}')
+    return apply_logistics_schema(concat_frames(chunks)), skipped_events
+
+
+def read_order_csv(file_path: str) -> pd.DataFrame:
+    """
+    Read an order data csv file into the typed schema
+    :param file_path: path to the csv file
+    :return: dataframe containing order data
+    """
+    return apply_order_schema(pd.read_csv(
+        file_path, names=ORDER_COLUMN_NAMES, dtype={column: 'category' for column in ORDER_CATEGORY_DTYPES}))
+
+
+def read_item_csv(file_path: str) -> pd.DataFrame:
+    """
+    Read an item data csv file into the typed schema
+    :param file_path: path to the csv file
+    :return: dataframe containing item data
+    """
+    return apply_item_schema(pd.read_csv(
+        file_path, names=ITEM_COLUMN_NAMES, dtype={column: 'category' for column in ITEM_CATEGORY_DTYPES}))
+
+
+def read_seller_csv(file_path: str) -> pd.DataFrame:
+    """
+    Read a seller data csv file into the typed schema
+    :param file_path: path to the csv file
+    :return: dataframe containing seller data
+    """
+    return apply_seller_schema(pd.read_csv(
+        file_path, names=SELLER_COLUMN_NAMES, dtype={column: 'category' for column in ORDER_CATEGORY_DTYPES}))
+
+
+def read_inventory_csv(file_path: str) -> pd.DataFrame:
+    """
+    Read an inventory data csv file into the typed schema
+    :param file_path: path to the csv file
+    :return: dataframe containing inventory data
+    """
+    return apply_inventory_schema(pd.read_csv(
+        file_path, names=INVENTORY_COLUMN_NAMES, dtype={column: 'category' for column in ORDER_CATEGORY_DTYPES}))
+
+
+def concat_frames(frames: list, ignore_index: bool = False) -> pd.DataFrame:
+    """
+    Concatenate dataframes keeping categorical columns categorical, pd.concat falls back to object strings when the
+    categories of the frames differ. The categories of the given frames are unified in place
+    :param frames: dataframes to concatenate
+    :param ignore_index: whether to reset the index of the result
+    :return: concatenated dataframe
+    """
+    for column in frames[0].columns:
+        if not all(isinstance(frame[column].dtype, pd.CategoricalDtype) for frame in frames):
+            continue
+        categories = frames[0][column].cat.categories
+        for frame in frames[1:]:
+            categories = categories.union(frame[column].cat.categories)
+        for frame in frames:
+            if not frame[column].cat.categories.equals(categories):
+                frame[column] = frame[column].cat.set_categories(categories)
+    return pd.concat(frames, ignore_index=ignore_index)
@@ -0,0 +1,269 @@
+import logging
+import os.path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as csv
+
+from constants import *
+from .schema import ACTION_DTYPE, ITEM_COLUMN_NAMES, LOGISTICS_COLUMN_NAMES, ORDER_COLUMN_NAMES
+
+SYNTHETIC_START_DATE = pd.Timestamp('2017-03-01')
+SYNTHETIC_DAY_COUNT = 120
+# Seconds between the payment and the consign action, and mean seconds between two actions of a shipment
+MAX_CONSIGN_DELAY = 3 * 24 * 3600
+MEAN_ACTION_GAP = 10 * 3600
+ORDER_ID_BASE = 1_000_000_000_000
+LOGISTICS_ORDER_ID_BASE = 2_000_000_000_000
+# Distance between the first order ids of consecutive shards, so that shards never share an order id
+SHARD_ORDER_ID_STRIDE = 100_000_000_000
+FACILITY_TYPES = ['a', 'b', 'c', 'd']
+FACILITY_COUNT = 5_000
+# Share of actions happening at the facility of the previous action, e.g. an arrival followed by a departure
+SAME_FACILITY_RATE = 0.3
+# Actions between GOT and SENT_SCAN and their probabilities
+TRANSIT_ACTIONS = [DEPARTURE, ARRIVAL, GOT, SENT_SCAN]
+TRANSIT_ACTION_PROBABILITIES = [0.45, 0.45, 0.05, 0.05]
+CITY_COUNT = 400
+LOGISTIC_COMPANY_COUNT = 20
+MERCHANT_COUNT = 2_000
+# Number of orders per item, brand and category popularity is skewed so that rare levels are collapsed by the analyses
+ORDERS_PER_ITEM = 20
+REVIEW_SCORE_PROBABILITIES = [0.03, 0.03, 0.08, 0.2, 0.66]
+# Share of orders with the defect removed by each cleaning rule, the defects are drawn independently
+DEFAULT_DEFECT_RATES = {
+    'remove_not_cainiao': 0.05,
+    'remove_without_shipment_score': 0.05,
+    'remove_trade_success_actions': 0.03,
+    'drop_duplicates': 0.03,
+    'remove_failed_delivery': 0.02,
+    'remove_without_shipment_times': 0.01,
+    'convert_timestamp_to_datetime': 0.01,
+    'remove_with_action_before_order': 0.01,
+    'remove_without_exactly_one_sign_action': 0.03,
+    'remove_without_exactly_one_consign_action': 0.03,
+    'remove_with_action_after_sign': 0.02,
+    'remove_without_slowest_shipping_speed': 0.05,
+    'remove_with_multiple_shippers': 0.02,
+    'remove_with_multiple_product_types': 0.05,
+    'remove_shipment_time_more_than_eight_days': 0.05,
+    'remove_more_than_ten_actions': 0.03,
+    'remove_less_than_four_actions': 0.03,
+}
+
+
+def _get_action_codes(positions: np.ndarray, last_positions: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    # CONSIGN -> GOT -> mostly DEPARTURE and ARRIVAL -> SENT_SCAN -> SIGNED
+    transit_codes = rng.choice([ACTION_DTYPE.categories.get_loc(action) for action in TRANSIT_ACTIONS],
+                               positions.shape[0], p=TRANSIT_ACTION_PROBABILITIES)
+    action_codes = np.select(
+        [positions == 0, positions == last_positions, positions == 1, positions == last_positions - 1],
+        [ACTION_DTYPE.categories.get_loc(action) for action in (CONSIGN, SIGNED, GOT, SENT_SCAN)], transit_codes)
+    return action_codes.astype(np.int8)
+
+
+def _set_action(action_codes: np.ndarray, is_row: np.ndarray, action: str):
+    action_codes[is_row] = ACTION_DTYPE.categories.get_loc(action)
+
+
+def get_synthetic_item_count(event_count: int) -> int:
+    """
+    :param event_count: approximate number of logistics events
+    :return: number of items ordered by the orders of that many events
+    """
+    return max(int(event_count / (MIN_SHIPMENT_ACTIONS + MAX_SHIPMENT_ACTIONS) * 2 / ORDERS_PER_ITEM), 1)
+
+
+def generate_synthetic_data(event_count: int, seed: int = 0, defect_rates: dict = None,
+                            item_df: pd.DataFrame = None, order_id_offset: int = 0) -> tuple:
+    """
+    Generate seeded synthetic logistics, order and item data in the raw schema of the msom files. Every shipment
+    follows CONSIGN -> GOT -> DEPARTURE/ARRIVAL -> SENT_SCAN -> SIGNED with four to ten actions, and a share of the
+    orders gets the defect targeted by each cleaning rule. Timestamps before day one stand in for the timestamps that
+    can't be converted, the generated timestamps are never malformed
+    :param event_count: approximate number of logistics events to generate
+    :param seed: seed of the random generator, the same seed and arguments always generate the same data
+    :param defect_rates: share of orders with the defect removed by each cleaning rule, see DEFAULT_DEFECT_RATES.
+        Rules that are not given use the default rate
+    :param item_df: items the orders are drawn from, see generate_synthetic_items, generated from the seed if None
+    :param order_id_offset: added to the order and logistics order ids, e.g. to keep the ids of shards apart
+    :return: logistics detail, order data and item data dataframes
+    """
+    rng = np.random.default_rng(seed)
+    defect_rates = {**DEFAULT_DEFECT_RATES, **(defect_rates or {})}
+    if item_df is None:
+        item_df = generate_synthetic_items(get_synthetic_item_count(event_count), rng)
+    mean_action_count = (MIN_SHIPMENT_ACTIONS + MAX_SHIPMENT_ACTIONS) / 2
+    order_count = max(int(event_count / mean_action_count), 1)
+    logging.info(f'started generating {order_count} synthetic orders with seed {seed}')
+    defects = {rule: rng.random(order_count) < rate for rule, rate in defect_rates.items()}
+
+    # Orders
+    order_ids = ORDER_ID_BASE + order_id_offset + np.cumsum(rng.integers(1, 1_000, order_count))
+    order_ids = rng.permutation(order_ids)
+    pay_seconds = rng.integers(0, SYNTHETIC_DAY_COUNT * 24 * 3600, order_count)
+    pay_timestamps = SYNTHETIC_START_DATE + pd.to_timedelta(pay_seconds, unit='s')
+    dates = pd.date_range(SYNTHETIC_START_DATE, periods=SYNTHETIC_DAY_COUNT).strftime('%Y-%m-%d')
+    pay_days = pay_seconds // (24 * 3600)
+
+    item_count = item_df.shape[0]
+    item_ids = rng.zipf(1.3, order_count) % item_count + 1
+    item_details = pd.Series(item_ids).astype(str) + ':' + pd.Series(rng.integers(1, 4, order_count)).astype(str)
+    multiple_items = defects['remove_with_multiple_product_types']
+    item_details[multiple_items] += ',' + pd.Series(
+        rng.integers(1, item_count + 1, order_count)[multiple_items], index=np.flatnonzero(multiple_items)).astype(str) \
+        + ':1'
+    # Merchant of every item by item id
+    item_merchants = np.concatenate([[0], item_df[MERCHANT_ID].to_numpy()])
+    review_scores = rng.choice(np.arange(1, 6), order_count, p=REVIEW_SCORE_PROBABILITIES).astype(float)
+    review_scores[defects['remove_without_shipment_score']] = np.nan
+    order_data_df = pd.DataFrame({
+        DAY: pd.Categorical.from_codes(pay_days, categories=dates),
+        ORDER_ID: order_ids,
+        ITEM_DETAIL_INFO: item_details,
+        PAY_TIMESTAMP: pay_timestamps,
+        BUYER_ID: rng.integers(1, order_count * 2, order_count),
+        PROMISE_SPEED: np.where(defects['remove_without_slowest_shipping_speed'], 0, rng.integers(1, 4, order_count)),
+        IF_CAINIAO: np.where(defects['remove_not_cainiao'], 0, 1),
+        MERCHANT_ID: item_merchants[item_ids],
+        LOGISTICS_REVIEW_SCORE: review_scores,
+    }, columns=ORDER_COLUMN_NAMES)
+
+    # Number of actions of each shipment, followed by a trade success and an action after the sign action
+    action_counts = rng.integers(MIN_SHIPMENT_ACTIONS, MAX_SHIPMENT_ACTIONS + 1, order_count)
+    too_many = defects['remove_more_than_ten_actions']
+    action_counts[too_many] = rng.integers(MAX_SHIPMENT_ACTIONS + 1, MAX_SHIPMENT_ACTIONS + 5, too_many.sum())
+    too_few = defects['remove_less_than_four_actions']
+    action_counts[too_few] = rng.integers(2, MIN_SHIPMENT_ACTIONS, too_few.sum())
+    extra_counts = (defects['remove_trade_success_actions'].astype(np.int64)
+                    + defects['remove_with_action_after_sign'])
+    row_counts = action_counts + extra_counts
+
+    # Events, one row per action of every order
+    order_indices = np.repeat(np.arange(order_count), row_counts)
+    starts = np.cumsum(row_counts) - row_counts
+    positions = np.arange(order_indices.shape[0]) - np.repeat(starts, row_counts)
+    last_positions = np.repeat(action_counts - 1, row_counts)
+    action_codes = _get_action_codes(positions, last_positions, rng)
+    is_extra = positions > last_positions
+    is_trade_success = is_extra & (positions == last_positions + 1) & defects['remove_trade_success_actions'][
+        order_indices]
+    _set_action(action_codes, is_trade_success, TRADE_SUCCESS)
+    _set_action(action_codes, is_extra & ~is_trade_success, ARRIVAL)
+    is_order_defect = {rule: flags[order_indices] for rule, flags in defects.items()}
+    _set_action(action_codes, (positions == last_positions) & is_order_defect['remove_failed_delivery'], FAILURE)
+    _set_action(action_codes, (positions == last_positions) & is_order_defect[
+        'remove_without_exactly_one_sign_action'], ARRIVAL)
+    _set_action(action_codes, (positions == 0) & is_order_defect['remove_without_exactly_one_consign_action'], GOT)
+
+    # Timestamps increase along each shipment starting from the consign action
+    consign_delays = rng.integers(3_600, MAX_CONSIGN_DELAY, order_count)
+    consign_delays[defects['remove_shipment_time_more_than_eight_days']] += (MAX_SHIPMENT_DAYS + 1) * 24 * 3600
+    consign_delays[defects['remove_with_action_before_order']] = -3_600
+    gaps = rng.exponential(MEAN_ACTION_GAP, order_indices.shape[0]).astype(np.int64) + 1
+    gaps[starts] = consign_delays
+    offsets = np.cumsum(gaps)
+    offsets -= np.repeat(offsets[starts] - consign_delays, row_counts)
+    timestamps = pay_timestamps[order_indices] + pd.to_timedelta(offsets, unit='s')
+    timestamps = pd.Series(timestamps)
+    timestamps[(positions == 1) & is_order_defect['remove_without_shipment_times']] = pd.NaT
+    timestamps[(positions == 1) & is_order_defect['convert_timestamp_to_datetime']] = DAY_ONE - pd.Timedelta(days=1)
+
+    facility_ids = rng.integers(1, FACILITY_COUNT + 1, order_indices.shape[0])
+    same_facility = np.flatnonzero((positions > 0) & (rng.random(order_indices.shape[0]) < SAME_FACILITY_RATE))
+    facility_ids[same_facility] = facility_ids[same_facility - 1]
+    companies = rng.integers(1, LOGISTIC_COMPANY_COUNT + 1, order_count)[order_indices]
+    companies[(positions == last_positions) & is_order_defect['remove_with_multiple_shippers']] += 1
+    logistics_data_df = pd.DataFrame({
+        ORDER_ID: order_ids[order_indices],
+        ORDER_DATE: pd.Categorical.from_codes(pay_days[order_indices], categories=dates),
+        LOGISTICS_ORDER_ID: LOGISTICS_ORDER_ID_BASE + order_id_offset + order_indices,
+        ACTION: pd.Categorical.from_codes(action_codes, dtype=ACTION_DTYPE),
+        FACILITY_ID: facility_ids,
+        FACILITY_TYPE: pd.Categorical.from_codes(rng.integers(0, len(FACILITY_TYPES), order_indices.shape[0]),
+                                                 categories=FACILITY_TYPES),
+        CITY_ID: rng.integers(1, CITY_COUNT + 1, order_indices.shape[0]),
+        LOGISTIC_COMPANY_ID: companies,
+        TIMESTAMP: timestamps,
+    }, columns=LOGISTICS_COLUMN_NAMES)
+
+    # Duplicate the second action and the order row of some orders
+    duplicates = defects['drop_duplicates']
+    duplicate_rows = np.flatnonzero((positions == 1) & is_order_defect['drop_duplicates'])
+    logistics_data_df = pd.concat([logistics_data_df, logistics_data_df.iloc[duplicate_rows]])
+    logistics_data_df = logistics_data_df.iloc[np.argsort(
+        np.concatenate([order_indices, order_indices[duplicate_rows]]), kind='stable')].reset_index(drop=True)
+    order_data_df = pd.concat([order_data_df, order_data_df[duplicates]]).sort_index(kind='stable').reset_index(
+        drop=True)
+
+    logging.info(f'finished generating {logistics_data_df.shape[0]} synthetic events')
+    return logistics_data_df, order_data_df, item_df
+
+
+def generate_synthetic_items(item_count: int, rng: np.random.Generator) -> pd.DataFrame:
+    """
+    Generate synthetic item data in the raw schema of the msom item file, with one row per item. Brands and
+    categories are drawn from a skewed distribution so that most of them are rare
+    :param item_count: number of items, the item ids are 1 to item_count
+    :param rng: random generator
+    :return: dataframe containing item data
+    """
+    item_ids = np.arange(1, item_count + 1)
+    category_ids = rng.zipf(1.5, item_count) % 200
+    return pd.DataFrame({
+        DATE: SYNTHETIC_START_DATE.strftime('%Y-%m-%d'),
+        ITEM_ID: item_ids,
+        FRONT_PAGE_ITEM_ID: item_ids,
+        MERCHANT_ID: rng.integers(1, MERCHANT_COUNT + 1, item_count),
+        BRAND_ID: rng.zipf(1.5, item_count) % 1_000,
+        CATEGORY_ID: category_ids,
+        SUB_CATEGORY_ID: category_ids * 10 + rng.integers(0, 10, item_count),
+        PC_PV: rng.poisson(50, item_count),
+        APP_PV: rng.poisson(200, item_count),
+        PC_UV: rng.poisson(20, item_count),
+        APP_UV: rng.poisson(80, item_count),
+        IF_CAINIAO: rng.integers(0, 2, item_count),
+    }, columns=ITEM_COLUMN_NAMES)
+
+
+def write_csv(df: pd.DataFrame, file_path: str):
+    """
+    Write a dataframe as a csv file without header in the format of the msom files, timestamps are written with
+    TIMESTAMP_FORMAT
+    :param df: dataframe to write
+    :param file_path: path to the csv file
+    """
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    for column_index, field in enumerate(table.schema):
+        if pa.types.is_timestamp(field.type):
+            table = table.set_column(column_index, field.name, table.column(column_index).cast(pa.timestamp('s')))
+    csv.write_csv(table, file_path, csv.WriteOptions(include_header=False))
+
+
+def write_synthetic_dataset(root_dir: str, event_count: int, indices: list, seed: int = 0,
+                            defect_rates: dict = None) -> dict:
+    """
+    Write a synthetic dataset laid out like the msom data: a logistics detail and an order data csv file per shard, and
+    the item data shared by the shards in data_8. Each shard is generated with its own seed so shards can be written
+    one at a time whatever the total size
+    :param root_dir: directory to write the dataset in
+    :param event_count: approximate number of logistics events of every shard
+    :param indices: indices of the shards
+    :param seed: seed of the first shard, shard i uses seed + i and order ids starting at i * SHARD_ORDER_ID_STRIDE
+    :param defect_rates: share of orders with the defect removed by each cleaning rule, see DEFAULT_DEFECT_RATES
+    :return: number of logistics events written for every shard index
+    """
+    item_df = generate_synthetic_items(get_synthetic_item_count(event_count), np.random.default_rng(seed))
+    event_counts = {}
+    for index in indices:
+        logistics_data_df, order_data_df, _ = generate_synthetic_data(
+            event_count, seed + index, defect_rates, item_df, index * SHARD_ORDER_ID_STRIDE)
+        os.makedirs(os.path.join(root_dir, f'data_{index}'), exist_ok=True)
+        write_csv(logistics_data_df, os.path.join(root_dir, f'data_{index}', f'msom_logistic_detail_{index}.csv'))
+        write_csv(order_data_df, os.path.join(root_dir, f'data_{index}', f'msom_order_data_{index}.csv'))
+        event_counts[index] = logistics_data_df.shape[0]
+        del logistics_data_df, order_data_df
+    os.makedirs(os.path.join(root_dir, 'data_8'), exist_ok=True)
+    write_csv(item_df, os.path.join(root_dir, 'data_8', 'msom_item_data.csv'))
+    return event_counts
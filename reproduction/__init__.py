@@ -1 +1,4 @@
+from .batched_ols import *
 from .data_processing_helper import *
+from .pipeline import *
+from .regression_cache import *
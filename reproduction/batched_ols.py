@@ -0,0 +1,149 @@
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+# Name statsmodels add_constant gives the constant regressor
+CONSTANT = 'const'
+
+
+def build_design_matrix(df: pd.DataFrame, columns: list) -> np.ndarray:
+    """
+    Gather numeric columns into one float64 matrix, allocated once and filled column by column
+    :param df: dataframe with the columns
+    :param columns: columns of the matrix, CONSTANT is a column of ones unless df has such a column
+    :return: matrix with one row per row of df and one column per column
+    """
+    matrix = np.empty((df.shape[0], len(columns)))
+    for index, column in enumerate(columns):
+        matrix[:, index] = 1 if column == CONSTANT and column not in df.columns else np.asarray(
+            df[column], dtype=np.float64)
+    return matrix
+
+
+def get_cell_codes(df: pd.DataFrame, cell_columns: list, cell_values: list) -> np.ndarray:
+    """
+    Assign every row to a regression cell, a cell is one combination of values of the cell columns. Values are matched
+    with ==, as when filtering each cell with boolean masks
+    :param df: dataframe to split into cells
+    :param cell_columns: columns identifying the cells, e.g. [DAY_COUNT, ACTION_TIME_INTERVAL]
+    :param cell_values: values of each cell column, the cells are numbered in row-major order of these values
+    :return: cell of every row, -1 for rows that are in no cell
+    """
+    cell_codes = np.zeros(df.shape[0], dtype=np.int64)
+    for column, values in zip(cell_columns, cell_values):
+        value_codes = pd.Index(np.asarray(list(values), dtype=float)).get_indexer(
+            np.asarray(df[column], dtype=float))
+        cell_codes = np.where((cell_codes < 0) | (value_codes < 0), -1, cell_codes * len(values) + value_codes)
+    return cell_codes
+
+
+def compute_cell_cross_products(data: np.ndarray, cell_codes: np.ndarray, cell_count: int) -> tuple:
+    """
+    Compute the cross product matrix of the data in every cell with a single pass over the rows. The rows are sorted by
+    cell once and the cross products of each cell are computed on its contiguous block
+    :param data: one row per observation, one column per variable
+    :param cell_codes: cell of every row, -1 for rows that are in no cell, see get_cell_codes
+    :param cell_count: number of cells
+    :return: cross product matrix and number of observations of every cell
+    """
+    in_cell = cell_codes >= 0
+    order = np.argsort(cell_codes[in_cell], kind='stable')
+    data = np.asarray(data, dtype=np.float64)[in_cell][order]
+    bounds = np.searchsorted(cell_codes[in_cell][order], np.arange(cell_count + 1))
+    cross_products = np.zeros((cell_count, data.shape[1], data.shape[1]))
+    for cell in range(cell_count):
+        cell_data = data[bounds[cell]:bounds[cell + 1]]
+        cross_products[cell] = cell_data.T @ cell_data
+    return cross_products, np.diff(bounds)
+
+
+def split_cross_products(cross_products: np.ndarray) -> tuple:
+    """
+    Split cross product matrices of [X|y] into the sufficient statistics of an OLS regression
+    :param cross_products: cross product matrices with the regressand as the last variable
+    :return: X'X, X'y and y'y
+    """
+    return cross_products[..., :-1, :-1], cross_products[..., :-1, -1], cross_products[..., -1, -1]
+
+
+def compute_cell_statistics(x: np.ndarray, y: np.ndarray, cell_codes: np.ndarray, cell_count: int) -> tuple:
+    """
+    Compute the sufficient statistics of an OLS regression in every cell with a single pass over the rows
+    :param x: regressors, one row per observation
+    :param y: regressand
+    :param cell_codes: cell of every row, -1 for rows that are in no cell, see get_cell_codes
+    :param cell_count: number of cells
+    :return: X'X, X'y, y'y and the number of observations of every cell
+    """
+    # y is appended as the last column so that one product gives X'X, X'y and y'y
+    cross_products, observation_counts = compute_cell_cross_products(
+        np.column_stack([np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)]), cell_codes, cell_count)
+    return *split_cross_products(cross_products), observation_counts
+
+
+def solve_cell_ols(xtx: np.ndarray, xty: np.ndarray, yty: np.ndarray, observation_counts: np.ndarray,
+                   alpha: float = 0.05) -> dict:
+    """
+    Solve the OLS regression of every cell at once from its sufficient statistics. Full rank cells match statsmodels
+    OLS. Rank deficient cells get the minimum norm least squares solution, as np.linalg.lstsq, with the rank found by
+    the tolerance of np.linalg.matrix_rank applied to X'X, and their residual degrees of freedom use that rank.
+    statsmodels cuts off the singular values of X at its pinv tolerance instead, so its estimates of these cells can
+    differ in the third decimal. Cells without observations get NaN
+    :param xtx: X'X of every cell
+    :param xty: X'y of every cell
+    :param yty: y'y of every cell
+    :param observation_counts: number of observations of every cell
+    :param alpha: significance level of the confidence intervals, e.g. 0.1 for 90% confidence intervals
+    :return: dict with the params, bse, conf_int_lower and conf_int_upper of every cell and regressor, and the rank
+        and df_resid of every cell
+    """
+    regressor_count = xtx.shape[-1]
+    eigenvalues, eigenvectors = np.linalg.eigh(xtx)
+    # Same tolerance as np.linalg.matrix_rank, applied to the eigenvalues of X'X
+    tolerance = eigenvalues.max(axis=-1, keepdims=True) * regressor_count * np.finfo(np.float64).eps
+    is_kept = eigenvalues > tolerance
+    inverse_eigenvalues = np.divide(1, eigenvalues, out=np.zeros_like(eigenvalues), where=is_kept)
+    normalized_cov_params = (eigenvectors * inverse_eigenvalues[:, None, :]) @ eigenvectors.transpose(0, 2, 1)
+    params = np.einsum('cij,cj->ci', normalized_cov_params, xty)
+
+    rank = is_kept.sum(axis=-1)
+    df_resid = (observation_counts - rank).astype(np.float64)
+    ssr = yty - 2 * np.einsum('ci,ci->c', params, xty) + np.einsum('ci,cij,cj->c', params, xtx, params)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scale = np.maximum(ssr, 0) / df_resid
+        bse = np.sqrt(np.diagonal(normalized_cov_params, axis1=1, axis2=2) * scale[:, None])
+        quantiles = stats.t.ppf(1 - alpha / 2, df_resid)[:, None]
+
+    is_empty = observation_counts == 0
+    params[is_empty] = np.nan
+    bse[is_empty] = np.nan
+    return {
+        'params': params,
+        'bse': bse,
+        'conf_int_lower': params - quantiles * bse,
+        'conf_int_upper': params + quantiles * bse,
+        'rank': rank,
+        'df_resid': df_resid,
+    }
+
+
+def run_batched_ols(df: pd.DataFrame, y_column: str, x_columns: list, cell_columns: list, cell_values: list,
+                    alpha: float = 0.05) -> dict:
+    """
+    Regress y_column on x_columns separately in every cell, see get_cell_codes. No constant is added, include
+    CONSTANT in x_columns to fit an intercept
+    :param df: dataframe with the regressand, regressors and cell columns
+    :param y_column: regressand column
+    :param x_columns: regressor columns
+    :param cell_columns: columns identifying the cells
+    :param cell_values: values of each cell column
+    :param alpha: significance level of the confidence intervals
+    :return: results of every cell, see solve_cell_ols, each array has one leading axis per cell column
+    """
+    cell_shape = tuple(len(values) for values in cell_values)
+    cell_codes = get_cell_codes(df, cell_columns, cell_values)
+    cross_products, observation_counts = compute_cell_cross_products(
+        build_design_matrix(df, x_columns + [y_column]), cell_codes, int(np.prod(cell_shape)))
+    xtx, xty, yty = split_cross_products(cross_products)
+    results = solve_cell_ols(xtx, xty, yty, observation_counts, alpha)
+    return {name: result.reshape(cell_shape + result.shape[1:]) for name, result in results.items()}
@@ -3,149 +3,429 @@ import logging
 import numpy as np
 
 from constants import *
+from data_processing import NAT_NANOSECONDS, compute_order_summary, count_segment_values, first_segment_times, \
+    get_event_segments, get_order_segments, to_nanoseconds
 
 CONDITIONAL_DENSITY = 'conditional_density'
 UNCONDITIONAL_DENSITY = 'unconditional_density'
 DAYS = 'days'
+# Columns compute_action_time needs, the optional columns are carried over when they are loaded
+ACTION_TIME_LOGISTICS_COLUMNS = [ORDER_ID, ACTION, TIMESTAMP_DATE_TIME]
+ACTION_TIME_ORDER_COLUMNS = [ORDER_ID, PAY_TIMESTAMP_DATETIME, LOGISTICS_REVIEW_SCORE]
+OPTIONAL_ACTION_TIME_LOGISTICS_COLUMNS = [LOGISTIC_COMPANY_ID, FACILITY_ID]
+OPTIONAL_ACTION_TIME_ORDER_COLUMNS = [ITEM_DETAIL_INFO, ITEM_ID, MERCHANT_ID]
+# Columns computed by compute_action_time
+ACTION_TIME_SHIPMENT_COLUMNS = [SIGN_TIME, ORDER_TIME, LOGISTICS_REVIEW_SCORE, SHIPMENT_TIME]
 
 
-def compute_action_time(logistics_data: pd.DataFrame, order_data: pd.DataFrame) -> pd.DataFrame:
+def lookup_orders(order_ids: np.ndarray, keys: np.ndarray) -> np.ndarray:
     """
-    Merge logistics and order data and compute the action time of each action
-    :param logistics_data: dataframe containing logistics data
-    :param order_data: dataframe containing order data
-    :return: merged dataframe with action time column added
+    Find orders in a table with one row per order. Both the orders and the keys are sorted, so the search walks
+    through the keys in order
+    :param order_ids: order ids to find
+    :param keys: order id of every row of the table
+    :return: row of every order, -1 if the order is not in the table
+    """
+    key_order = np.argsort(keys)
+    sorted_keys = keys[key_order]
+    if (sorted_keys[1:] == sorted_keys[:-1]).any():
+        raise ValueError('order ids are not unique, compute action time on cleaned data with one row per order')
+    rows = np.full(order_ids.size, -1)
+    if not sorted_keys.size:
+        return rows
+    order_id_order = np.argsort(order_ids)
+    sorted_order_ids = order_ids[order_id_order]
+    positions = np.searchsorted(sorted_keys, sorted_order_ids).clip(max=sorted_keys.size - 1)
+    rows[order_id_order] = np.where(sorted_keys[positions] == sorted_order_ids, key_order[positions], -1)
+    return rows
+
+
+def compute_action_time(logistics_data: pd.DataFrame, order_data: pd.DataFrame,
+                        order_summary: pd.DataFrame = None, columns: list = None) -> pd.DataFrame:
+    """
+    Compute the action time of each action, the time since the order was paid as a share of the shipment time. The
+    events are grouped into one segment per order, the pay and sign time are looked up once per segment and gathered
+    to its events as int64 nanoseconds, so the logistics data is never merged
+    :param logistics_data: dataframe containing logistics data, at least ACTION_TIME_LOGISTICS_COLUMNS
+    :param order_data: dataframe containing order data with one row per order, at least ACTION_TIME_ORDER_COLUMNS
+    :param order_summary: per-order event summary exported with the cleaned data, the sign time is computed from
+        logistics data if None
+    :param columns: columns to return, only these are gathered. By default the logistics columns, the shipment columns
+        ACTION_TIME_SHIPMENT_COLUMNS, the loaded optional order columns and the action time
+    :return: dataframe with one row per action with a valid action time, indexed by its row in logistics data
     """
     logging.info("Started computing action time")
-    # Merge the two dataframes and trim columns
-    sign_time = logistics_data[logistics_data[ACTION] == SIGNED][
-        [ORDER_ID, ACTION, TIMESTAMP_DATE_TIME, LOGISTIC_COMPANY_ID, FACILITY_ID]]
-    shipment_time = sign_time.merge(order_data, on=ORDER_ID, how=LEFT)
-    shipment_time[SHIPMENT_TIME] = shipment_time[TIMESTAMP_DATE_TIME] - shipment_time[PAY_TIMESTAMP_DATETIME]
-    shipment_time = shipment_time.rename(
-        columns={PAY_TIMESTAMP_DATETIME: ORDER_TIME, TIMESTAMP_DATE_TIME: SIGN_TIME})
-    shipment_time = shipment_time[
-        [ORDER_ID, SIGN_TIME, ORDER_TIME, LOGISTICS_REVIEW_SCORE, SHIPMENT_TIME, ITEM_DETAIL_INFO, LOGISTIC_COMPANY_ID,
-         FACILITY_ID, MERCHANT_ID]]
-
-    # Compute action time
-    action_time = logistics_data[[ORDER_ID, ACTION, TIMESTAMP_DATE_TIME]]
-    action_time = action_time.merge(shipment_time, on=ORDER_ID, how=LEFT)
-    action_time[ACTION_TIME] = (action_time[TIMESTAMP_DATE_TIME] - action_time[ORDER_TIME]) / action_time[SHIPMENT_TIME]
+    sort_order, segment_order_ids, offsets = get_order_segments(logistics_data[ORDER_ID].to_numpy(np.int64))
+    timestamps = to_nanoseconds(logistics_data[TIMESTAMP_DATE_TIME])
+
+    # Look up the pay and sign time of every order segment
+    order_rows = lookup_orders(segment_order_ids, order_data[ORDER_ID].to_numpy(np.int64))
+    pay_times = np.where(order_rows >= 0, to_nanoseconds(order_data[PAY_TIMESTAMP_DATETIME])[order_rows],
+                         NAT_NANOSECONDS)
+    if order_summary is not None:
+        summary_rows = lookup_orders(segment_order_ids, order_summary[ORDER_ID].to_numpy(np.int64))
+        sign_times = np.where(summary_rows >= 0, to_nanoseconds(order_summary[SIGN_TIME])[summary_rows],
+                              NAT_NANOSECONDS)
+    else:
+        is_signed = (logistics_data[ACTION] == SIGNED).to_numpy()
+        sign_times = first_segment_times(timestamps if sort_order is None else timestamps[sort_order], offsets,
+                                         is_signed if sort_order is None else is_signed[sort_order])
+    # Shipment time of every segment as a float, like the division of timedeltas, NaN if a time is missing
+    shipment_times = np.where((pay_times == NAT_NANOSECONDS) | (sign_times == NAT_NANOSECONDS), np.nan,
+                              sign_times - pay_times)
+
+    # Gather them to the events, in the order of logistics data, computing in place to keep one copy per event
+    event_segments = get_event_segments(sort_order, offsets)
+    time_since_pay = pay_times[event_segments]
+    np.subtract(timestamps, time_since_pay, out=time_since_pay)
+    action_times = shipment_times[event_segments]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        np.divide(time_since_pay, action_times, out=action_times)
+    del time_since_pay
+    action_times[timestamps == NAT_NANOSECONDS] = np.nan
 
     # Filter out invalid action times
-    action_time = action_time[action_time[ACTION_TIME] >= 0]
-    action_time = action_time[action_time[ACTION_TIME] <= 1]
+    kept = np.flatnonzero((action_times >= 0) & (action_times <= 1))
+    kept_segments = event_segments[kept]
+    kept_order_rows = order_rows[kept_segments]
+
+    def get_sign_time():
+        if order_summary is not None:
+            return order_summary[SIGN_TIME].array.take(summary_rows[kept_segments])
+        return pd.array(sign_times[kept_segments].view('datetime64[ns]')).astype(
+            logistics_data[TIMESTAMP_DATE_TIME].dtype)
+
+    column_getters = {
+        SIGN_TIME: get_sign_time,
+        ORDER_TIME: lambda: order_data[PAY_TIMESTAMP_DATETIME].array.take(kept_order_rows),
+        SHIPMENT_TIME: lambda: get_sign_time() - column_getters[ORDER_TIME](),
+        ACTION_TIME: lambda: action_times[kept],
+    }
+    logistics_columns = [column for column in ACTION_TIME_LOGISTICS_COLUMNS + OPTIONAL_ACTION_TIME_LOGISTICS_COLUMNS
+                         if column in logistics_data.columns]
+    order_columns = [column for column in [LOGISTICS_REVIEW_SCORE] + OPTIONAL_ACTION_TIME_ORDER_COLUMNS
+                     if column in order_data.columns]
+    if columns is None:
+        columns = logistics_columns + [column for column in ACTION_TIME_SHIPMENT_COLUMNS +
+                                       OPTIONAL_ACTION_TIME_ORDER_COLUMNS + [ACTION_TIME]
+                                       if column in column_getters or column in order_columns]
+
+    # Columns of logistics and order data are gathered block by block, then the order and computed columns are added
+    # to the logistics columns one at a time so that the blocks are not copied again. Columns are only copied to
+    # reorder them when logistics columns are requested after other columns
+    action_time = logistics_data[[column for column in columns if column in logistics_columns]].take(kept)
+    action_time.index = kept
+    order_columns_df = order_data[[column for column in columns if column in order_columns]].take(kept_order_rows)
+    order_columns_df.index = action_time.index
+    for column in columns:
+        if column in order_columns:
+            action_time[column] = order_columns_df[column]
+        elif column not in logistics_columns:
+            action_time[column] = column_getters[column]()
+    if list(action_time.columns) != list(columns):
+        action_time = action_time[columns]
 
     logging.info("Finished computing action time")
     return action_time
 
 
-def bin_action_time(action_time_df: pd.DataFrame, bin_size: float = 0.1):
+def get_action_time_interval_column(bin_size: float) -> str:
     """
-    Divide rows into bins based on action time
-    :param action_time_df: data frame with action time
+    Get the name of the action time bin column of a bin size added by bin_action_time
+    :param bin_size: size of each bin
+    :return: column name, e.g. action_time_interval_0.05
+    """
+    return f'{ACTION_TIME_INTERVAL}_{bin_size:g}'
+
+
+def get_action_time_bins(max_action_time: float, bin_size: float) -> tuple:
+    """
+    Get the edges of the action time bins and their left edges as labelled by pd.cut
+    :param max_action_time: largest action time to bin
+    :param bin_size: size of each bin
+    :return: edges of the bins, right closed like pd.cut, and the left edge label of every bin
+    """
+    bins = np.arange(0, max_action_time + bin_size, bin_size)
+    # pd.cut labels intervals with rounded edges, e.g. 0.15 rather than 0.15000000000000002
+    left_edges = pd.cut(bins[1:], bins).categories.left.to_numpy()
+    return bins, left_edges
+
+
+def compute_bin_codes(values: np.ndarray, bins: np.ndarray, bin_size: float) -> np.ndarray:
+    """
+    Compute the bin of every value with the right closed bins of pd.cut. The bin is computed by division, then moved
+    by one where rounding put a value next to its bin, so the codes are those of searching the edges
+    :param values: values to bin
+    :param bins: edges of the bins, bin_size apart starting at 0
     :param bin_size: size of each bin
-    :return: dataframe with action time bin added
+    :return: bin code of every value in the smallest integer type holding them, -1 if the value is in no bin
+    """
+    code_type = np.min_scalar_type(-max(bins.size, 2))
+    estimates = np.divide(values, bin_size)
+    np.ceil(estimates, out=estimates)
+    # fmax and fmin replace NaN with the bound, missing values are set to -1 below
+    np.fmax(estimates, 1, out=estimates)
+    np.fmin(estimates, bins.size - 1, out=estimates)
+    estimates -= 1
+    codes = estimates.astype(code_type)
+    edges = estimates.astype(np.intp)
+    codes -= values <= bins[edges]
+    edges += 1
+    codes += values > bins[edges]
+    codes[(codes > bins.size - 2) | np.isnan(values)] = -1
+    return codes
+
+
+def bin_action_time(action_time_df: pd.DataFrame, bin_size: float = 0.1, bin_sizes: list = None):
+    """
+    Divide rows into bins based on action time. Bins are categorical columns of integer bin codes with the left edge of
+    every bin as categories
+    :param action_time_df: data frame with action time
+    :param bin_size: size of each bin of ACTION_TIME_INTERVAL
+    :param bin_sizes: other bin sizes to bin at in the same pass, each adds a column named by
+        get_action_time_interval_column, so that the same dataframe serves analyses at several resolutions
+    :return: dataframe with action time bins added, without the rows that are in no bin
     """
     logging.info("Started binning action time")
-    # Create intervals for action_time
-    bins = np.arange(0, action_time_df[ACTION_TIME].max() + bin_size, bin_size)
-    action_time_df[ACTION_TIME_INTERVAL] = pd.cut(action_time_df[ACTION_TIME], bins=bins)
-    action_time_df[ACTION_TIME_INTERVAL] = action_time_df[ACTION_TIME_INTERVAL].apply(lambda x: x.left)
-    action_time_df = action_time_df[~action_time_df[ACTION_TIME_INTERVAL].isna()]
+    action_times = action_time_df[ACTION_TIME].to_numpy(np.float64)
+    max_action_time = np.nanmax(action_times) if action_times.size else 0.0
+    is_binned = None
+    for column, size in [(ACTION_TIME_INTERVAL, bin_size)] + [
+            (get_action_time_interval_column(size), size) for size in bin_sizes or []]:
+        bins, left_edges = get_action_time_bins(max_action_time, size)
+        codes = compute_bin_codes(action_times, bins, size)
+        action_time_df[column] = pd.Categorical.from_codes(codes, categories=left_edges, ordered=True)
+        # Values are in no bin of any size for the same reasons, non-positive or missing, the first size decides
+        if is_binned is None:
+            is_binned = codes >= 0
+    action_time_df = action_time_df[is_binned]
     logging.info("Finished binning action time")
 
     return action_time_df
 
 
+class ActionTimeHistogram:
+    """
+    Number of actions in every (logistics review score, action, action time bin) cell, from which the distribution
+    difference of figure 2 is computed. Histograms of shards are merged by adding their counts, so the distribution
+    difference of the full data is computed one shard at a time
+    """
+
+    def __init__(self, bin_size: float, max_action_time: float, scores: np.ndarray, actions: pd.CategoricalDtype,
+                 counts: np.ndarray):
+        """
+        :param bin_size: size of each action time bin
+        :param max_action_time: largest action time counted, the bins cover 0 to max_action_time
+        :param scores: logistics review scores, scores of 1 are counted as 2
+        :param actions: categories of the actions
+        :param counts: counts shaped scores + 1 × actions × bins, the last score counts actions of orders without a score
+        """
+        self.bin_size = bin_size
+        self.max_action_time = max_action_time
+        self.scores = scores
+        self.actions = actions
+        self.counts = counts
+
+    @classmethod
+    def from_dataframe(cls, action_time_df: pd.DataFrame, bin_size: float = 0.1) -> 'ActionTimeHistogram':
+        """
+        Count the actions of every cell, the cell of every row is encoded into one integer and counted with bincount
+        :param action_time_df: dataframe with action, logistics review score and action time, see compute_action_time
+        :param bin_size: size of each action time bin
+        :return: histogram of the actions
+        """
+        action_times = action_time_df[ACTION_TIME].to_numpy(np.float64)
+        max_action_time = float(np.nanmax(action_times, initial=0.0))
+        bins, _ = get_action_time_bins(max_action_time, bin_size)
+        bin_codes = compute_bin_codes(action_times, bins, bin_size)
+        bin_count = bins.size - 1
+
+        actions = pd.Categorical(action_time_df[ACTION])
+        action_codes = actions.codes
+        score_codes, scores = pd.factorize(action_time_df[LOGISTICS_REVIEW_SCORE], sort=True)
+        scores = np.asarray(scores)
+        scores, score_map = np.unique(np.where(scores <= 1, 2, scores).astype(scores.dtype), return_inverse=True)
+        score_codes = np.where(score_codes >= 0, score_map[score_codes], scores.size)
+
+        is_counted = (action_codes >= 0) & (bin_codes >= 0)
+        cell_codes = score_codes * len(actions.categories)
+        cell_codes += action_codes
+        cell_codes *= bin_count
+        cell_codes += bin_codes
+        counts = np.bincount(cell_codes[is_counted], minlength=(scores.size + 1) * len(actions.categories) * bin_count)
+        return cls(bin_size, max_action_time, scores, actions.dtype,
+                   counts.reshape(scores.size + 1, len(actions.categories), bin_count))
+
+    @classmethod
+    def merge(cls, histograms: list) -> 'ActionTimeHistogram':
+        """
+        Merge the histograms of several shards, the bins of a shard are the first bins of the merged histogram
+        :param histograms: histograms with the same bin size
+        :return: histogram of all the shards
+        """
+        bin_size = histograms[0].bin_size
+        if any(histogram.bin_size != bin_size for histogram in histograms):
+            raise ValueError('Histograms with different bin sizes can\'t be merged')
+        scores = np.unique(np.concatenate([histogram.scores for histogram in histograms]))
+        actions = histograms[0].actions
+        if any(histogram.actions != actions for histogram in histograms):
+            actions = pd.CategoricalDtype(pd.Index(actions.categories).append(
+                [histogram.actions.categories for histogram in histograms]).unique())
+        counts = np.zeros((scores.size + 1, len(actions.categories),
+                           max(histogram.counts.shape[2] for histogram in histograms)), dtype=np.int64)
+        for histogram in histograms:
+            score_indices = np.append(np.searchsorted(scores, histogram.scores), scores.size)
+            action_indices = actions.categories.get_indexer(histogram.actions.categories)
+            counts[np.ix_(score_indices, action_indices, np.arange(histogram.counts.shape[2]))] += histogram.counts
+        return cls(bin_size, max(histogram.max_action_time for histogram in histograms), scores, actions, counts)
+
+    def compute_distribution_difference(self) -> pd.DataFrame:
+        """
+        Compute the difference in the expected number of actions in each action time interval when conditioned and
+        unconditioned on logistics review score
+        :return: dataframe with the distribution difference of every score, action and action time interval with
+            actions, ordered by score, action and interval
+        """
+        counts = self.counts.astype(np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            conditional_densities = counts[:-1] / counts[:-1].sum(axis=2, keepdims=True)
+            unconditional_counts = counts.sum(axis=0)
+            unconditional_densities = unconditional_counts / unconditional_counts.sum(axis=1, keepdims=True)
+        score_indices, action_indices, bin_indices = np.nonzero(self.counts[:-1])
+
+        _, left_edges = get_action_time_bins(self.max_action_time, self.bin_size)
+        return pd.DataFrame({
+            LOGISTICS_REVIEW_SCORE: self.scores[score_indices],
+            ACTION: pd.Categorical.from_codes(action_indices, dtype=self.actions),
+            ACTION_TIME_INTERVAL: pd.Categorical.from_codes(bin_indices, categories=left_edges, ordered=True),
+            DISTRIBUTION_DIFFERENCE: conditional_densities[score_indices, action_indices, bin_indices]
+            - unconditional_densities[action_indices, bin_indices],
+        })
+
+
+def compute_action_time_histogram(logistics_data: pd.DataFrame, order_data: pd.DataFrame, bin_size: float = 0.1,
+                                  order_summary: pd.DataFrame = None) -> ActionTimeHistogram:
+    """
+    Count the actions by logistics review score, action and action time bin
+    :param logistics_data: dataframe containing logistics data
+    :param order_data: dataframe containing order data
+    :param bin_size: size of each action time bin
+    :param order_summary: per-order event summary exported with the cleaned data, computed from logistics data if None
+    :return: histogram of the actions
+    """
+    action_time_df = compute_action_time(logistics_data, order_data, order_summary,
+                                         columns=[ACTION, LOGISTICS_REVIEW_SCORE, ACTION_TIME])
+    return ActionTimeHistogram.from_dataframe(action_time_df, bin_size)
+
+
 def compute_action_time_distribution_difference(
-        logistics_data: pd.DataFrame, order_data: pd.DataFrame, bin_size: float = 0.1) -> pd.DataFrame:
+        logistics_data: pd.DataFrame, order_data: pd.DataFrame, bin_size: float = 0.1,
+        order_summary: pd.DataFrame = None) -> pd.DataFrame:
     """
     Compute the difference in the expected number of actions in each action time interval when conditioned and
     unconditioned on logistics review score
     :param logistics_data: dataframe containing logistics data
     :param order_data: dataframe containing order data
     :param bin_size: size of each action time bin
-    :return: dataframe with the difference in distribution added
+    :param order_summary: per-order event summary exported with the cleaned data, computed from logistics data if None
+    :return: dataframe with the difference in distribution, see ActionTimeHistogram.compute_distribution_difference
     """
     logging.info("Started compute action time distribution difference")
-    action_time_df = compute_action_time(logistics_data, order_data)
-    bin_action_time(action_time_df, bin_size)
-
-    action_time_df.loc[action_time_df[LOGISTICS_REVIEW_SCORE] <= 1, LOGISTICS_REVIEW_SCORE] = 2
-
-    # Calculate conditional PDFs
-    conditional_pdfs = (action_time_df.groupby([LOGISTICS_REVIEW_SCORE, ACTION, ACTION_TIME_INTERVAL], observed=True)
-                        .size().rename(CONDITIONAL_DENSITY))
-    conditional_pdfs = conditional_pdfs / conditional_pdfs.groupby([ACTION, LOGISTICS_REVIEW_SCORE],
-                                                                   observed=True).transform(SUM)
-    conditional_pdfs = conditional_pdfs.reset_index()
-
-    # Calculate unconditional PDFs
-    unconditional_pdfs = action_time_df.groupby([ACTION_TIME_INTERVAL, ACTION], observed=True).size().rename(
-        UNCONDITIONAL_DENSITY)
-    unconditional_pdfs = unconditional_pdfs / unconditional_pdfs.groupby([ACTION]).transform(SUM)
-    unconditional_pdfs = unconditional_pdfs.reset_index()
-
-    # Merge to have both conditional and unconditional densities in the same dataframe
-    merged = conditional_pdfs.merge(unconditional_pdfs, on=[ACTION, ACTION_TIME_INTERVAL], how=LEFT)
-
-    # Calculate the difference
-    merged[DISTRIBUTION_DIFFERENCE] = merged[CONDITIONAL_DENSITY] - merged[UNCONDITIONAL_DENSITY]
-    merged.drop([CONDITIONAL_DENSITY, UNCONDITIONAL_DENSITY], axis=1)
+    distribution_difference = compute_action_time_histogram(
+        logistics_data, order_data, bin_size, order_summary).compute_distribution_difference()
     logging.info("Finished compute action time distribution difference")
-    return merged
+    return distribution_difference
+
+
+ORDER_COUNT_COLUMNS = [SHIPMENT_ACTION_COUNT, FACILITY_COUNT, ARRIVE_COUNT, DEPART_COUNT, RECEIVE_COUNT, SCAN_COUNT]
+ITEM_KEY_COLUMNS = [ITEM_ID, MERCHANT_ID]
+SEGMENT = 'segment'
+ITEM_ROW = 'item_row'
 
 
 def filter_less_than_5000(df, field, assigned_value=-1):
-    less_than_5000 = df.groupby(field).filter(lambda x: len(x) < 5000)
-    df.loc[df[field].isin(less_than_5000[field]), field] = assigned_value
+    """
+    Collapse the values of a column that occur in fewer than 5000 rows into one value, in place
+    :param df: dataframe to update
+    :param field: column to collapse the rare values of
+    :param assigned_value: value the rare values are replaced with
+    """
+    value_counts = df[field].value_counts()
+    rare_values = value_counts.index[value_counts < 5000]
+    if len(rare_values):
+        df.loc[df[field].isin(rare_values), field] = assigned_value
+
+
+def lookup_items(segment_items: pd.DataFrame, item_df: pd.DataFrame) -> tuple:
+    """
+    Find the items of every order segment like a left merge on ITEM_KEY_COLUMNS. Only the item keys of the segments
+    are merged, an order has one item so the rows of an order share its matches
+    :param segment_items: item key columns of every order segment
+    :param item_df: item data
+    :return: row of item_df of every match, -1 if the segment has no item, and the offsets of the matches of every
+        segment, the matches of segment i are offsets[i]:offsets[i + 1]
+    """
+    matches = segment_items[ITEM_KEY_COLUMNS].assign(**{SEGMENT: np.arange(segment_items.shape[0])}).merge(
+        item_df[ITEM_KEY_COLUMNS].assign(**{ITEM_ROW: np.arange(item_df.shape[0])}), on=ITEM_KEY_COLUMNS, how=LEFT)
+    offsets = np.append(0, np.cumsum(np.bincount(matches[SEGMENT], minlength=segment_items.shape[0])))
+    return matches[ITEM_ROW].fillna(-1).to_numpy(np.int64), offsets
 
 
-def add_dummy_variables(df: pd.DataFrame, item_df: pd.DataFrame):
+def add_dummy_variables(df: pd.DataFrame, item_df: pd.DataFrame, order_summary: pd.DataFrame = None):
     """
     Add dummy variables to the dataframe, dummy variables include facility counts, arrive counts, depart counts,
-    receive counts, scan counts, action counts, week_counts, and day of the week
+    receive counts, scan counts, action counts, week_counts, and day of the week. The per-order counts and items are
+    computed once per order segment and gathered to the rows in a single pass instead of merging the rows once per
+    feature
     :param df: dataframe with action time intervals
-    :param item_df: dataframe containing item info
-    :return: dataframe with dummy variables added
+    :param item_df: dataframe containing item info, items that are not found are given 0 in every item column
+    :param order_summary: per-order event summary exported with the cleaned data, computed from df if None
+    :return: dataframe with dummy variables added, without the rows of orders missing from the order summary
     """
     logging.info("Started adding dummy variables")
-    # Compute dummy variable values
-    facility_counts = df.groupby(ORDER_ID)[FACILITY_ID].nunique().rename(FACILITY_COUNT).reset_index()
-    arrive_counts = df[df[ACTION] == ARRIVAL].groupby(ORDER_ID).size().rename(ARRIVE_COUNT).reset_index()
-    depart_counts = df[df[ACTION] == DEPARTURE].groupby(ORDER_ID).size().rename(DEPART_COUNT).reset_index()
-    receive_counts = df[df[ACTION] == GOT].groupby(ORDER_ID).size().rename(RECEIVE_COUNT).reset_index()
-    scan_counts = df[df[ACTION] == SENT_SCAN].groupby(ORDER_ID).size().rename(SCAN_COUNT).reset_index()
-    action_counts = df.groupby([ORDER_ID, ACTION_TIME_INTERVAL], observed=True).size().rename(ACTION_COUNT)\
-        .reset_index()
+    if order_summary is None:
+        order_summary = compute_order_summary(df)
     df[DAYS] = (df[ORDER_TIME] - DAY_ONE).dt.days
     df[WEEK_COUNT] = df[DAYS] // 7
     df[DAY_OF_WEEK] = df[DAYS] % 7
 
-    action_count_df = df.groupby([ORDER_ID], observed=True).size().rename(
-        SHIPMENT_ACTION_COUNT).reset_index()
-    action_count_df = df.merge(action_count_df, on=[ORDER_ID])
-
-    logging.info("Started merging dummy variables.")
-    # Merge dummy variables into the main dataframe
-    action_count_df = action_count_df \
-        .merge(facility_counts, on=ORDER_ID, how=LEFT) \
-        .merge(arrive_counts, on=ORDER_ID, how=LEFT) \
-        .merge(depart_counts, on=ORDER_ID, how=LEFT) \
-        .merge(receive_counts, on=ORDER_ID, how=LEFT) \
-        .merge(scan_counts, on=ORDER_ID, how=LEFT) \
-        .merge(action_counts, on=[ORDER_ID, ACTION_TIME_INTERVAL], how=LEFT)
+    sort_order, segment_order_ids, offsets = get_order_segments(df[ORDER_ID].to_numpy(np.int64))
+    row_segments = get_event_segments(sort_order, offsets)
+    # Rows of every (order, action time interval) pair, counted per order segment in one pass
+    intervals = df[ACTION_TIME_INTERVAL].cat.codes.to_numpy()
+    interval_counts = count_segment_values(intervals if sort_order is None else intervals[sort_order],
+                                           len(df[ACTION_TIME_INTERVAL].cat.categories), offsets)
+    action_counts = interval_counts[row_segments, intervals]
+    if (intervals < 0).any():
+        action_counts = np.where(intervals >= 0, action_counts, np.nan)
+    summary_rows = lookup_orders(segment_order_ids, order_summary[ORDER_ID].to_numpy(np.int64))
 
     filter_less_than_5000(item_df, BRAND_ID)
     filter_less_than_5000(item_df, CATEGORY_ID)
     filter_less_than_5000(item_df, MERCHANT_ID)
+    first_rows = offsets[:-1] if sort_order is None else sort_order[offsets[:-1]]
+    item_rows, item_offsets = lookup_items(df[ITEM_KEY_COLUMNS].take(first_rows), item_df)
+
+    logging.info("Started merging dummy variables.")
+    # Rows of orders missing from the order summary are dropped and rows with several matching items are repeated, as
+    # by an inner merge with the order summary followed by a left merge with the items
+    repeats = np.where(summary_rows >= 0, np.diff(item_offsets), 0)[row_segments]
+    rows = np.repeat(np.arange(df.shape[0]), repeats)
+    segments = row_segments[rows]
+    row_item_rows = item_rows[item_offsets[segments] + np.arange(rows.size) - (np.cumsum(repeats) - repeats)[rows]]
+
+    action_count_df = df.take(rows)
+    action_count_df.index = pd.RangeIndex(rows.size)
+    order_counts = order_summary[ORDER_COUNT_COLUMNS].take(summary_rows[segments])
+    order_counts.index = action_count_df.index
+    for column in ORDER_COUNT_COLUMNS:
+        action_count_df[column] = order_counts[column]
+    action_count_df[ACTION_COUNT] = action_counts[rows]
+    for column in item_df.columns.difference(ITEM_KEY_COLUMNS, sort=False):
+        action_count_df[column] = np.where(row_item_rows >= 0, item_df[column].to_numpy()[row_item_rows], 0)
+
     filter_less_than_5000(df, LOGISTIC_COMPANY_ID)
     filter_less_than_5000(df, WEEK_COUNT)
-
-    action_count_df = action_count_df.merge(item_df, on=[ITEM_ID, MERCHANT_ID], how=LEFT)
-    action_count_df.fillna(0, inplace=True)
     logging.info("Finished adding dummy variables")
 
     return action_count_df
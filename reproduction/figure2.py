@@ -5,16 +5,53 @@ from data_processing import *
 from constants import *
 
 
-def main():
-    full_logistics_data_df = load_full_logistics_data()
-    full_order_data_df = load_full_order_data()
+ACTIONS = [CONSIGN, GOT, DEPARTURE, ARRIVAL, SENT_SCAN]
 
-    # Calculate distribution difference
-    distribution_difference = compute_action_time_distribution_difference(full_logistics_data_df, full_order_data_df)
+
+def compute_sharded_distribution_difference(actions: list = None, bin_size: float = 0.1) -> pd.DataFrame:
+    """
+    Compute the distribution difference one shard at a time, only the histogram of the actions is kept between shards
+    so the events of all shards are never in memory together
+    :param actions: actions to count, ACTIONS if None
+    :param bin_size: size of each action time bin
+    :return: dataframe with the difference in distribution, see ActionTimeHistogram.compute_distribution_difference
+    """
+    actions = ACTIONS if actions is None else actions
+    histograms = []
+    for shard_index in get_cleaned_shard_indices():
+        logging.info(f'counting action times of shard {shard_index}')
+        # Only load the columns and actions that are plotted
+        histograms.append(compute_action_time_histogram(
+            load_shard_logistics_data(shard_index, columns=ACTION_TIME_LOGISTICS_COLUMNS,
+                                      filters=[(ACTION, 'in', actions)]),
+            load_shard_order_data(shard_index, columns=ACTION_TIME_ORDER_COLUMNS), bin_size,
+            load_shard_order_summary(shard_index, columns=[ORDER_ID, SIGN_TIME])))
+    return ActionTimeHistogram.merge(histograms).compute_distribution_difference()
+
+
+def get_distribution_difference_stage(actions: list = None, bin_size: float = 0.1) -> Stage:
+    """
+    Get the pipeline stage computing the distribution difference
+    :param actions: actions to count, ACTIONS if None
+    :param bin_size: size of each action time bin
+    :return: stage computing the distribution difference, see compute_sharded_distribution_difference
+    """
+    return Stage(
+        'distribution_difference', compute_sharded_distribution_difference,
+        parameters={'actions': ACTIONS if actions is None else actions, 'bin_size': bin_size},
+        input_paths=lambda: get_cleaned_file_paths('cleaned_logistics_detail') + get_cleaned_file_paths(
+            'cleaned_order_data') + get_cleaned_file_paths('cleaned_order_summary'),
+        functions=[compute_action_time_histogram, compute_action_time, ActionTimeHistogram.from_dataframe,
+                   ActionTimeHistogram.merge, ActionTimeHistogram.compute_distribution_difference, compute_bin_codes])
+
+
+def main(force: bool = False):
+    actions = ACTIONS
+    # Calculate distribution difference, reused from the pipeline cache until the data or the code change
+    distribution_difference = get_pipeline().run(get_distribution_difference_stage(actions), force)
 
     # Plot
     plt.figure(figsize=(12, 8))
-    actions = [CONSIGN, GOT, DEPARTURE, ARRIVAL, SENT_SCAN]
 
     # Define the number of rows/cols for the subplot grid
     cols = 1
@@ -1,3 +1,5 @@
+import os.path
+
 import matplotlib.pyplot as plt
 import pandas
 import statsmodels.api as sm
@@ -7,9 +9,49 @@ from constants import *
 
 DAY_COUNT = 'day_count'
 BINS = [0.0, 0.05, 0.1, 0.15, 0.2, 0.25, 0.3, 0.35, 0.4, 0.45, 0.5, 0.55, 0.6, 0.65, 0.7, 0.75, 0.8, 0.85, 0.9, 0.95]
+OLS_REGRESSORS = [ACTION_COUNT, WEEK_COUNT, DAY_COUNT, FACILITY_COUNT, ARRIVE_COUNT, DEPART_COUNT, RECEIVE_COUNT,
+                  SCAN_COUNT]
+# Regressors the cached regression cells cover, OLS_REGRESSORS and the alternatives that have been tried
+CANDIDATE_REGRESSORS = OLS_REGRESSORS + [CONSTANT, MERCHANT_ID, BRAND_ID, CATEGORY_ID, LOGISTIC_COMPANY_ID]
+SPLITTING_COLUMNS = [SHIPMENT_ACTION_COUNT, DAY_COUNT]
+BIN_SIZE = 0.05
+# Columns of compute_action_time used by the regressions, the logistics columns first so that they are not reordered
+REGRESSION_ACTION_TIME_COLUMNS = [ORDER_ID, LOGISTIC_COMPANY_ID, ORDER_TIME, LOGISTICS_REVIEW_SCORE, SHIPMENT_TIME,
+                                  ITEM_ID, MERCHANT_ID, ACTION_TIME]
+BATCHED = 'batched'
+STATSMODELS = 'statsmodels'
+
+
+def get_action_count_results(results: dict, x_columns: list) -> tuple:
+    """
+    Get the action count results of batched regressions
+    :param results: results with a leading split value and bin axis, see run_batched_ols
+    :param x_columns: regressors of the regressions
+    :return: action count coefficients, lower and upper confidence interval bounds by column value and bin
+    """
+    action_count_index = x_columns.index(ACTION_COUNT)
+    return tuple(results[name][:, :, action_count_index].tolist()
+                 for name in ['params', 'conf_int_lower', 'conf_int_upper'])
+
 
+def run_ols(df: pandas.DataFrame, splitting_column_name: str, column_values: range, alpha: float = 0.1,
+            engine: str = BATCHED):
+    """
+    Regress the shipment score on the action count and the controls in every action time bin for every value of the
+    splitting column
+    :param df: dataframe with dummy variables added, see add_dummy_variables
+    :param splitting_column_name: column to split the regressions by
+    :param column_values: values of the splitting column to run regressions for
+    :param alpha: significance level of the confidence intervals, 0.1 gives 90% confidence intervals
+    :param engine: BATCHED to solve every regression at once from sufficient statistics computed in one pass over
+        the data, STATSMODELS to filter the data and fit a statsmodels OLS for each regression
+    :return: action count coefficients, lower and upper confidence interval bounds by column value and bin
+    """
+    if engine == BATCHED:
+        results = run_batched_ols(df, LOGISTICS_REVIEW_SCORE, OLS_REGRESSORS,
+                                  [splitting_column_name, ACTION_TIME_INTERVAL], [column_values, BINS], alpha)
+        return get_action_count_results(results, OLS_REGRESSORS)
 
-def run_ols(df: pandas.DataFrame, splitting_column_name: str, column_values: range):
     coefficients = []
     upper_conf_ints = []
     lower_conf_ints = []
@@ -21,9 +63,7 @@ def run_ols(df: pandas.DataFrame, splitting_column_name: str, column_values: ran
         for bin in BINS:
             subsample_df = df[(df[splitting_column_name] == value) & (df[ACTION_TIME_INTERVAL] == bin)]
             y = subsample_df[LOGISTICS_REVIEW_SCORE]
-            x = subsample_df[
-                [ACTION_COUNT, WEEK_COUNT, DAY_COUNT, FACILITY_COUNT, ARRIVE_COUNT, DEPART_COUNT, RECEIVE_COUNT,
-                 SCAN_COUNT]]
+            x = subsample_df[OLS_REGRESSORS]
             # x = subsample_df[
             #     [ACTION_COUNT, MERCHANT_ID, BRAND_ID, CATEGORY_ID, LOGISTIC_COMPANY_ID, WEEK_COUNT, DAY_COUNT,
             #      FACILITY_COUNT, ARRIVE_COUNT, DEPART_COUNT, RECEIVE_COUNT, SCAN_COUNT]]
@@ -31,7 +71,7 @@ def run_ols(df: pandas.DataFrame, splitting_column_name: str, column_values: ran
 
             model = sm.OLS(y, x)
             results = model.fit()
-            conf_int = results.conf_int(alpha=0.1).loc[ACTION_COUNT]  # alpha=0.1 indicates 90% confidence interval
+            conf_int = results.conf_int(alpha=alpha).loc[ACTION_COUNT]
             bin_upper_conf_ints.append(conf_int[1])
             bin_lower_conf_ints.append(conf_int[0])
             bin_coefficients.append(results.params[ACTION_COUNT])
@@ -42,15 +82,29 @@ def run_ols(df: pandas.DataFrame, splitting_column_name: str, column_values: ran
     return coefficients, lower_conf_ints, upper_conf_ints
 
 
-def main():
-    # Loads data
-    full_logistics_data_df = load_full_logistics_data()
-    full_order_data_df = load_full_order_data()
-    item_df = load_item_data()
+def run_cached_ols(cells: RegressionCells, splitting_column_name: str, column_values: range, alpha: float = 0.1,
+                   x_columns: list = None):
+    """
+    Run the regressions of run_ols from cached regression cells, without the regression data
+    :param cells: regression cells, see load_regression_cells
+    :param splitting_column_name: column to split the regressions by, one of SPLITTING_COLUMNS
+    :param column_values: values of the splitting column to run regressions for
+    :param alpha: significance level of the confidence intervals, 0.1 gives 90% confidence intervals
+    :param x_columns: regressors, a subset of CANDIDATE_REGRESSORS, OLS_REGRESSORS if None
+    :return: action count coefficients, lower and upper confidence interval bounds by column value and bin
+    """
+    x_columns = OLS_REGRESSORS if x_columns is None else x_columns
+    results = cells.run_ols(splitting_column_name, column_values, x_columns, alpha, BINS)
+    return get_action_count_results(results, x_columns)
 
-    df = compute_action_time(full_logistics_data_df, full_order_data_df)
-    df = bin_action_time(df, bin_size=0.05)
 
+def prepare_action_time(df: pandas.DataFrame) -> pandas.DataFrame:
+    """
+    Prepare binned action times for the regressions: merge shipment scores 1 and 2, add the day count and keep
+    shipments of one to eight days. The item id is parsed from the item detail info if it wasn't loaded
+    :param df: dataframe with action time intervals, see bin_action_time
+    :return: prepared dataframe
+    """
     # Merge rows with shipment score 1 and 2
     df.loc[df[LOGISTICS_REVIEW_SCORE] <= 1, LOGISTICS_REVIEW_SCORE] = 2
     # Calculate day count by taking ceiling of shipment time
@@ -58,21 +112,191 @@ def main():
     # Remove shipments with day count less than 1 or greater than 8
     df = df[df[DAY_COUNT] <= 8]
     df = df[df[DAY_COUNT] >= 1]
-    # Get item id from item det info
-    df[ITEM_ID] = df[ITEM_DETAIL_INFO].apply(
-        lambda item_det_info: int(item_det_info.split(":")[0]))
+    # Cleaned order data carries the item id parsed from the item detail info
+    if ITEM_ID not in df.columns:
+        df[ITEM_ID] = parse_item_details(df[ITEM_DETAIL_INFO])[0]
+    return df
 
-    # Clean up item info
+
+def prepare_item_data(item_df: pandas.DataFrame, df: pandas.DataFrame) -> pandas.DataFrame:
+    """
+    Keep the items and item columns used by the regressions
+    :param item_df: dataframe containing item data
+    :param df: dataframe returned by prepare_action_time
+    :return: item dataframe
+    """
     item_df = item_df[item_df[ITEM_ID].isin(df[ITEM_ID])]
     item_df = item_df[[ITEM_ID, MERCHANT_ID, BRAND_ID, CATEGORY_ID]]
-    item_df = item_df.drop_duplicates()
+    return item_df.drop_duplicates()
+
+
+def get_regression_input_paths() -> list:
+    """
+    :return: paths to the cleaned files and item data the regression data is computed from
+    """
+    return get_cleaned_file_paths('cleaned_logistics_detail') + get_cleaned_file_paths('cleaned_order_data') + \
+        get_cleaned_file_paths('cleaned_order_summary') + [get_item_dimension_path()]
 
+
+def compute_regression_action_time() -> pandas.DataFrame:
+    """
+    Load the cleaned data and compute the action times used by the regressions
+    :return: dataframe with the REGRESSION_ACTION_TIME_COLUMNS of every action, see compute_action_time
+    """
+    full_logistics_data_df = load_full_logistics_data(
+        columns=ACTION_TIME_LOGISTICS_COLUMNS + [LOGISTIC_COMPANY_ID])
+    full_order_data_df = load_full_order_data(columns=ACTION_TIME_ORDER_COLUMNS + [ITEM_ID, MERCHANT_ID])
+    full_order_summary_df = load_full_order_summary(columns=[ORDER_ID, SIGN_TIME])
+    return compute_action_time(full_logistics_data_df, full_order_data_df, full_order_summary_df,
+                               columns=REGRESSION_ACTION_TIME_COLUMNS)
+
+
+def bin_regression_action_time(df: pandas.DataFrame, bin_size: float = BIN_SIZE) -> pandas.DataFrame:
+    """
+    Bin the action times and prepare them for the regressions
+    :param df: dataframe returned by compute_regression_action_time
+    :param bin_size: size of each action time bin
+    :return: prepared dataframe, see prepare_action_time
+    """
+    return prepare_action_time(bin_action_time(df, bin_size=bin_size))
+
+
+def compute_regression_data(df: pandas.DataFrame) -> pandas.DataFrame:
+    """
+    Add the dummy variables of the regressions
+    :param df: dataframe returned by bin_regression_action_time
+    :return: dataframe with dummy variables added, see add_dummy_variables
+    """
+    # Clean up item info
+    item_df = prepare_item_data(load_item_dimension(), df)
     # Add dummy variable for analysis
-    df = add_dummy_variables(df, item_df)
+    return add_dummy_variables(df, item_df, load_full_order_summary())
+
+
+def load_regression_data(bin_size: float = BIN_SIZE) -> pandas.DataFrame:
+    """
+    Load the cleaned data and compute the regression data of figure 3
+    :param bin_size: size of each action time bin
+    :return: dataframe with dummy variables added, see add_dummy_variables
+    """
+    return compute_regression_data(bin_regression_action_time(compute_regression_action_time(), bin_size))
+
+
+def get_regression_data_stage(bin_size: float = BIN_SIZE) -> Stage:
+    """
+    Get the pipeline stages computing the regression data of figure 3, the action times are shared by every bin size
+    :param bin_size: size of each action time bin
+    :return: stage computing the regression data, see load_regression_data
+    """
+    action_time_stage = Stage(
+        'regression_action_time', compute_regression_action_time, input_paths=get_regression_input_paths,
+        functions=[compute_action_time, get_order_segments, lookup_orders, get_event_segments, first_segment_times])
+    binned_action_time_stage = Stage(
+        'binned_regression_action_time', bin_regression_action_time, [action_time_stage], {'bin_size': bin_size},
+        functions=[bin_action_time, compute_bin_codes, get_action_time_bins, prepare_action_time])
+    return Stage('regression_data', compute_regression_data, [binned_action_time_stage],
+                 input_paths=get_regression_input_paths,
+                 functions=[prepare_item_data, add_dummy_variables, filter_less_than_5000, lookup_items,
+                            count_segment_values])
+
+
+def get_shard_input_paths(shard_index: int) -> list:
+    """
+    :param shard_index: index of the shard
+    :return: paths to the cleaned files of the shard
+    """
+    return [get_cleaned_shard_file_paths(file_name)[shard_index]
+            for file_name in ['cleaned_logistics_detail', 'cleaned_order_data', 'cleaned_order_summary']]
+
+
+def compute_shard_regression_action_time(shard_index: int) -> pandas.DataFrame:
+    """
+    Load the cleaned data of one shard and compute the action times used by the regressions
+    :param shard_index: index of the shard
+    :return: dataframe with the REGRESSION_ACTION_TIME_COLUMNS of every action of the shard, see compute_action_time
+    """
+    logistics_data_df = load_shard_logistics_data(
+        shard_index, columns=ACTION_TIME_LOGISTICS_COLUMNS + [LOGISTIC_COMPANY_ID])
+    order_data_df = load_shard_order_data(
+        shard_index, columns=ACTION_TIME_ORDER_COLUMNS + [ITEM_ID, MERCHANT_ID])
+    order_summary_df = load_shard_order_summary(shard_index, columns=[ORDER_ID, SIGN_TIME])
+    return compute_action_time(logistics_data_df, order_data_df, order_summary_df,
+                               columns=REGRESSION_ACTION_TIME_COLUMNS)
+
+
+def get_shard_binned_action_time_stage(shard_index: int, bin_size: float = BIN_SIZE) -> Stage:
+    """
+    Get the pipeline stages computing the binned action times of one shard
+    :param shard_index: index of the shard
+    :param bin_size: size of each action time bin
+    :return: stage computing the binned action times of the shard, see bin_regression_action_time
+    """
+    action_time_stage = Stage(
+        'shard_regression_action_time', compute_shard_regression_action_time, parameters={'shard_index': shard_index},
+        input_paths=lambda: get_shard_input_paths(shard_index),
+        functions=[compute_action_time, get_order_segments, lookup_orders, get_event_segments, first_segment_times])
+    return Stage('shard_binned_regression_action_time', bin_regression_action_time, [action_time_stage],
+                 {'bin_size': bin_size},
+                 functions=[bin_action_time, compute_bin_codes, get_action_time_bins, prepare_action_time])
+
+
+def compute_sharded_regression_cells(bin_size: float = BIN_SIZE, force: bool = False) -> RegressionCells:
+    """
+    Compute the regression cells one shard at a time and merge them, so that only one shard is in memory. Every order
+    is in one shard, so the action times and dummy variables of a shard only depend on the shard. The items are
+    prepared once for the items of every shard, so rare item levels are collapsed as for the full data
+    :param bin_size: size of each action time bin
+    :param force: compute the binned action times of every shard even if they are up to date
+    :return: regression cells, equal to those of the full data up to the rounding of the sums
+    """
+    pipeline = get_pipeline()
+    stages = {shard_index: get_shard_binned_action_time_stage(shard_index, bin_size)
+              for shard_index in get_cleaned_shard_indices()}
+    item_ids = pandas.Index([], dtype=np.int64)
+    for stage in stages.values():
+        item_ids = item_ids.union(pipeline.run(stage, force)[ITEM_ID].unique())
+    item_df = prepare_item_data(load_item_dimension(), pandas.DataFrame({ITEM_ID: item_ids}))
+
+    cells = []
+    for shard_index, stage in stages.items():
+        logging.info(f'computing regression cells of shard {shard_index}')
+        df = add_dummy_variables(pipeline.run(stage), item_df.copy(), load_shard_order_summary(shard_index))
+        cells.append(RegressionCells.from_dataframe(df, LOGISTICS_REVIEW_SCORE, CANDIDATE_REGRESSORS,
+                                                    SPLITTING_COLUMNS, ACTION_TIME_INTERVAL))
+        del df
+    return RegressionCells.merge(cells)
+
+
+def load_regression_cells(bin_size: float = BIN_SIZE, force: bool = False, streaming: bool = False) -> RegressionCells:
+    """
+    Load the regression cells of every splitting column and candidate regressor from the cache in the cleaned data
+    directory. They are computed when the cleaned data, the code computing them or the bin size changed, from the
+    regression data cached by the pipeline
+    :param bin_size: size of each action time bin
+    :param force: compute the cells and the regression data even if they are up to date
+    :param streaming: compute the cells one shard at a time, see compute_sharded_regression_cells
+    :return: regression cells
+    """
+    functions = [get_regression_data_stage, compute_regression_action_time, bin_regression_action_time,
+                 compute_regression_data, compute_action_time, bin_action_time, prepare_action_time,
+                 prepare_item_data, add_dummy_variables, filter_less_than_5000, lookup_items, count_segment_values,
+                 RegressionCells.from_dataframe, build_design_matrix, compute_cell_cross_products,
+                 compute_shard_regression_action_time, compute_sharded_regression_cells, RegressionCells.merge]
+    cache_path = os.path.join(get_cleaned_data_dir(), REGRESSION_CACHE_DIR, f'regression_cells_{bin_size}.npz')
+    return get_cached_regression_cells(
+        cache_path, get_regression_input_paths(), functions,
+        {'bin_size': bin_size, 'x_columns': CANDIDATE_REGRESSORS, 'split_columns': SPLITTING_COLUMNS},
+        lambda: compute_sharded_regression_cells(bin_size, force) if streaming else RegressionCells.from_dataframe(
+            get_pipeline().run(get_regression_data_stage(bin_size), force), LOGISTICS_REVIEW_SCORE,
+            CANDIDATE_REGRESSORS, SPLITTING_COLUMNS, ACTION_TIME_INTERVAL),
+        force)
+
 
-    action_count_coefficients, action_count_lower_conf_ints, action_count_upper_conf_ints = run_ols(
-        df, SHIPMENT_ACTION_COUNT, range(4, 11))
-    day_coefficients, day_lower_conf_ints, day_upper_conf_ints = run_ols(df, DAY_COUNT, range(2, 9))
+def main(alpha: float = 0.1, force: bool = False, streaming: bool = False):
+    cells = load_regression_cells(force=force, streaming=streaming)
+    action_count_coefficients, action_count_lower_conf_ints, action_count_upper_conf_ints = run_cached_ols(
+        cells, SHIPMENT_ACTION_COUNT, range(4, 11), alpha)
+    day_coefficients, day_lower_conf_ints, day_upper_conf_ints = run_cached_ols(cells, DAY_COUNT, range(2, 9), alpha)
 
     # Plot
     plt.figure(figsize=(12, 8))
@@ -0,0 +1,165 @@
+import hashlib
+import json
+import logging
+import os.path
+import time
+
+import pandas as pd
+
+from data_processing import fingerprint_files, get_cleaned_data_dir, read_feather
+from .regression_cache import fingerprint_functions
+
+PIPELINE_CACHE_DIR = 'pipeline_cache'
+PIPELINE_INDEX_FILE_NAME = 'index.json'
+DEFAULT_DISK_BUDGET = 20 * 1024 ** 3
+
+
+class Stage:
+    """
+    Step of an analysis computing a dataframe from the outputs of upstream stages, the files it reads and its
+    parameters. A stage is identified by a key hashing all of these and the code of its functions, so its output can
+    be cached and reused until one of them changes
+    """
+
+    def __init__(self, name: str, function, inputs: list = None, parameters: dict = None, input_paths=None,
+                 functions: list = None):
+        """
+        :param name: name of the stage, used to name its artifacts
+        :param function: function computing the output, called with the outputs of the input stages followed by the
+            parameters as keyword arguments
+        :param inputs: stages the output is computed from
+        :param parameters: keyword arguments of the function, must be json serializable
+        :param input_paths: function returning the paths to the files the stage reads, e.g. get_cleaned_file_paths,
+            called when the pipeline runs so that the paths follow the configured data directory
+        :param functions: other functions the output depends on, their code is hashed with the code of function
+        """
+        self.name = name
+        self.function = function
+        self.inputs = list(inputs or [])
+        self.parameters = dict(parameters or {})
+        self.input_paths = input_paths
+        self.functions = [function] + list(functions or [])
+
+
+class Pipeline:
+    """
+    Runs stages and caches their outputs as feather artifacts in a directory. A stage whose artifact is up to date is
+    loaded without running it or any of its upstream stages, otherwise its inputs are loaded from the nearest up to
+    date artifacts upstream. Artifacts are evicted least recently used first to keep the directory within a disk budget
+    """
+
+    def __init__(self, cache_dir: str, disk_budget: int = DEFAULT_DISK_BUDGET):
+        """
+        :param cache_dir: directory of the artifacts
+        :param disk_budget: bytes the artifacts may take, the artifact of the stage that last ran is always kept
+        """
+        self.cache_dir = cache_dir
+        self.disk_budget = disk_budget
+        self.index = self.load_index()
+
+    def get_index_path(self) -> str:
+        """
+        :return: path to the index recording the size and last use of every artifact and the input fingerprints
+        """
+        return os.path.join(self.cache_dir, PIPELINE_INDEX_FILE_NAME)
+
+    def load_index(self) -> dict:
+        """
+        Load the index of the artifacts, artifacts missing from the directory are forgotten
+        :return: index with the artifacts by file name and the fingerprints of the input files by path
+        """
+        index = {'artifacts': {}, 'inputs': {}}
+        if os.path.exists(self.get_index_path()):
+            with open(self.get_index_path()) as file:
+                index = json.load(file)
+        index['artifacts'] = {file_name: artifact for file_name, artifact in index['artifacts'].items()
+                              if os.path.exists(os.path.join(self.cache_dir, file_name))}
+        return index
+
+    def save_index(self):
+        """
+        Save the index of the artifacts, the previous index is replaced atomically
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(f'{self.get_index_path()}.tmp', 'w') as file:
+            json.dump(self.index, file, indent=2)
+        os.replace(f'{self.get_index_path()}.tmp', self.get_index_path())
+
+    def get_key(self, stage: Stage, keys: dict = None) -> str:
+        """
+        Get the key of the output of a stage from its code, parameters, input files and the keys of its inputs
+        :param stage: stage to get the key of
+        :param keys: keys already computed in this run by stage, to fingerprint shared upstream stages once
+        :return: hash identifying the output
+        """
+        keys = {} if keys is None else keys
+        if stage not in keys:
+            input_fingerprints = fingerprint_files(stage.input_paths() if stage.input_paths else [],
+                                                   self.index['inputs'])
+            self.index['inputs'].update(input_fingerprints)
+            key = {
+                'name': stage.name,
+                'functions': fingerprint_functions(stage.functions),
+                'parameters': stage.parameters,
+                'files': {file_path: fingerprint['hash'] for file_path, fingerprint in input_fingerprints.items()},
+                'inputs': [self.get_key(input_stage, keys) for input_stage in stage.inputs],
+            }
+            keys[stage] = hashlib.blake2b(json.dumps(key, sort_keys=True).encode(), digest_size=16).hexdigest()
+        return keys[stage]
+
+    def run(self, stage: Stage, force: bool = False) -> pd.DataFrame:
+        """
+        Get the output of a stage, loaded from its artifact if it is up to date or computed and cached otherwise
+        :param stage: stage to run
+        :param force: compute the stage and every upstream stage even if their artifacts are up to date
+        :return: output of the stage
+        """
+        output = self._run(stage, force, {})
+        self.save_index()
+        return output
+
+    def _run(self, stage: Stage, force: bool, keys: dict) -> pd.DataFrame:
+        file_name = f'{stage.name}_{self.get_key(stage, keys)}.feather'
+        file_path = os.path.join(self.cache_dir, file_name)
+        if not force and file_name in self.index['artifacts']:
+            logging.info(f'loading {stage.name} from {file_path}')
+            self.index['artifacts'][file_name]['last_used'] = time.time()
+            return read_feather(file_path)
+
+        inputs = [self._run(input_stage, force, keys) for input_stage in stage.inputs]
+        logging.info(f'computing {stage.name}')
+        output = stage.function(*inputs, **stage.parameters)
+        del inputs
+        os.makedirs(self.cache_dir, exist_ok=True)
+        output.to_feather(f'{file_path}.tmp')
+        os.replace(f'{file_path}.tmp', file_path)
+        self.index['artifacts'][file_name] = {
+            'stage': stage.name, 'size': os.path.getsize(file_path), 'last_used': time.time()}
+        logging.info(f'cached {stage.name} in {file_path}')
+        self.evict(keep=file_name)
+        return output
+
+    def evict(self, keep: str = None):
+        """
+        Delete the least recently used artifacts until the artifacts fit within the disk budget
+        :param keep: file name of an artifact that is never deleted
+        """
+        artifacts = self.index['artifacts']
+        total_size = sum(artifact['size'] for artifact in artifacts.values())
+        for file_name in sorted(artifacts, key=lambda name: artifacts[name]['last_used']):
+            if total_size <= self.disk_budget:
+                break
+            if file_name == keep:
+                continue
+            logging.info(f'evicting {file_name} to stay within the disk budget')
+            os.remove(os.path.join(self.cache_dir, file_name))
+            total_size -= artifacts.pop(file_name)['size']
+
+
+def get_pipeline(disk_budget: int = DEFAULT_DISK_BUDGET) -> Pipeline:
+    """
+    Get the pipeline caching its artifacts in the cleaned data directory
+    :param disk_budget: bytes the artifacts may take
+    :return: pipeline
+    """
+    return Pipeline(os.path.join(get_cleaned_data_dir(), PIPELINE_CACHE_DIR), disk_budget)
@@ -0,0 +1,220 @@
+import hashlib
+import inspect
+import json
+import logging
+import os.path
+
+import numpy as np
+import pandas as pd
+
+from data_processing import fingerprint_files
+from .batched_ols import CONSTANT, build_design_matrix, compute_cell_cross_products, get_cell_codes, solve_cell_ols, \
+    split_cross_products
+
+REGRESSION_CACHE_DIR = 'regression_cache'
+
+
+def fingerprint_functions(functions: list) -> dict:
+    """
+    Fingerprint functions with a hash of their source code
+    :param functions: functions to fingerprint
+    :return: dict mapping the qualified name of each function to its hash
+    """
+    return {f'{function.__module__}.{function.__qualname__}': hashlib.blake2b(
+        inspect.getsource(function).encode(), digest_size=8).hexdigest() for function in functions}
+
+
+def get_regression_cache_key(input_fingerprints: dict, function_fingerprints: dict, parameters: dict) -> str:
+    """
+    Get the key identifying the regression data computed from the given inputs, code and parameters
+    :param input_fingerprints: fingerprints of the input files, see fingerprint_files
+    :param function_fingerprints: fingerprints of the functions computing the regression data, see fingerprint_functions
+    :param parameters: parameters the regression data depends on, e.g. the bin size
+    :return: hash of the content of the inputs, the code and the parameters
+    """
+    key = {
+        'inputs': {file_path: fingerprint['hash'] for file_path, fingerprint in input_fingerprints.items()},
+        'functions': function_fingerprints,
+        'parameters': parameters,
+    }
+    return hashlib.blake2b(json.dumps(key, sort_keys=True).encode(), digest_size=16).hexdigest()
+
+
+class RegressionCells:
+    """
+    Sufficient statistics of the regressions of figure 3. For every splitting column, the cross product matrix of the
+    regressand and every candidate regressor is kept for each (split value, action time bin) cell. Any subset of the
+    candidate regressors can be regressed in any selection of cells without the underlying data
+    """
+
+    def __init__(self, y_column: str, x_columns: list, bins: np.ndarray, split_values: dict, cross_products: dict,
+                 observation_counts: dict):
+        """
+        :param y_column: regressand
+        :param x_columns: candidate regressors
+        :param bins: action time bins
+        :param split_values: values of every splitting column
+        :param cross_products: cross product matrices of [X|y] by splitting column, shaped split values × bins × k × k
+        :param observation_counts: number of observations by splitting column, shaped split values × bins
+        """
+        self.y_column = y_column
+        self.x_columns = list(x_columns)
+        self.bins = np.asarray(bins, dtype=np.float64)
+        self.split_values = {column: np.asarray(values, dtype=np.float64) for column, values in split_values.items()}
+        self.cross_products = cross_products
+        self.observation_counts = observation_counts
+
+    @classmethod
+    def from_dataframe(cls, df: pd.DataFrame, y_column: str, x_columns: list, split_columns: list,
+                       bin_column: str) -> 'RegressionCells':
+        """
+        Compute the cross products of every cell, with one pass over the data per splitting column
+        :param df: regression data, the constant regressor CONSTANT is added if it is a candidate regressor
+        :param y_column: regressand
+        :param x_columns: candidate regressors
+        :param split_columns: columns the regressions are split by, e.g. [SHIPMENT_ACTION_COUNT, DAY_COUNT]
+        :param bin_column: action time bin column
+        :return: regression cells
+        """
+        data = build_design_matrix(df, x_columns + [y_column])
+        bins = np.sort(df[bin_column].dropna().unique().astype(np.float64))
+        split_values, cross_products, observation_counts = {}, {}, {}
+        for split_column in split_columns:
+            values = np.sort(df[split_column].dropna().unique().astype(np.float64))
+            cell_codes = get_cell_codes(df, [split_column, bin_column], [values, bins])
+            cell_cross_products, cell_counts = compute_cell_cross_products(data, cell_codes, len(values) * len(bins))
+            split_values[split_column] = values
+            cross_products[split_column] = cell_cross_products.reshape(
+                len(values), len(bins), data.shape[1], data.shape[1])
+            observation_counts[split_column] = cell_counts.reshape(len(values), len(bins))
+        return cls(y_column, x_columns, bins, split_values, cross_products, observation_counts)
+
+    @classmethod
+    def merge(cls, cells: list) -> 'RegressionCells':
+        """
+        Merge the cells computed from parts of the data, e.g. from every shard, by adding their cross products. Split
+        values and bins missing from a part have no observations in it
+        :param cells: regression cells with the same regressand, candidate regressors and splitting columns
+        :return: regression cells of all the parts
+        """
+        first = cells[0]
+        if any(part.y_column != first.y_column or part.x_columns != first.x_columns or
+               list(part.split_values) != list(first.split_values) for part in cells):
+            raise ValueError('Regression cells with different variables or splitting columns can\'t be merged')
+        bins = np.unique(np.concatenate([part.bins for part in cells]))
+        split_values, cross_products, observation_counts = {}, {}, {}
+        for split_column in first.split_values:
+            values = np.unique(np.concatenate([part.split_values[split_column] for part in cells]))
+            variable_count = first.cross_products[split_column].shape[-1]
+            split_values[split_column] = values
+            cross_products[split_column] = np.zeros((len(values), len(bins), variable_count, variable_count))
+            observation_counts[split_column] = np.zeros((len(values), len(bins)), dtype=np.int64)
+            for part in cells:
+                part_cells = np.ix_(np.searchsorted(values, part.split_values[split_column]),
+                                    np.searchsorted(bins, part.bins))
+                cross_products[split_column][part_cells] += part.cross_products[split_column]
+                observation_counts[split_column][part_cells] += part.observation_counts[split_column]
+        return cls(first.y_column, first.x_columns, bins, split_values, cross_products, observation_counts)
+
+    def run_ols(self, split_column: str, split_values, x_columns: list, alpha: float = 0.05, bins=None) -> dict:
+        """
+        Regress the regressand on a subset of the candidate regressors in the selected cells
+        :param split_column: column the regressions are split by
+        :param split_values: values of the splitting column to run regressions for, values without data give NaN
+        :param x_columns: regressors, a subset of the candidate regressors
+        :param alpha: significance level of the confidence intervals
+        :param bins: action time bins to run regressions for, every bin if None
+        :return: results of every cell, see solve_cell_ols, each array has a leading split value and bin axis
+        """
+        bins = self.bins if bins is None else np.asarray(bins, dtype=np.float64)
+        value_indices = pd.Index(self.split_values[split_column]).get_indexer(np.asarray(split_values, dtype=float))
+        bin_indices = pd.Index(self.bins).get_indexer(bins)
+        variable_indices = [self.x_columns.index(column) for column in x_columns] + [len(self.x_columns)]
+
+        # An empty cell is appended to both cell axes, values and bins that are not cached have index -1 and select it
+        cross_products = np.pad(
+            self.cross_products[split_column][..., variable_indices, :][..., variable_indices],
+            ((0, 1), (0, 1), (0, 0), (0, 0)))[np.ix_(value_indices, bin_indices)]
+        observation_counts = np.pad(self.observation_counts[split_column], ((0, 1), (0, 1)))[
+            np.ix_(value_indices, bin_indices)]
+
+        cell_shape = observation_counts.shape
+        xtx, xty, yty = split_cross_products(cross_products.reshape(-1, *cross_products.shape[2:]))
+        results = solve_cell_ols(xtx, xty, yty, observation_counts.reshape(-1), alpha)
+        return {name: result.reshape(cell_shape + result.shape[1:]) for name, result in results.items()}
+
+    def save(self, file_path: str, key: str, input_fingerprints: dict):
+        """
+        Save the cells, the previous file is replaced atomically
+        :param file_path: path to the npz file
+        :param key: cache key of the cells, see get_regression_cache_key
+        :param input_fingerprints: fingerprints of the input files, kept so that unchanged inputs are not hashed again
+        """
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        metadata = {
+            'key': key, 'inputs': input_fingerprints, 'y_column': self.y_column, 'x_columns': self.x_columns,
+            'split_columns': list(self.split_values),
+        }
+        arrays = {'bins': self.bins}
+        for index, split_column in enumerate(self.split_values):
+            arrays[f'split_values_{index}'] = self.split_values[split_column]
+            arrays[f'cross_products_{index}'] = self.cross_products[split_column]
+            arrays[f'observation_counts_{index}'] = self.observation_counts[split_column]
+        with open(f'{file_path}.tmp', 'wb') as file:
+            np.savez(file, metadata=np.array(json.dumps(metadata)), **arrays)
+        os.replace(f'{file_path}.tmp', file_path)
+
+
+def load_regression_cells_metadata(file_path: str) -> dict:
+    """
+    Load the metadata of cached regression cells without loading the cells
+    :param file_path: path to the npz file written by RegressionCells.save
+    :return: metadata with the cache key and input fingerprints, None if there is no cache
+    """
+    if not os.path.exists(file_path):
+        return None
+    with np.load(file_path) as arrays:
+        return json.loads(str(arrays['metadata']))
+
+
+def load_regression_cells(file_path: str) -> RegressionCells:
+    """
+    Load cached regression cells
+    :param file_path: path to the npz file written by RegressionCells.save
+    :return: regression cells
+    """
+    with np.load(file_path) as arrays:
+        metadata = json.loads(str(arrays['metadata']))
+        split_columns = metadata['split_columns']
+        return RegressionCells(
+            metadata['y_column'], metadata['x_columns'], arrays['bins'],
+            {column: arrays[f'split_values_{index}'] for index, column in enumerate(split_columns)},
+            {column: arrays[f'cross_products_{index}'] for index, column in enumerate(split_columns)},
+            {column: arrays[f'observation_counts_{index}'] for index, column in enumerate(split_columns)})
+
+
+def get_cached_regression_cells(file_path: str, input_paths: list, functions: list, parameters: dict,
+                                compute_cells, force: bool = False) -> RegressionCells:
+    """
+    Load the regression cells from the cache, or compute and cache them if the inputs, the functions computing them or
+    the parameters changed since they were cached
+    :param file_path: path to the cache file
+    :param input_paths: paths to the files the cells are computed from
+    :param functions: functions the cells are computed with
+    :param parameters: parameters the cells depend on, e.g. the bin size
+    :param compute_cells: function computing the cells
+    :param force: compute the cells even if the cache is up to date
+    :return: regression cells
+    """
+    metadata = load_regression_cells_metadata(file_path)
+    input_fingerprints = fingerprint_files(input_paths, metadata['inputs'] if metadata is not None else None)
+    key = get_regression_cache_key(input_fingerprints, fingerprint_functions(functions), parameters)
+    if not force and metadata is not None and metadata['key'] == key:
+        logging.info(f'loading regression cells from {file_path}')
+        return load_regression_cells(file_path)
+
+    logging.info(f'computing regression cells, {"forced" if force else "cache missing or outdated"}')
+    cells = compute_cells()
+    cells.save(file_path, key, input_fingerprints)
+    logging.info(f'cached regression cells in {file_path}')
+    return cells
@@ -0,0 +1,240 @@
+# Script to benchmark the data pipeline on synthetic data
+import argparse
+import datetime
+import json
+import logging
+import os.path
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+
+import data_processing.data_loader as data_loader
+from data_processing import *
+from constants import *
+from reproduction import *
+from reproduction import figure3
+
+DEFAULT_EVENT_COUNT = 100_000
+DEFAULT_OUTPUT = 'benchmark_results.jsonl'
+
+
+def get_commit() -> str:
+    """
+    Get the commit the benchmarks run on
+    :return: short hash of the checked out commit, suffixed with -dirty if there are uncommitted changes
+    """
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_dir, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=repo_dir,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return f'{commit}-dirty' if dirty else commit
+
+
+def measure(function, setup, repeat: int) -> dict:
+    """
+    Measure a function, the setup is run before every call and is not measured
+    :param function: function to measure, called with the arguments returned by setup
+    :param setup: function returning the arguments of a call
+    :param repeat: number of timed calls
+    :return: fastest and mean wall time of the timed calls in seconds, and the peak memory of an additional call
+    """
+    seconds = []
+    for _ in range(repeat):
+        arguments = setup()
+        start_time = time.perf_counter()
+        function(*arguments)
+        seconds.append(time.perf_counter() - start_time)
+        del arguments
+
+    # Tracing slows allocations down, so the peak memory is measured on a separate untimed call
+    arguments = setup()
+    tracemalloc.start()
+    function(*arguments)
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'seconds': min(seconds), 'mean_seconds': sum(seconds) / len(seconds), 'peak_memory': peak_memory}
+
+
+def write_cleaned_dataset(root_dir: str, indices: list):
+    """
+    Clean the synthetic shards and write them in the layout read by the load_full_* functions
+    :param root_dir: directory containing the synthetic dataset
+    :param indices: indices of the shards
+    """
+    for index in indices:
+        logistics_data_df = read_logistics_csv(
+            os.path.join(root_dir, f'data_{index}', f'msom_logistic_detail_{index}.csv'))
+        order_data_df = read_order_csv(os.path.join(root_dir, f'data_{index}', f'msom_order_data_{index}.csv'))
+        data_cleaner = DataCleaner(order_data_df, logistics_data_df)
+        data_cleaner.fused_clean_up()
+        data_cleaner.export_data(root_dir, index)
+    write_dimension_tables(root_dir)
+
+
+def run_benchmarks(args: argparse.Namespace, root_dir: str) -> list:
+    """
+    Generate a synthetic dataset in root_dir and measure every benchmark selected on the command line
+    :param args: parsed command line arguments
+    :param root_dir: directory to write the synthetic dataset in
+    :return: result of every benchmark
+    """
+    indices = list(range(1, args.shards + 1))
+    shard_event_count = args.events // args.shards
+    results = []
+
+    def record(benchmark: str, row_count: int, measurement: dict):
+        result = {
+            'benchmark': benchmark, 'commit': args.commit, 'events': args.events, 'shards': args.shards,
+            'seed': args.seed, 'rows': int(row_count), 'repeat': args.repeat, **measurement,
+            'rows_per_second': row_count / measurement['seconds'] if measurement['seconds'] else None,
+            'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        }
+        logging.info(f'{benchmark}: {result["seconds"]:.3f}s, {result["rows_per_second"]:,.0f} rows/s, '
+                     f'peak memory {result["peak_memory"] / 1024 ** 2:,.1f}MB')
+        results.append(result)
+
+    def is_selected(benchmark: str) -> bool:
+        return not args.benchmarks or benchmark in args.benchmarks
+
+    if is_selected('generate_synthetic_data'):
+        record('generate_synthetic_data', shard_event_count, measure(
+            generate_synthetic_data, lambda: (shard_event_count, args.seed), args.repeat))
+    write_synthetic_dataset(root_dir, shard_event_count, indices, args.seed)
+
+    # Cleaning, measured on the first shard
+    logistics_data_df = read_logistics_csv(os.path.join(root_dir, 'data_1', 'msom_logistic_detail_1.csv'))
+    order_data_df = read_order_csv(os.path.join(root_dir, 'data_1', 'msom_order_data_1.csv'))
+    # The synthetic events are grouped by order, the shuffled benchmarks clean the same events in a random order
+    shuffled_logistics_data_df = logistics_data_df.sample(frac=1, random_state=args.seed, ignore_index=True)
+    for benchmark in ['clean_up', 'fused_clean_up']:
+        for suffix, events_df in [('', logistics_data_df), ('_shuffled', shuffled_logistics_data_df)]:
+            if is_selected(benchmark + suffix):
+                record(benchmark + suffix, events_df.shape[0], measure(
+                    lambda data_cleaner: getattr(data_cleaner, benchmark)(),
+                    lambda: (DataCleaner(order_data_df.copy(), events_df.copy()),), args.repeat))
+    del logistics_data_df, shuffled_logistics_data_df, order_data_df
+
+    # Loading, measured on every shard
+    write_cleaned_dataset(root_dir, indices)
+    data_loader.CLEANED_DATA_DIR_ROOT = os.path.join(root_dir, 'cleaned')
+    loaders = {
+        'load_full_logistics_data': lambda: load_full_logistics_data(
+            columns=ACTION_TIME_LOGISTICS_COLUMNS + [LOGISTIC_COMPANY_ID]),
+        'load_full_order_data': lambda: load_full_order_data(
+            columns=ACTION_TIME_ORDER_COLUMNS + [ITEM_ID, MERCHANT_ID]),
+        'load_full_order_summary': load_full_order_summary,
+        'load_item_dimension': load_item_dimension,
+    }
+    loaded = {benchmark: loader() for benchmark, loader in loaders.items()}
+    for benchmark, loader in loaders.items():
+        if is_selected(benchmark):
+            record(benchmark, loaded[benchmark].shape[0], measure(loader, tuple, args.repeat))
+    logistics_data_df = loaded['load_full_logistics_data']
+    order_data_df = loaded['load_full_order_data']
+    order_summary_df = loaded['load_full_order_summary']
+    item_df = loaded['load_item_dimension']
+
+    # Analyses, each measured on the output of the previous step as run by figure3.main
+    if is_selected('compute_action_time'):
+        record('compute_action_time', logistics_data_df.shape[0], measure(
+            compute_action_time, lambda: (logistics_data_df, order_data_df, order_summary_df), args.repeat))
+    if is_selected('compute_action_time_distribution_difference'):
+        record('compute_action_time_distribution_difference', logistics_data_df.shape[0], measure(
+            compute_action_time_distribution_difference, lambda: (logistics_data_df, order_data_df, 0.1,
+                                                                  order_summary_df), args.repeat))
+    action_time_df = compute_action_time(logistics_data_df, order_data_df, order_summary_df)
+    if is_selected('bin_action_time'):
+        record('bin_action_time', action_time_df.shape[0], measure(
+            bin_action_time, lambda: (action_time_df.copy(), 0.05), args.repeat))
+    df = figure3.prepare_action_time(bin_action_time(action_time_df, bin_size=0.05))
+    item_df = figure3.prepare_item_data(item_df, df)
+    if is_selected('add_dummy_variables'):
+        record('add_dummy_variables', df.shape[0], measure(
+            add_dummy_variables, lambda: (df.copy(), item_df.copy(), order_summary_df), args.repeat))
+    df = add_dummy_variables(df, item_df, order_summary_df)
+    if is_selected('run_ols'):
+        record('run_ols', df.shape[0], measure(
+            figure3.run_ols, lambda: (df, SHIPMENT_ACTION_COUNT, range(4, 11)), args.repeat))
+    return results
+
+
+def load_baseline(baseline_path: str) -> dict:
+    """
+    Load the latest result of every benchmark and scale from a results file
+    :param baseline_path: path to the json lines file with the baseline results
+    :return: dict mapping the benchmark, event count and shard count to the latest result
+    """
+    baseline = {}
+    with open(baseline_path) as file:
+        for line in file:
+            result = json.loads(line)
+            baseline[(result['benchmark'], result['events'], result['shards'])] = result
+    return baseline
+
+
+def log_comparison(results: list, baseline: dict):
+    """
+    Log the speedup of every benchmark over the baseline result of the same benchmark and scale
+    :param results: results of this run
+    :param baseline: baseline results, see load_baseline
+    """
+    for result in results:
+        baseline_result = baseline.get((result['benchmark'], result['events'], result['shards']))
+        if baseline_result is None:
+            continue
+        logging.info(
+            f'{result["benchmark"]}: {baseline_result["seconds"] / result["seconds"]:.2f}x the speed and '
+            f'{result["peak_memory"] / max(baseline_result["peak_memory"], 1):.2f}x the peak memory of '
+            f'{baseline_result["commit"]}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--events', '-n', type=int, default=DEFAULT_EVENT_COUNT,
+                        help="approximate number of logistics events of the synthetic dataset")
+    parser.add_argument('--shards', '-s', type=int, default=1, help="number of shards the events are split into")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', '-r', type=int, default=3, help="number of timed runs of every benchmark")
+    parser.add_argument('--benchmarks', '-b', nargs='+', default=None,
+                        help="benchmarks to run, e.g. clean_up run_ols, all benchmarks by default")
+    parser.add_argument('--work_dir', '-w', type=str, default=None,
+                        help="directory to write the synthetic dataset in, a temporary directory by default")
+    parser.add_argument('--output', '-o', type=str, default=DEFAULT_OUTPUT,
+                        help="json lines file the results are appended to")
+    parser.add_argument('--baseline', type=str, default=None,
+                        help="json lines file with results of another commit to compare with")
+
+    args = parser.parse_args()
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)-8s %(message)s',
+        level=logging.INFO,
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+    args.commit = get_commit()
+    # Loaded first, the results may be appended to the same file
+    baseline = load_baseline(args.baseline) if args.baseline else None
+
+    if args.work_dir:
+        os.makedirs(args.work_dir, exist_ok=True)
+        results = run_benchmarks(args, args.work_dir)
+    else:
+        with tempfile.TemporaryDirectory() as work_dir:
+            results = run_benchmarks(args, work_dir)
+
+    with open(args.output, 'a') as file:
+        for result in results:
+            file.write(json.dumps(result) + '\n')
+    logging.info(f'appended {len(results)} results to {args.output}')
+    if baseline is not None:
+        log_comparison(results, baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,63 +3,406 @@ import argparse
 import gc
 import logging
 import os.path
+import sys
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 
 import pandas as pd
 
-from data_processing import DataCleaner
+from data_processing import *
 from constants import *
 
-LOGISTICS_COLUMN_NAMES = [ORDER_ID, ORDER_DATE, LOGISTICS_ORDER_ID, ACTION, FACILITY_ID, FACILITY_TYPE, CITY_ID,
-                          LOGISTIC_COMPANY_ID, TIMESTAMP]
-LOGISTICS_COLS = [0, 1, 2, 3, 4, 5, 6, 7, 8]
-ORDER_COLUMN_NAMES = [DAY, ORDER_ID, ITEM_DETAIL_INFO, PAY_TIMESTAMP, BUYER_ID, PROMISE_SPEED, IF_CAINIAO, MERCHANT_ID,
-                      LOGISTICS_REVIEW_SCORE]
-ORDER_COLS = [0, 1, 2, 3, 4, 5, 6, 7, 8]
 
-# LOGISTICS_COLUMN_NAMES = [ORDER_ID, ORDER_DATE, ACTION, FACILITY_TYPE, CITY_ID, LOGISTIC_COMPANY_ID, TIMESTAMP]
-# LOGISTICS_COLS = [0, 1, 3, 5, 6, 7, 8]
-# ORDER_COLUMN_NAMES = [ORDER_ID, ITEM_DETAIL_INFO, PAY_TIMESTAMP, PROMISE_SPEED, IF_CAINIAO, LOGISTICS_REVIEW_SCORE]
-# ORDER_COLS = [1, 2, 3, 5, 6, 8]
+# Rough peak memory of cleaning a shard relative to the size of its feather files, see CSV_MEMORY_FACTOR for csv files
+FEATHER_MEMORY_FACTOR = 3
+DEFAULT_CHUNK_SIZE = 1_000_000
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--root", "-r", type=str, required=True)
-    parser.add_argument("--logistics_detail", "-l", type=str, default="msom_logistic_detail")
-    parser.add_argument("--order_data", "-o", type=str, default="msom_order_data")
-    parser.add_argument("--indices", "-i", nargs="+", type=int, default=[i for i in range(1, 8)])
-    parser.add_argument('--feather', "-f", action=argparse.BooleanOptionalAction)
 
-    args = parser.parse_args()
+def configure_logging():
+    """
+    Configure logging for the main process and the worker processes
+    """
     # logging.getLogger().setLevel(logging.INFO)
     logging.basicConfig(
-        format='%(asctime)s %(levelname)-8s %(message)s',
+        format='%(asctime)s %(process)d %(levelname)-8s %(message)s',
         level=logging.INFO,
         datefmt='%Y-%m-%d %H:%M:%S'
     )
 
+
+def get_input_paths(args: argparse.Namespace, index: int) -> (str, str):
+    """
+    Get the paths of the logistics detail and order data files of a shard
+    :param args: parsed command line arguments
+    :param index: index of the shard
+    :return: logistics detail path and order data path
+    """
+    extension = 'feather' if args.feather else 'csv'
+    logistics_detail_path = os.path.join(args.root, f'data_{index}', f'{args.logistics_detail}_{index}.{extension}')
+    order_data_path = os.path.join(args.root, f'data_{index}', f'{args.order_data}_{index}.{extension}')
+    return logistics_detail_path, order_data_path
+
+
+def estimate_shard_memory(args: argparse.Namespace, index: int) -> int:
+    """
+    Estimate the peak memory needed to clean a shard from the size of its input files
+    :param args: parsed command line arguments
+    :param index: index of the shard
+    :return: estimated memory in bytes
+    """
+    if args.streaming:
+        return int(args.bucket_memory * GB)
+    memory_factor = FEATHER_MEMORY_FACTOR if args.feather else CSV_MEMORY_FACTOR
+    return memory_factor * sum(os.path.getsize(path) for path in get_input_paths(args, index))
+
+
+def get_shard_input_files(args: argparse.Namespace, index: int) -> list:
+    """
+    Get the input files a shard is cleaned from
+    :param args: parsed command line arguments
+    :param index: index of the shard
+    :return: paths to the input files
+    """
+    if args.streaming and args.feather:
+        logistics_bucket_dir, order_bucket_dir = get_bucket_dirs(args, index, None)
+        return [get_bucket_path(bucket_dir, bucket) for bucket_dir in (logistics_bucket_dir, order_bucket_dir)
+                for bucket in list_buckets(bucket_dir)]
+    return list(get_input_paths(args, index))
+
+
+def get_settings(args: argparse.Namespace) -> dict:
+    """
+    Get the settings other than the inputs and the cleaning rules that the exported files depend on
+    :param args: parsed command line arguments
+    :return: settings recorded in the manifest
+    """
+    return {'export_format': args.export_format,
+            'partition_by_company': bool(args.partition_by_company) and args.export_format == PARQUET}
+
+
+def get_stale_shards(args: argparse.Namespace, manifest: dict, rule_fingerprints: dict) -> dict:
+    """
+    Find the shards whose inputs, cleaning rules or settings changed since they were last cleaned
+    :param args: parsed command line arguments
+    :param manifest: manifest of the previous runs
+    :param rule_fingerprints: fingerprints of the current cleaning rules, see DataCleaner.get_rule_fingerprints
+    :return: dict mapping the index of every shard to clean to the fingerprints of its input files
+    """
+    stale_shards = {}
     for index in args.indices:
-        logging.info(f'started reading index {index}')
+        shard_entry = manifest['shards'].get(str(index))
+        input_fingerprints = fingerprint_files(
+            get_shard_input_files(args, index), shard_entry['inputs'] if shard_entry else None)
+        reasons = get_stale_reasons(shard_entry, input_fingerprints, rule_fingerprints, get_settings(args))
+        if args.force:
+            reasons.append('forced')
+        if reasons:
+            logging.info(f'cleaning index {index}: {", ".join(reasons)}')
+            stale_shards[index] = input_fingerprints
+        else:
+            logging.info(f'skipping index {index}, inputs, rules and outputs are unchanged')
+            # Keep the modification times current so unchanged files are not hashed again
+            shard_entry['inputs'] = input_fingerprints
+    return stale_shards
+
+
+def get_total_memory() -> int:
+    """
+    Get the physical memory of the machine
+    :return: physical memory in bytes
+    """
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def clean_shard(args: argparse.Namespace, index: int) -> dict:
+    """
+    Read, clean and export a single shard
+    :param args: parsed command line arguments
+    :param index: index of the shard
+    :return: report of the shard containing its shapes before and after cleaning and the time taken
+    """
+    if args.streaming:
+        return clean_shard_in_buckets(args, index)
+    start_time = time.perf_counter()
+    logging.info(f'started reading index {index}')
+    logistics_detail_path, order_data_path = get_input_paths(args, index)
+    skipped_events = None
+    if args.two_phase:
+        # The order only rules are applied first, the events of the orders they remove are never loaded
+        order_data_df = read_feather(order_data_path) if args.feather else read_order_csv(order_data_path)
+        removed_order_rules = DataCleaner.find_orders_removed_by_order_rules(order_data_df)
         if args.feather:
-            logistics_detail_df = pd.read_feather(
-                os.path.join(args.root, f'data_{index}', f'{args.logistics_detail}_{index}.feather'))
-            order_data_df = pd.read_feather(
-                os.path.join(args.root, f'data_{index}', f'{args.order_data}_{index}.feather'))
+            logistics_detail_df, skipped_events = read_feather_excluding_orders(
+                logistics_detail_path, removed_order_rules.index)
         else:
-            logistics_detail_df = pd.read_csv(
-                os.path.join(args.root, f'data_{index}', f'{args.logistics_detail}_{index}.csv'),
-                names=LOGISTICS_COLUMN_NAMES)
-            order_data_df = pd.read_csv(
-                os.path.join(args.root, f'data_{index}', f'{args.order_data}_{index}.csv'),
-                names=ORDER_COLUMN_NAMES)
-        logging.info(f'finished reading index {index}')
-        data_cleaner = DataCleaner(logistics_detail_data_df=logistics_detail_df, order_data_df=order_data_df)
+            logistics_detail_df, skipped_events = read_logistics_csv_excluding_orders(
+                logistics_detail_path, removed_order_rules.index, args.chunk_size)
+    elif args.feather:
+        logistics_detail_df = read_feather(logistics_detail_path)
+        order_data_df = read_feather(order_data_path)
+    else:
+        logistics_detail_df = read_logistics_csv(logistics_detail_path)
+        order_data_df = read_order_csv(order_data_path)
+    logging.info(f'finished reading index {index}')
+    skipped_event_count = 0 if skipped_events is None else int(skipped_events.sum())
+    report = {
+        'index': index,
+        'original_logistics_shape': (logistics_detail_df.shape[0] + skipped_event_count, logistics_detail_df.shape[1]),
+        'original_order_shape': order_data_df.shape,
+    }
+
+    data_cleaner = DataCleaner(logistics_detail_data_df=logistics_detail_df, order_data_df=order_data_df)
+    del logistics_detail_df, order_data_df
+    if args.fused:
+        data_cleaner.fused_clean_up()
+    else:
         data_cleaner.clean_up()
-        data_cleaner.export_data(args.root, index)
+    if skipped_events is not None:
+        data_cleaner.record_skipped_events(removed_order_rules, skipped_events)
+    report['outputs'] = data_cleaner.export_data(args.root, index, args.export_format, args.partition_by_company)
+    report['cleaned_logistics_shape'] = data_cleaner.logistics_data_df.shape
+    report['cleaned_order_shape'] = data_cleaner.order_data_df.shape
+
+    logging.info(f'started cleanup for index {index}')
+    del data_cleaner
+    gc.collect()
+    logging.info(f'finished cleanup for index {index}')
+    report['seconds'] = time.perf_counter() - start_time
+    return report
+
+
+def get_bucket_dirs(args: argparse.Namespace, index: int, partition_dir: str) -> (str, str):
+    """
+    Get the bucket directories of a shard. Csv files are partitioned into partition_dir, feather buckets are the ones
+    written by convert_to_feather.py
+    :param args: parsed command line arguments
+    :param index: index of the shard
+    :param partition_dir: temporary directory to partition csv files in
+    :return: logistics detail bucket directory and order data bucket directory
+    """
+    if args.feather:
+        return (os.path.join(args.root, f'data_{index}', f'{args.logistics_detail}_{index}_buckets'),
+                os.path.join(args.root, f'data_{index}', f'{args.order_data}_{index}_buckets'))
+
+    logistics_detail_path, order_data_path = get_input_paths(args, index)
+    bucket_count = get_bucket_count([logistics_detail_path, order_data_path], args.bucket_memory)
+    logistics_bucket_dir = os.path.join(partition_dir, 'logistics_detail')
+    order_bucket_dir = os.path.join(partition_dir, 'order_data')
+    partition_csv(logistics_detail_path, LOGISTICS_COLUMN_NAMES, logistics_bucket_dir, bucket_count, args.chunk_size,
+                  apply_logistics_schema)
+    partition_csv(order_data_path, ORDER_COLUMN_NAMES, order_bucket_dir, bucket_count, args.chunk_size,
+                  apply_order_schema)
+    return logistics_bucket_dir, order_bucket_dir
+
+
+def clean_shard_in_buckets(args: argparse.Namespace, index: int) -> dict:
+    """
+    Clean a shard one order id bucket at a time. Every cleaning rule only looks at a single order, so cleaning the
+    buckets separately gives the same result as cleaning the whole shard while only one bucket is held in memory
+    :param args: parsed command line arguments
+    :param index: index of the shard
+    :return: report of the shard containing its shapes before and after cleaning and the time taken
+    """
+    start_time = time.perf_counter()
+    report = {'index': index, 'original_logistics_shape': (0, 0), 'original_order_shape': (0, 0)}
+    cleaned_logistics_data = []
+    cleaned_order_data = []
+    cleaned_order_summaries = []
+    # Exported when every bucket is empty
+    empty_logistics_df = apply_logistics_schema(pd.DataFrame(columns=LOGISTICS_COLUMN_NAMES))
+    empty_order_df = apply_order_schema(pd.DataFrame(columns=ORDER_COLUMN_NAMES))
+    audit = CleaningAudit()
+    with tempfile.TemporaryDirectory(dir=os.path.join(args.root, f'data_{index}')) as partition_dir:
+        logistics_bucket_dir, order_bucket_dir = get_bucket_dirs(args, index, partition_dir)
+        for bucket in list_buckets(order_bucket_dir):
+            logging.info(f'started cleaning bucket {bucket} of index {index}')
+            logistics_detail_df = read_bucket(logistics_bucket_dir, bucket)
+            order_data_df = read_bucket(order_bucket_dir, bucket)
+            report['original_logistics_shape'] = (
+                report['original_logistics_shape'][0] + logistics_detail_df.shape[0], logistics_detail_df.shape[1])
+            report['original_order_shape'] = (
+                report['original_order_shape'][0] + order_data_df.shape[0], order_data_df.shape[1])
+            empty_logistics_df, empty_order_df = logistics_detail_df.iloc[:0], order_data_df.iloc[:0]
+            if order_data_df.empty:
+                logging.info(f'skipping bucket {bucket} of index {index} without order data')
+                continue
+
+            data_cleaner = DataCleaner(logistics_detail_data_df=logistics_detail_df, order_data_df=order_data_df)
+            del logistics_detail_df, order_data_df
+            if args.fused:
+                data_cleaner.fused_clean_up()
+            else:
+                data_cleaner.clean_up()
+            cleaned_logistics_data.append(data_cleaner.logistics_data_df)
+            cleaned_order_data.append(data_cleaner.order_data_df)
+            cleaned_order_summaries.append(data_cleaner.get_order_summary())
+            audit.merge(data_cleaner.audit)
+            del data_cleaner
+            gc.collect()
+            logging.info(f'finished cleaning bucket {bucket} of index {index}')
+
+    if cleaned_order_data:
+        data_cleaner = DataCleaner(logistics_detail_data_df=concat_frames(cleaned_logistics_data, ignore_index=True),
+                                   order_data_df=concat_frames(cleaned_order_data, ignore_index=True))
+        data_cleaner.order_summary_df = pd.concat(cleaned_order_summaries, ignore_index=True)
+    else:
+        logging.info(f'every bucket of index {index} is empty, exporting empty tables')
+        data_cleaner = DataCleaner(logistics_detail_data_df=empty_logistics_df.copy(),
+                                   order_data_df=empty_order_df.copy())
+        data_cleaner.order_summary_df = data_cleaner.get_order_summary()
+    data_cleaner.audit = audit
+    del cleaned_logistics_data, cleaned_order_data, cleaned_order_summaries
+    report['outputs'] = data_cleaner.export_data(args.root, index, args.export_format, args.partition_by_company)
+    report['cleaned_logistics_shape'] = data_cleaner.logistics_data_df.shape
+    report['cleaned_order_shape'] = data_cleaner.order_data_df.shape
+    report['seconds'] = time.perf_counter() - start_time
+    return report
+
+
+def clean_shards_in_parallel(args: argparse.Namespace, indices: list, on_report) -> list:
+    """
+    Clean shards in a process pool. A shard is only started when the estimated memory of the shards in flight stays
+    within the memory limit, a shard is always started when nothing else is running
+    :param args: parsed command line arguments
+    :param indices: indices of the shards to clean
+    :param on_report: function called with the report of each shard as soon as it is done
+    :return: reports of the cleaned shards
+    """
+    memory_limit = args.memory_limit * GB if args.memory_limit else get_total_memory()
+    pending = sorted(indices, key=lambda i: estimate_shard_memory(args, i), reverse=True)
+    estimated_memory = {index: estimate_shard_memory(args, index) for index in pending}
+    logging.info(f'cleaning {len(pending)} shards with {args.workers} workers and a memory limit of '
+                 f'{memory_limit / GB:.1f}GB')
+
+    reports = []
+    in_flight = {}
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=configure_logging) as executor:
+        while pending or in_flight:
+            memory_in_flight = sum(estimated_memory[index] for index in in_flight.values())
+            for index in list(pending):
+                if len(in_flight) >= args.workers:
+                    break
+                if in_flight and memory_in_flight + estimated_memory[index] > memory_limit:
+                    continue
+                logging.info(f'submitting index {index}, estimated memory {estimated_memory[index] / GB:.1f}GB')
+                in_flight[executor.submit(clean_shard, args, index)] = index
+                memory_in_flight += estimated_memory[index]
+                pending.remove(index)
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = in_flight.pop(future)
+                try:
+                    reports.append(future.result())
+                except Exception:
+                    logging.exception(f'failed cleaning index {index}')
+                    reports.append({'index': index, 'failed': True})
+                on_report(reports[-1])
+                logging.info(f'progress: {len(reports)}/{len(indices)} shards done, {len(in_flight)} running, '
+                             f'{len(pending)} pending')
+    return reports
+
+
+def log_summary(reports: list):
+    """
+    Log a consolidated summary of the cleaned shards
+    :param reports: reports returned by clean_shard
+    """
+    logging.info('cleanup summary:')
+    for report in sorted(reports, key=lambda r: r['index']):
+        if report.get('failed'):
+            logging.info(f'index {report["index"]}: failed')
+            continue
+        if report.get('skipped'):
+            logging.info(f'index {report["index"]}: up to date')
+            continue
+        logging.info(
+            f'index {report["index"]}: {report["seconds"]:.1f}s, '
+            f'logistics {report["original_logistics_shape"][0]} -> {report["cleaned_logistics_shape"][0]} rows, '
+            f'orders {report["original_order_shape"][0]} -> {report["cleaned_order_shape"][0]} rows')
+    succeeded = [report for report in reports if not report.get('failed') and not report.get('skipped')]
+    if succeeded:
+        logging.info(
+            f'total: {len(succeeded)}/{len(reports)} shards cleaned, '
+            f'logistics {sum(r["original_logistics_shape"][0] for r in succeeded)} -> '
+            f'{sum(r["cleaned_logistics_shape"][0] for r in succeeded)} rows, '
+            f'orders {sum(r["original_order_shape"][0] for r in succeeded)} -> '
+            f'{sum(r["cleaned_order_shape"][0] for r in succeeded)} rows')
+
+
+def log_audit_summary(summary: dict):
+    """
+    Log the time taken and the orders and events removed by every cleaning rule across the audited shards
+    :param summary: summary returned by save_audit_summary
+    """
+    logging.info(f'cleaning audit of shards {summary["shards"]}:')
+    for rule_name, entry in summary['rules'].items():
+        logging.info(
+            f'{rule_name}: {entry["wall_seconds"]:.1f}s ({entry["wall_seconds_share"] * 100:.1f}%), '
+            f'cpu {entry["cpu_seconds"]:.1f}s, peak memory +{entry["peak_memory_delta"] / GB:.2f}GB, '
+            f'removed {entry["orders_removed"]} orders ({entry["orders_removed_share"] * 100:.1f}%) and '
+            f'{entry["events_removed"]} events ({entry["events_removed_share"] * 100:.1f}%)')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root", "-r", type=str, required=True)
+    parser.add_argument("--logistics_detail", "-l", type=str, default="msom_logistic_detail")
+    parser.add_argument("--order_data", "-o", type=str, default="msom_order_data")
+    parser.add_argument("--indices", "-i", nargs="+", type=int, default=[i for i in range(1, 8)])
+    parser.add_argument('--feather', "-f", action=argparse.BooleanOptionalAction)
+    parser.add_argument('--fused', action=argparse.BooleanOptionalAction)
+    parser.add_argument('--workers', "-w", type=int, default=1)
+    parser.add_argument('--memory_limit', "-m", type=float, default=None,
+                        help="memory in GB the shards cleaned in parallel may use, defaults to the physical memory")
+    parser.add_argument('--streaming', "-s", action=argparse.BooleanOptionalAction,
+                        help="clean each shard one order id bucket at a time")
+    parser.add_argument('--bucket_memory', "-b", type=float, default=4,
+                        help="memory ceiling in GB of cleaning a single bucket when streaming")
+    parser.add_argument('--chunk_size', "-c", type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="number of csv rows read at a time when streaming or reading in two phases")
+    parser.add_argument('--two_phase', "-t", action=argparse.BooleanOptionalAction,
+                        help="apply the order only rules before reading the logistics data and skip the events of "
+                             "the orders they remove while reading it")
+    parser.add_argument('--export_format', "-e", choices=[FEATHER, PARQUET], default=FEATHER,
+                        help="export a feather file per table and shard or partitioned parquet datasets")
+    parser.add_argument('--partition_by_company', action=argparse.BooleanOptionalAction,
+                        help="also partition the parquet datasets by logistic company")
+    parser.add_argument('--force', action=argparse.BooleanOptionalAction,
+                        help="clean every shard even if its inputs, rules and outputs are unchanged")
+
+    args = parser.parse_args()
+    if args.two_phase and args.streaming:
+        parser.error('--two_phase reads whole shards, it can\'t be combined with --streaming')
+    configure_logging()
+
+    cleaned_dir = os.path.join(args.root, 'cleaned')
+    manifest = load_manifest(cleaned_dir)
+    rule_fingerprints = DataCleaner.get_rule_fingerprints()
+    stale_shards = get_stale_shards(args, manifest, rule_fingerprints)
+    save_manifest(cleaned_dir, manifest)
+
+    def record_report(report: dict):
+        # Record every shard as soon as it is done, so an interrupted run keeps its progress
+        if report.get('failed'):
+            manifest['shards'].pop(str(report['index']), None)
+        else:
+            manifest['shards'][str(report['index'])] = create_shard_entry(
+                stale_shards[report['index']], rule_fingerprints, get_settings(args), report['outputs'])
+        save_manifest(cleaned_dir, manifest)
 
-        logging.info(f'started cleanup for index {index}')
-        del data_cleaner
-        gc.collect()
-        logging.info(f'finished cleanup for index {index}')
+    reports = [{'index': index, 'skipped': True} for index in args.indices if index not in stale_shards]
+    if args.workers > 1:
+        reports += clean_shards_in_parallel(args, list(stale_shards), record_report)
+    else:
+        for index in stale_shards:
+            reports.append(clean_shard(args, index))
+            record_report(reports[-1])
+    log_summary(reports)
+    log_audit_summary(save_audit_summary(cleaned_dir, args.indices))
+    if any(report.get('failed') for report in reports):
+        sys.exit(1)
 
 
 if __name__ == "__main__":
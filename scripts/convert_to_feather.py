@@ -6,20 +6,11 @@ import os.path
 
 import pandas as pd
 
-from data_processing import DataCleaner
+from data_processing import *
 from constants import *
 
-LOGISTICS_COLUMN_NAMES = [ORDER_ID, ORDER_DATE, LOGISTICS_ORDER_ID, ACTION, FACILITY_ID, FACILITY_TYPE, CITY_ID,
-                          LOGISTIC_COMPANY_ID, TIMESTAMP]
-LOGISTICS_COLS = [0, 1, 2, 3, 4, 5, 6, 7, 8]
-ORDER_COLUMN_NAMES = [DAY, ORDER_ID, ITEM_DETAIL_INFO, PAY_TIMESTAMP, BUYER_ID, PROMISE_SPEED, IF_CAINIAO, MERCHANT_ID,
-                      LOGISTICS_REVIEW_SCORE]
-ORDER_COLS = [0, 1, 2, 3, 4, 5, 6, 7, 8]
+DEFAULT_CHUNK_SIZE = 1_000_000
 
-# LOGISTICS_COLUMN_NAMES = [ORDER_ID, ORDER_DATE, ACTION, FACILITY_TYPE, CITY_ID, LOGISTIC_COMPANY_ID, TIMESTAMP]
-# LOGISTICS_COLS = [0, 1, 3, 5, 6, 7, 8]
-# ORDER_COLUMN_NAMES = [ORDER_ID, ITEM_DETAIL_INFO, PAY_TIMESTAMP, PROMISE_SPEED, IF_CAINIAO, LOGISTICS_REVIEW_SCORE]
-# ORDER_COLS = [1, 2, 3, 5, 6, 8]
 
 def main():
     parser = argparse.ArgumentParser()
@@ -27,6 +18,16 @@ def main():
     parser.add_argument("--logistics_detail", "-l", type=str, default="msom_logistic_detail")
     parser.add_argument("--order_data", "-o", type=str, default="msom_order_data")
     parser.add_argument("--indices", "-i", nargs="+", default=[i for i in range(1, 8)])
+    parser.add_argument('--bucket_memory', "-b", type=float, default=None,
+                        help="write order id buckets of at most this many GB in memory instead of a single file")
+    parser.add_argument('--chunk_size', "-c", type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="number of csv rows read at a time when writing buckets")
+    parser.add_argument('--engine', "-e", choices=['arrow', 'pandas'], default='arrow',
+                        help="read the csv files with the streaming pyarrow reader or with pandas")
+    parser.add_argument('--block_size', type=int, default=CSV_BLOCK_SIZE,
+                        help="bytes of csv read at a time by the arrow engine")
+    parser.add_argument('--skip_dimension_tables', action='store_true',
+                        help="don't convert the item, seller and inventory data in data_8 and their aggregates")
 
     args = parser.parse_args()
     # logging.getLogger().setLevel(logging.INFO)
@@ -37,16 +38,28 @@ def main():
     )
 
     for index in args.indices:
-        logging.info(f'started reading index {index}')
-        logistics_data_df = pd.read_csv(
-            os.path.join(args.root, f'data_{index}', f'{args.logistics_detail}_{index}.csv'),
-            names=LOGISTICS_COLUMN_NAMES)
-        order_data_df = pd.read_csv(
-            os.path.join(args.root, f'data_{index}', f'{args.order_data}_{index}.csv'),
-            names=ORDER_COLUMN_NAMES)
+        logistics_data_csv_dir = os.path.join(args.root, f'data_{index}', f'{args.logistics_detail}_{index}.csv')
+        order_data_csv_dir = os.path.join(args.root, f'data_{index}', f'{args.order_data}_{index}.csv')
+        if args.bucket_memory:
+            bucket_count = get_bucket_count([logistics_data_csv_dir, order_data_csv_dir], args.bucket_memory)
+            partition_csv(logistics_data_csv_dir, LOGISTICS_COLUMN_NAMES,
+                          os.path.join(args.root, f'data_{index}', f'{args.logistics_detail}_{index}_buckets'),
+                          bucket_count, args.chunk_size, apply_logistics_schema)
+            partition_csv(order_data_csv_dir, ORDER_COLUMN_NAMES,
+                          os.path.join(args.root, f'data_{index}', f'{args.order_data}_{index}_buckets'),
+                          bucket_count, args.chunk_size, apply_order_schema)
+            continue
 
         logistic_data_file_dir = os.path.join(args.root, f'data_{index}', f'{args.logistics_detail}_{index}.feather')
         order_data_file_dir = os.path.join(args.root, f'data_{index}', f'{args.order_data}_{index}.feather')
+        if args.engine == 'arrow':
+            convert_logistics_csv_to_feather(logistics_data_csv_dir, logistic_data_file_dir, args.block_size)
+            convert_order_csv_to_feather(order_data_csv_dir, order_data_file_dir, args.block_size)
+            continue
+
+        logging.info(f'started reading index {index}')
+        logistics_data_df = read_logistics_csv(logistics_data_csv_dir)
+        order_data_df = read_order_csv(order_data_csv_dir)
 
         logging.info(f'started exporting logistics data to {logistic_data_file_dir}')
         logistics_data_df.to_feather(logistic_data_file_dir)
@@ -56,6 +69,9 @@ def main():
         order_data_df.to_feather(order_data_file_dir)
         logging.info('finished exporting order data')
 
+    if not args.skip_dimension_tables:
+        write_dimension_tables(args.root, args.block_size)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from constants import *
+from reproduction import *
+from reproduction import figure3
+
+SPLIT_VALUES = range(2, 5)
+ROWS_PER_CELL = 60
+
+
+def generate_regression_data(seed: int) -> pd.DataFrame:
+    """
+    Generate regression data with random regressors, every (day count, action time bin) cell has full rank
+    :param seed: seed of the random generator
+    :return: dataframe with the regressors of figure 3, the shipment score and the cell columns
+    """
+    rng = np.random.default_rng(seed)
+    row_count = len(SPLIT_VALUES) * len(figure3.BINS) * ROWS_PER_CELL
+    df = pd.DataFrame({column: rng.integers(0, 10, row_count).astype(float) for column in figure3.OLS_REGRESSORS})
+    df[figure3.DAY_COUNT] = np.repeat(list(SPLIT_VALUES), row_count // len(SPLIT_VALUES))
+    df[ACTION_TIME_INTERVAL] = np.tile(np.repeat(figure3.BINS, ROWS_PER_CELL), len(SPLIT_VALUES))
+    df[LOGISTICS_REVIEW_SCORE] = rng.integers(2, 6, row_count).astype(float)
+    return df
+
+
+@pytest.mark.parametrize('alpha', [0.1, 0.05])
+def test_batched_ols_matches_statsmodels_on_full_rank_cells(alpha):
+    df = generate_regression_data(0)
+    batched_results = figure3.run_ols(df, figure3.DAY_COUNT, SPLIT_VALUES, alpha, figure3.BATCHED)
+    statsmodels_results = figure3.run_ols(df, figure3.DAY_COUNT, SPLIT_VALUES, alpha, figure3.STATSMODELS)
+    for batched_result, statsmodels_result in zip(batched_results, statsmodels_results):
+        np.testing.assert_allclose(batched_result, statsmodels_result, rtol=1e-8, atol=1e-10)
+
+
+def test_rank_deficient_cells_get_the_minimum_norm_solution():
+    rng = np.random.default_rng(1)
+    x = rng.normal(size=(50, 3))
+    # The last regressor is the sum of the others
+    x = np.column_stack([x, x.sum(axis=1)])
+    y = rng.normal(size=50)
+    results = solve_cell_ols(*compute_cell_statistics(x, y, np.zeros(50, dtype=np.int64), 1))
+    assert results['rank'][0] == 3
+    assert results['df_resid'][0] == 47
+    np.testing.assert_allclose(results['params'][0], np.linalg.lstsq(x, y, rcond=None)[0], rtol=1e-8, atol=1e-10)
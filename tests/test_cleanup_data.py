@@ -0,0 +1,111 @@
+import glob
+import json
+import os.path
+import subprocess
+import sys
+
+import pandas as pd
+import pytest
+
+from constants import *
+from data_processing import *
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EVENT_COUNT = 20_000
+
+
+def run_cleanup(root_dir: str, *flags: str):
+    """
+    Run scripts/cleanup_data.py on shard 1 of a dataset
+    :param root_dir: directory containing the dataset
+    :param flags: extra command line flags
+    """
+    subprocess.run([sys.executable, os.path.join(REPO_DIR, 'scripts', 'cleanup_data.py'), '-r', root_dir, '-i', '1',
+                    '--force', *flags], check=True, capture_output=True,
+                   env=dict(os.environ, PYTHONPATH=REPO_DIR))
+
+
+def read_cleaned_files(root_dir: str) -> dict:
+    """
+    Read the cleaned feather files of a dataset
+    :param root_dir: directory containing the dataset
+    :return: dict mapping the name of every file to its dataframe
+    """
+    file_paths = sorted(glob.glob(os.path.join(root_dir, 'cleaned', 'data_*', '*.feather')))
+    return {os.path.basename(file_path): pd.read_feather(file_path) for file_path in file_paths}
+
+
+def read_audit(root_dir: str) -> dict:
+    """
+    Read the rows removed and left by every rule from the cleaning audit of shard 1, without the timings
+    :param root_dir: directory containing the dataset
+    :return: dict mapping every rule to its row counts
+    """
+    with open(get_audit_path(os.path.join(root_dir, 'cleaned'), 1)) as file:
+        rules = json.load(file)['rules']
+    return {rule: {field: entry[field] for field in ['orders_removed', 'order_rows_removed', 'events_removed',
+                                                      'order_rows', 'events']} for rule, entry in rules.items()}
+
+
+def assert_same_files(expected: dict, actual: dict):
+    assert expected.keys() == actual.keys()
+    for file_name in expected:
+        pd.testing.assert_frame_equal(expected[file_name], actual[file_name], obj=file_name)
+
+
+@pytest.fixture(scope='module')
+def dataset_dir(tmp_path_factory) -> str:
+    root_dir = str(tmp_path_factory.mktemp('data'))
+    write_synthetic_dataset(root_dir, EVENT_COUNT, [1], seed=1)
+    return root_dir
+
+
+@pytest.fixture(scope='module')
+def two_phase_dataset_dir(tmp_path_factory) -> str:
+    root_dir = str(tmp_path_factory.mktemp('data'))
+    write_synthetic_dataset(root_dir, EVENT_COUNT, [1], seed=2)
+    # Rows without an order id, the order row is removed by remove_not_cainiao
+    with open(os.path.join(root_dir, 'data_1', 'msom_order_data_1.csv'), 'a') as file:
+        file.write('2017-03-01,,1:1,2017-03-01 10:00:00,5,1,0,3,4\n')
+    with open(os.path.join(root_dir, 'data_1', 'msom_logistic_detail_1.csv'), 'a') as file:
+        file.write(',2017-03-01,77,CONSIGN,1,a,3,4,2017-03-01 11:00:00\n')
+    subprocess.run([sys.executable, os.path.join(REPO_DIR, 'scripts', 'convert_to_feather.py'), '-r', root_dir,
+                    '-i', '1', '--skip_dimension_tables'], check=True, capture_output=True,
+                   env=dict(os.environ, PYTHONPATH=REPO_DIR))
+    return root_dir
+
+
+@pytest.mark.parametrize('flags', [[], ['--fused'], ['--feather'], ['--feather', '--fused']])
+def test_two_phase_writes_the_same_files_and_audit(two_phase_dataset_dir, flags):
+    run_cleanup(two_phase_dataset_dir, *flags)
+    files, audit = read_cleaned_files(two_phase_dataset_dir), read_audit(two_phase_dataset_dir)
+    run_cleanup(two_phase_dataset_dir, '--two_phase', '--chunk_size', '5000', *flags)
+    assert_same_files(files, read_cleaned_files(two_phase_dataset_dir))
+    two_phase_audit = read_audit(two_phase_dataset_dir)
+    assert list(two_phase_audit) == list(audit)
+    assert two_phase_audit == audit
+    assert all(audit[rule]['events_removed'] > 0 for rule in DataCleaner.get_leading_order_rules())
+
+
+@pytest.mark.parametrize('flags', [[], ['--fused']])
+def test_streaming_writes_the_same_files(dataset_dir, flags):
+    run_cleanup(dataset_dir, *flags)
+    in_memory_files = read_cleaned_files(dataset_dir)
+    run_cleanup(dataset_dir, '--streaming', '--bucket_memory', '0.0005', '--chunk_size', '5000', *flags)
+    assert_same_files(in_memory_files, read_cleaned_files(dataset_dir))
+
+
+def test_streaming_exports_empty_tables_without_order_data(tmp_path):
+    root_dir = str(tmp_path)
+    for file_name, column_names, apply_schema in [('msom_logistic_detail_1', LOGISTICS_COLUMN_NAMES,
+                                                   apply_logistics_schema),
+                                                  ('msom_order_data_1', ORDER_COLUMN_NAMES, apply_order_schema)]:
+        bucket_dir = os.path.join(root_dir, 'data_1', f'{file_name}_buckets')
+        os.makedirs(bucket_dir)
+        for bucket in range(2):
+            apply_schema(pd.DataFrame(columns=column_names)).to_feather(get_bucket_path(bucket_dir, bucket))
+    run_cleanup(root_dir, '--feather', '--streaming')
+    cleaned_files = read_cleaned_files(root_dir)
+    assert set(cleaned_files) == {'cleaned_logistics_detail_1.feather', 'cleaned_order_data_1.feather',
+                                  'cleaned_order_summary_1.feather', 'order_keys_1.feather'}
+    assert all(df.empty for df in cleaned_files.values())
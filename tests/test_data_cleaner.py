@@ -0,0 +1,43 @@
+import pandas as pd
+import pytest
+
+from constants import *
+from data_processing import *
+
+EVENT_COUNT = 20_000
+AUDIT_COUNTERS = ['orders_removed', 'order_rows_removed', 'events_removed', 'order_rows', 'events']
+
+
+def get_removed_counts(data_cleaner: DataCleaner) -> dict:
+    """
+    :param data_cleaner: cleaner that has cleaned its data
+    :return: dict mapping every rule to the rows it removed and left, without the timings
+    """
+    return {rule: {field: entry[field] for field in AUDIT_COUNTERS}
+            for rule, entry in data_cleaner.audit.rules.items() if rule != 'fused_clean_up'}
+
+
+def sort_by_order(df: pd.DataFrame) -> pd.DataFrame:
+    return df.sort_values(ORDER_ID, kind='stable')
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+@pytest.mark.parametrize('shuffled', [False, True])
+def test_fused_clean_up_matches_clean_up(seed, shuffled):
+    logistics_data_df, order_data_df, _ = generate_synthetic_data(EVENT_COUNT, seed)
+    if shuffled:
+        logistics_data_df = logistics_data_df.sample(frac=1, random_state=seed)
+    data_cleaner = DataCleaner(order_data_df.copy(), logistics_data_df.copy())
+    data_cleaner.clean_up()
+    fused_data_cleaner = DataCleaner(order_data_df.copy(), logistics_data_df.copy())
+    fused_data_cleaner.fused_clean_up()
+
+    pd.testing.assert_frame_equal(data_cleaner.order_data_df, fused_data_cleaner.order_data_df)
+    # clean_up groups events that aren't grouped by order, the export sorts both by order id
+    pd.testing.assert_frame_equal(sort_by_order(data_cleaner.logistics_data_df),
+                                  sort_by_order(fused_data_cleaner.logistics_data_df))
+    removed_counts = get_removed_counts(data_cleaner)
+    assert list(removed_counts) == list(get_removed_counts(fused_data_cleaner))
+    assert removed_counts == get_removed_counts(fused_data_cleaner)
+    assert all(removed_counts[rule]['orders_removed'] > 0 for rule in DataCleaner.RULES
+               if rule not in ['remove_trade_success_actions', 'drop_duplicates'])
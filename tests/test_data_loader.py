@@ -0,0 +1,35 @@
+import os.path
+
+import pytest
+
+import data_processing.data_loader as data_loader
+from constants import *
+from data_processing import *
+
+
+def test_load_full_data_without_cleaned_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(data_loader, 'CLEANED_DATA_DIR_ROOT', str(tmp_path))
+    with pytest.raises(FileNotFoundError, match='CLEANED_DATA_DIR_ROOT'):
+        data_loader.load_full_logistics_data()
+
+
+@pytest.mark.parametrize('precomputed', [True, False])
+def test_dimension_loaders_take_columns_and_filters(tmp_path, monkeypatch, precomputed):
+    write_synthetic_dataset(str(tmp_path), 2_000, [1])
+    write_dimension_tables(str(tmp_path))
+    if not precomputed:
+        os.remove(get_dimension_table_path(str(tmp_path / 'cleaned'), ITEM_DIMENSION_FILE_NAME))
+    monkeypatch.setattr(data_loader, 'CLEANED_DATA_DIR_ROOT', str(tmp_path / 'cleaned'))
+
+    item_dimension_df = data_loader.load_item_dimension()
+    merchant_id = item_dimension_df[MERCHANT_ID].iloc[0]
+    filtered_df = data_loader.load_item_dimension([ITEM_ID, MERCHANT_ID], [(MERCHANT_ID, '==', merchant_id)])
+    assert list(filtered_df.columns) == [ITEM_ID, MERCHANT_ID]
+    assert (filtered_df[MERCHANT_ID] == merchant_id).all()
+    assert len(filtered_df) == (item_dimension_df[MERCHANT_ID] == merchant_id).sum()
+
+    daily_item_traffic_df = data_loader.load_daily_item_traffic()
+    date = daily_item_traffic_df[DATE].iloc[0]
+    filtered_df = data_loader.load_daily_item_traffic([DATE, PC_PV], [(DATE, '==', date)])
+    assert list(filtered_df.columns) == [DATE, PC_PV]
+    assert filtered_df[PC_PV].tolist() == daily_item_traffic_df.loc[daily_item_traffic_df[DATE] == date, PC_PV].tolist()
@@ -0,0 +1,118 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from constants import *
+from data_processing import *
+from reproduction import *
+
+BIN_SIZES = [0.1, 0.05, 0.03]
+
+
+def generate_action_times(seed: int, row_count: int = 5_000) -> np.ndarray:
+    """
+    Generate action times between 0 and 1, with values on the bin edges, zeros and missing values
+    :param seed: seed of the random generator
+    :param row_count: number of random action times
+    :return: action times
+    """
+    rng = np.random.default_rng(seed)
+    edges = np.concatenate([np.arange(0, 1 + size, size) for size in BIN_SIZES])
+    return np.concatenate([rng.random(row_count), edges, np.round(edges, 2), [0.0, 1.0, np.nan]])
+
+
+def cut_action_time(action_time_df: pd.DataFrame, bin_size: float) -> pd.DataFrame:
+    """
+    Bin action times as bin_action_time did with pd.cut
+    """
+    bins = np.arange(0, action_time_df[ACTION_TIME].max() + bin_size, bin_size)
+    action_time_df[ACTION_TIME_INTERVAL] = pd.cut(action_time_df[ACTION_TIME], bins=bins)
+    action_time_df[ACTION_TIME_INTERVAL] = action_time_df[ACTION_TIME_INTERVAL].apply(lambda x: x.left)
+    return action_time_df[~action_time_df[ACTION_TIME_INTERVAL].isna()]
+
+
+@pytest.mark.parametrize('bin_size', BIN_SIZES)
+def test_bin_codes_match_pd_cut(bin_size):
+    values = generate_action_times(0)
+    # The last edges are left out, so that some values are beyond the last bin
+    bins, _ = get_action_time_bins(0.8, bin_size)
+    values = np.concatenate([values, -values, bins, bins + bin_size / 2])
+    np.testing.assert_array_equal(compute_bin_codes(values, bins, bin_size), pd.cut(values, bins).codes)
+
+
+@pytest.mark.parametrize('bin_size', BIN_SIZES)
+def test_bin_action_time_matches_pd_cut(bin_size):
+    action_time_df = pd.DataFrame({ACTION_TIME: generate_action_times(1)})
+    binned_df = bin_action_time(action_time_df.copy(), bin_size, bin_sizes=[0.2])
+    expected_df = cut_action_time(action_time_df.copy(), bin_size)
+    pd.testing.assert_index_equal(binned_df.index, expected_df.index)
+    np.testing.assert_array_equal(binned_df[ACTION_TIME_INTERVAL].astype(float), expected_df[ACTION_TIME_INTERVAL])
+    assert binned_df[ACTION_TIME_INTERVAL].cat.ordered
+    np.testing.assert_array_equal(binned_df[get_action_time_interval_column(0.2)].astype(float),
+                                  cut_action_time(action_time_df.copy(), 0.2).loc[binned_df.index,
+                                                                                    ACTION_TIME_INTERVAL])
+
+
+def compute_baseline_distribution_difference(logistics_data: pd.DataFrame, order_data: pd.DataFrame,
+                                             bin_size: float) -> pd.DataFrame:
+    """
+    Compute the distribution difference as compute_action_time_distribution_difference did with merges and groupby
+    """
+    sign_time = logistics_data[logistics_data[ACTION] == SIGNED][[ORDER_ID, TIMESTAMP_DATE_TIME]]
+    shipment_time = sign_time.merge(order_data[[ORDER_ID, PAY_TIMESTAMP_DATETIME, LOGISTICS_REVIEW_SCORE]],
+                                    on=ORDER_ID, how=LEFT)
+    shipment_time[SHIPMENT_TIME] = shipment_time[TIMESTAMP_DATE_TIME] - shipment_time[PAY_TIMESTAMP_DATETIME]
+    shipment_time = shipment_time.rename(columns={PAY_TIMESTAMP_DATETIME: ORDER_TIME, TIMESTAMP_DATE_TIME: SIGN_TIME})
+    action_time = logistics_data[[ORDER_ID, ACTION, TIMESTAMP_DATE_TIME]].merge(shipment_time, on=ORDER_ID, how=LEFT)
+    action_time[ACTION_TIME] = (action_time[TIMESTAMP_DATE_TIME] - action_time[ORDER_TIME]) / action_time[SHIPMENT_TIME]
+    action_time = action_time[(action_time[ACTION_TIME] >= 0) & (action_time[ACTION_TIME] <= 1)]
+    action_time = cut_action_time(action_time.copy(), bin_size)
+    action_time.loc[action_time[LOGISTICS_REVIEW_SCORE] <= 1, LOGISTICS_REVIEW_SCORE] = 2
+
+    conditional_pdfs = action_time.groupby([LOGISTICS_REVIEW_SCORE, ACTION, ACTION_TIME_INTERVAL],
+                                           observed=True).size().rename(CONDITIONAL_DENSITY)
+    conditional_pdfs = conditional_pdfs / conditional_pdfs.groupby([ACTION, LOGISTICS_REVIEW_SCORE],
+                                                                   observed=True).transform(SUM)
+    unconditional_pdfs = action_time.groupby([ACTION_TIME_INTERVAL, ACTION], observed=True).size().rename(
+        UNCONDITIONAL_DENSITY)
+    unconditional_pdfs = unconditional_pdfs / unconditional_pdfs.groupby([ACTION], observed=True).transform(SUM)
+    merged = conditional_pdfs.reset_index().merge(unconditional_pdfs.reset_index(), on=[ACTION, ACTION_TIME_INTERVAL],
+                                                  how=LEFT)
+    merged[DISTRIBUTION_DIFFERENCE] = merged[CONDITIONAL_DENSITY] - merged[UNCONDITIONAL_DENSITY]
+    return merged
+
+
+def to_comparable(distribution_difference: pd.DataFrame) -> pd.DataFrame:
+    """
+    :return: the score, action, interval and difference columns with plain dtypes, sorted by score, action and interval
+    """
+    columns = [LOGISTICS_REVIEW_SCORE, ACTION, ACTION_TIME_INTERVAL]
+    return distribution_difference.astype({LOGISTICS_REVIEW_SCORE: float, ACTION: str, ACTION_TIME_INTERVAL: float})[
+        columns + [DISTRIBUTION_DIFFERENCE]].sort_values(columns, ignore_index=True)
+
+
+@pytest.fixture(scope='module')
+def cleaned_data() -> tuple:
+    logistics_data_df, order_data_df, _ = generate_synthetic_data(20_000, seed=3)
+    data_cleaner = DataCleaner(order_data_df, logistics_data_df)
+    data_cleaner.clean_up()
+    return data_cleaner.logistics_data_df, data_cleaner.order_data_df
+
+
+@pytest.mark.parametrize('bin_size', [0.1, 0.05])
+def test_action_time_histogram_matches_the_baseline_groupby(cleaned_data, bin_size):
+    logistics_data_df, order_data_df = cleaned_data
+    distribution_difference = compute_action_time_distribution_difference(logistics_data_df, order_data_df, bin_size)
+    expected = compute_baseline_distribution_difference(logistics_data_df, order_data_df, bin_size)
+    pd.testing.assert_frame_equal(to_comparable(distribution_difference), to_comparable(expected))
+
+
+def test_merged_shard_histograms_match_the_full_histogram(cleaned_data):
+    logistics_data_df, order_data_df = cleaned_data
+    is_first_shard = order_data_df[ORDER_ID] % 2 == 0
+    histograms = [compute_action_time_histogram(
+        logistics_data_df[logistics_data_df[ORDER_ID].isin(order_data_df.loc[is_shard, ORDER_ID])],
+        order_data_df[is_shard]) for is_shard in [is_first_shard, ~is_first_shard]]
+    pd.testing.assert_frame_equal(
+        ActionTimeHistogram.merge(histograms).compute_distribution_difference(),
+        compute_action_time_histogram(logistics_data_df, order_data_df).compute_distribution_difference())
@@ -0,0 +1,31 @@
+import inspect
+
+import pytest
+
+import data_processing.order_summary as order_summary_module
+from data_processing import *
+
+
+@pytest.fixture
+def shard_entry(tmp_path) -> dict:
+    output_path = tmp_path / 'cleaned_logistics_detail_1.feather'
+    output_path.write_bytes(b'cleaned')
+    return create_shard_entry({}, DataCleaner.get_rule_fingerprints(), {}, [str(output_path)])
+
+
+def test_unchanged_shard_is_up_to_date(shard_entry):
+    assert get_stale_reasons(shard_entry, {}, DataCleaner.get_rule_fingerprints(), {}) == []
+
+
+def test_editing_a_helper_marks_the_shard_stale(shard_entry, monkeypatch):
+    get_source = inspect.getsource
+    monkeypatch.setattr(inspect, 'getsource', lambda obj: get_source(obj) + (
+        '\n# edited\n' if obj is order_summary_module else ''))
+    assert get_stale_reasons(shard_entry, {}, DataCleaner.get_rule_fingerprints(), {}) == [
+        "cleaning code changed: ['data_processing.order_summary']"]
+
+
+def test_manifest_without_code_fingerprints_is_stale(shard_entry):
+    del shard_entry['rules']['code']
+    reasons = get_stale_reasons(shard_entry, {}, DataCleaner.get_rule_fingerprints(), {})
+    assert len(reasons) == 1 and reasons[0].startswith('cleaning code changed')